@@ -0,0 +1,27 @@
+"""
+ASGI config for xtreem project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Besides the Django application, it serves the Server-Sent Events
+of xtreembackend/events.py, which need a long-lived connection.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'xtreem.settings')
+
+djangoApplication = get_asgi_application()
+
+# imported after the setup of Django, since it imports the models
+from xtreembackend.events import EVENTS_PATH, eventsApplication
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] == EVENTS_PATH:
+        await eventsApplication(scope, receive, send)
+    else:
+        await djangoApplication(scope, receive, send)
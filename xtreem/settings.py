@@ -52,6 +52,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'xtreembackend.middleware.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'xtreem.urls'
@@ -73,6 +74,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'xtreem.wsgi.application'
+ASGI_APPLICATION = 'xtreem.asgi.application'
 
 
 # Database
@@ -127,3 +129,21 @@ USE_X_FORWARDED_HOST = True
 STATIC_URL = '/static/'
 
 CORS_ORIGIN_ALLOW_ALL = True
+
+# Size limit of the process-wide cache of nodes and links (see xtreembackend/graphcache.py).
+# It is dropped whenever a request reads a new graph revision, so that the writes
+# of other processes are noticed. Set to 0 to disable the cache.
+GRAPH_CACHE_SIZE = 100000
+
+# Whether to keep an in-memory index of all links (see xtreembackend/graphindex.py),
+# which lets subgraph queries skip the database except for fetching the nodes.
+GRAPH_INDEX_ENABLED = False
+
+# Whether the async API views may issue independent reads concurrently (e.g. the reads
+# of getChangesSince), on separate database connections (see AsyncNodeRepository
+# in xtreembackend/repositories.py). All other reads use the connection of the request.
+ASYNC_CONCURRENT_READS = True
+
+# Size limit (in bytes) of the process-wide cache of encoded getNodes responses
+# (see xtreembackend/compression.py). Set to 0 to disable the cache.
+RESPONSE_CACHE_SIZE = 50 * 1024 * 1024
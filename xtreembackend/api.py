@@ -1,10 +1,15 @@
+import asyncio
 from typing import List
 
-from .repositories import NodeRepository
+from django.db import transaction
+
+from . import metrics
+from .repositories import AsyncNodeRepository, NodeRepository, NodeNotFoundException
 from .domain.objects import LinkID, Node, NodeData, Link, LinkType
 from .domain.cache import Cache
+from .validation import ValidationException
 
-from .dataspecs import Result, AggregateDataType, IntDataType, ListDataType, Nullable, StringDataType
+from .dataspecs import Maybe, Result, AggregateDataType, BoolDataType, EnumDataType, IntDataType, ListDataType, MapDataType, NoneDataType, Nullable, StringDataType, TaggedUnionDataType, WithDefault
 
 #
 # This file contains the specification and implementation of the API
@@ -21,66 +26,364 @@ from .dataspecs import Result, AggregateDataType, IntDataType, ListDataType, Nul
 # https://lexi-lambda.github.io/blog/2019/11/05/parse-don-t-validate/
 #
 
+# If `titlesOnly` is set, the content of all nodes except for
+# the ones with the given ids is replaced by an empty string.
+# If `maxChildren` is set, only the first `maxChildren` children
+# (in the order the links were created) of every node are returned
+# and followed; the result contains a cursor for a GetChildrenPageCommand
+# for every node with more children (see GetNodesResult).
 GetNodesCommand = AggregateDataType({
     "ids": ListDataType(StringDataType),
     "depth": IntDataType,
+    "titlesOnly": WithDefault(BoolDataType, False),
+    "maxChildren": WithDefault(Nullable(IntDataType), Maybe.nothing()),
 }, lambda cmd: Result.ensure([
     (cmd["depth"] >= 0, "The depth must be nonnegative"),
     (cmd["depth"] <= 10, "The depth must be at most 10"),
+    (not cmd["maxChildren"].hasValue() or 1 <= cmd["maxChildren"].extract() <= 1000, "maxChildren must be between 1 and 1000"),
 ]))
 
+# A Cache with the result of a GetNodesCommand, plus the IDs of the
+# returned nodes whose subtrees were truncated because the result would
+# have contained more than 2000 nodes: the nodes whose children were not
+# fetched although they are above `depth`, and the nodes with children
+# that were not returned. A client can fetch the rest with
+# another GetNodesCommand for these nodes.
+# `childCursors` maps the IDs of the nodes that have more than `maxChildren`
+# children to the cursor of the next page of their children.
+GetNodesResult = AggregateDataType(dict(Cache.getSchema(), **{
+    "truncatedIds": ListDataType(StringDataType),
+    "childCursors": MapDataType(StringDataType, StringDataType),
+}), lambda result: Result.success(None))
+
 def executeGetNodesCommand(cmd, repository):
-    cache = Cache.createEmpty()
-    depthOfLevel = cmd["depth"]
+    result = Cache.createEmpty()
+    truncatedIds = set()
+    childCursors = {}
+    for (nodesById, childrenByParentId) in iterGetNodesCommand(cmd, repository, truncatedIds, childCursors):
+        for node in nodesById.values():
+            Cache.storeNode(result, node)
+        for (id, children) in childrenByParentId.items():
+            Cache.storeChildren(result, id, children)
+
+    result["truncatedIds"] = sorted(truncatedIds, key=int)
+    result["childCursors"] = childCursors
+    return result
+
+# Yields the result of a GetNodesCommand level by level,
+# as pairs (nodesById, childrenByParentId).
+# The whole subgraph is fetched at once (see NodeRepository.iterSubgraph)
+# instead of querying the database level by level.
+# Every node is returned once, on the lowest level it is reachable on,
+# and only distinct nodes count against the limit of 2000 nodes.
+# Once all levels have been consumed, the IDs of the nodes
+# whose subtrees were truncated (see GetNodesResult) have been added
+# to `truncatedIds`, and the cursors to `childCursors`, if given.
+def iterGetNodesCommand(cmd, repository, truncatedIds=None, childCursors=None):
+    levelCount = 0
     nodeCount = 0
-    idsOnLevel = []
+    returnedIds = set()
+    childIdsByParentId = {}
+    maxChildren = cmd["maxChildren"].extract() if cmd["maxChildren"].hasValue() else None
+    lastChildKeys = {}
+    for (nodesById, childrenByParentId) in repository.iterSubgraph(cmd["ids"], cmd["depth"], 2000, cmd["titlesOnly"], maxChildren, lastChildKeys):
+        if truncatedIds is not None:
+            returnedIds.update(nodesById.keys())
+            for (id, children) in childrenByParentId.items():
+                childIdsByParentId[id] = [link["targetId"] for link in children]
+            if levelCount < cmd["depth"]:
+                truncatedIds.update(id for id in nodesById if id not in childrenByParentId)
+
+        levelCount += 1
+        nodeCount += len(nodesById)
+        yield (nodesById, childrenByParentId)
+
+    if truncatedIds is not None:
+        for (id, childIds) in childIdsByParentId.items():
+            if any(childId not in returnedIds for childId in childIds):
+                truncatedIds.add(id)
+    if childCursors is not None:
+        for (id, lastKey) in lastChildKeys.items():
+            childCursors[id] = encodeChildrenCursor("id", lastKey)
+    metrics.record("levels", levelCount)
+    metrics.record("nodes", nodeCount)
+
+# Returns a page of the children of a node and the child nodes themselves,
+# ordered by `orderBy` (see NodeRepository.getChildrenPage).
+# The first page is requested without a `cursor`; the cursor of the next page
+# is part of the result (see ChildrenPage). Cursors are only valid for the
+# `orderBy` they were created for.
+GetChildrenPageCommand = AggregateDataType({
+    "parentId": StringDataType,
+    "orderBy": WithDefault(EnumDataType(["id", "type"]), "id"),
+    "cursor": WithDefault(Nullable(StringDataType), Maybe.nothing()),
+    "limit": IntDataType,
+}, lambda cmd: Result.ensure([
+    (1 <= cmd["limit"] <= 1000, "The limit must be between 1 and 1000"),
+]))
+
+# `cursor` is null on the last page.
+ChildrenPage = AggregateDataType({
+    "children": ListDataType(Link),
+    "nodesById": MapDataType(StringDataType, Node),
+    "cursor": Nullable(StringDataType),
+}, lambda page: Result.success(None))
+
+def executeGetChildrenPageCommand(cmd, repository: NodeRepository):
+    after = None
+    if cmd["cursor"].hasValue():
+        after = decodeChildrenCursor(cmd["orderBy"], cmd["cursor"].extract())
+    (children, lastKey) = repository.getChildrenPage(cmd["parentId"], cmd["orderBy"], after, cmd["limit"])
+    nodesById = repository.get([link["targetId"] for link in children])
+
+    return {
+        "children": children,
+        "nodesById": {id: node for (id, node) in nodesById.items() if node is not None},
+        "cursor": Maybe.value(encodeChildrenCursor(cmd["orderBy"], lastKey)) if lastKey is not None else Maybe.nothing(),
+    }
+
+# Cursors are the keys of NodeRepository.getChildrenPage,
+# encoded as "<link ID>" or "<type>:<link ID>".
+def encodeChildrenCursor(orderBy, key):
+    if orderBy == "id":
+        return str(key)
+    return key[0] + ":" + str(key[1])
+
+def decodeChildrenCursor(orderBy, cursor):
+    try:
+        if orderBy == "id":
+            return int(cursor)
+        (type, id) = cursor.split(":")
+        return (LinkType.create(type), int(id))
+    except ValueError:
+        raise ValidationException("invalid cursor")
 
-    def assignIdsForNextLevel(ids):
-        nonlocal nodeCount, depthOfLevel, idsOnLevel
-        if nodeCount + len(ids) >= 2000:
-            depthOfLevel = 0
-            idsOnLevel = ids[0:2000-nodeCount]
-        else:
-            idsOnLevel = ids
-        nodeCount += len(idsOnLevel)
-    assignIdsForNextLevel(cmd["ids"])
+# Returns the node `id` and its ancestors, i.e. all nodes it can be reached from,
+# together with the parents of each of them, e.g. for showing breadcrumbs
+# (see NodeRepository.getAncestors).
+GetAncestorsCommand = AggregateDataType({
+    "id": StringDataType,
+}, lambda cmd: Result.success(None))
+
+AncestorsResult = AggregateDataType({
+    "nodesById": MapDataType(StringDataType, Node),
+    "parentIdsById": MapDataType(StringDataType, ListDataType(StringDataType)),
+}, lambda result: Result.success(None))
+
+def executeGetAncestorsCommand(cmd, repository: NodeRepository):
+    (nodesById, parentIdsById) = repository.getAncestors(cmd["id"])
+    return {
+        "nodesById": nodesById,
+        "parentIdsById": parentIdsById,
+    }
 
-    while depthOfLevel >= 0:
-        newIdsOnLevel = [id for id in idsOnLevel if not Cache.hasNode(cache, id)]
-        newNodesOnLevel = repository.get(newIdsOnLevel)
-        for (id, node) in newNodesOnLevel.items():
-            Cache.storeNode(cache, node)
+# Returns whether the node `targetId` can be reached from the node `sourceId`.
+IsReachableCommand = AggregateDataType({
+    "sourceId": StringDataType,
+    "targetId": StringDataType,
+}, lambda cmd: Result.success(None))
+
+IsReachableResult = AggregateDataType({
+    "reachable": BoolDataType,
+}, lambda result: Result.success(None))
 
-        depthOfLevel -= 1
-        if depthOfLevel >= 0:
-            idsWithUnknownChildrenOnLevel = [id for id in idsOnLevel if not Cache.hasChildrenOf(cache, id)]
-            for (id, children) in repository.getChildren(idsWithUnknownChildrenOnLevel).items():
-                Cache.storeChildren(cache, id, children)
+def executeIsReachableCommand(cmd, repository: NodeRepository):
+    return {"reachable": repository.isReachable(cmd["sourceId"], cmd["targetId"])}
 
-            assignIdsForNextLevel([link["targetId"] for parentId in idsOnLevel for link in Cache.getChildrenOf(cache, parentId)])
+# Returns the current state of the nodes and links that were changed
+# after `cursor` (a sequence number of the change log, 0 for the beginning)
+# as a Cache: every changed node, and all children of every node
+# whose links were changed, including nodes without any children left.
+# If a `subtree` is given, only changes to the nodes returned by the
+# corresponding GetNodesCommand (and to their links) are included.
+# The result contains the cursor for the next request; if `hasMore` is set,
+# not all changes were returned and the client should request again right away.
+# If `reset` is set, all nodes and links may have changed (e.g. because a snapshot
+# was imported), so the client must fetch everything it keeps again; the changes
+# only include those after the reset.
+GetChangesSinceCommand = AggregateDataType({
+    "cursor": IntDataType,
+    "subtree": WithDefault(Nullable(AggregateDataType({
+        "ids": ListDataType(StringDataType),
+        "depth": IntDataType,
+    }, lambda subtree: Result.ensure([
+        (subtree["depth"] >= 0, "The depth must be nonnegative"),
+        (subtree["depth"] <= 10, "The depth must be at most 10"),
+    ]))), Maybe.nothing()),
+}, lambda cmd: Result.ensure([
+    (cmd["cursor"] >= 0, "The cursor must be nonnegative"),
+]))
 
-    return cache
+ChangesResult = AggregateDataType({
+    "cursor": IntDataType,
+    "hasMore": BoolDataType,
+    "reset": BoolDataType,
+    "changes": Cache,
+}, lambda result: Result.success(None))
 
+def executeGetChangesSinceCommand(cmd, repository: NodeRepository):
+    (cursor, nodeIds, parentIds, hasMore, reset) = repository.getChangesSince(cmd["cursor"], 1000)
+    subtreeNodesById = None
+    if cmd["subtree"].hasValue():
+        subtree = cmd["subtree"].extract()
+        (subtreeNodesById, _) = repository.getSubgraph(subtree["ids"], subtree["depth"], 2000, True)
+        nodeIds = nodeIds & subtreeNodesById.keys()
+        parentIds = parentIds & subtreeNodesById.keys()
+
+    return changesResult(cursor, hasMore, reset, repository.get(nodeIds), repository.getChildren(parentIds), subtreeNodesById)
+
+# Same as executeGetChangesSinceCommand, but fetches the changed nodes,
+# their links and the subtree concurrently.
+async def executeGetChangesSinceCommandAsync(cmd, repository: AsyncNodeRepository):
+    (cursor, nodeIds, parentIds, hasMore, reset) = await repository.getChangesSince(cmd["cursor"], 1000)
+    reads = [repository.get(nodeIds), repository.getChildren(parentIds)]
+    if cmd["subtree"].hasValue():
+        subtree = cmd["subtree"].extract()
+        reads.append(repository.getSubgraph(subtree["ids"], subtree["depth"], 2000, True))
+    results = await asyncio.gather(*reads)
+
+    subtreeNodesById = results[2][0] if len(results) > 2 else None
+    return changesResult(cursor, hasMore, reset, results[0], results[1], subtreeNodesById)
+
+# Only the nodes in `subtreeNodesById` (if given) and their links are included.
+def changesResult(cursor, hasMore, reset, nodesById, childrenByParentId, subtreeNodesById):
+    changes = Cache.createEmpty()
+    for (id, node) in nodesById.items():
+        if node is not None and (subtreeNodesById is None or id in subtreeNodesById):
+            Cache.storeNode(changes, node)
+    for (id, children) in childrenByParentId.items():
+        if subtreeNodesById is None or id in subtreeNodesById:
+            Cache.storeChildren(changes, id, children)
+    metrics.record("nodes", len(changes["nodesById"]))
+
+    return {
+        "cursor": cursor,
+        "hasMore": hasMore,
+        "reset": reset,
+        "changes": changes,
+    }
+
+# Subscribes to the changes of the nodes that the corresponding
+# GetNodesCommand would return (see events.py). If a `cursor` is given,
+# the changes after it are sent right away; otherwise, only
+# the changes after the subscription are sent.
+SubscribeCommand = AggregateDataType({
+    "ids": ListDataType(StringDataType),
+    "depth": IntDataType,
+    "cursor": WithDefault(Nullable(IntDataType), Maybe.nothing()),
+}, lambda cmd: Result.ensure([
+    (cmd["depth"] >= 0, "The depth must be nonnegative"),
+    (cmd["depth"] <= 10, "The depth must be at most 10"),
+    (not cmd["cursor"].hasValue() or cmd["cursor"].extract() >= 0, "The cursor must be nonnegative"),
+]))
 
 CreateNodeCommand = AggregateDataType({
     "nodeData": NodeData,
     "parentId": Nullable(StringDataType),
 }, lambda cmd: Result.success(None))
 
+# The node is not created if the parent does not exist.
 def executeCreateNodeCommand(cmd, repository: NodeRepository) -> Node:
-    node = repository.create(cmd["nodeData"])
+    with transaction.atomic():
+        node = repository.create(cmd["nodeData"])
 
-    if cmd["parentId"].hasValue():
-        link = Link.create({
-            "sourceId": cmd["parentId"].extract(),
-            "targetId": node["id"],
-            "type": "general"
-        })
+        if cmd["parentId"].hasValue():
+            link = Link.create({
+                "sourceId": cmd["parentId"].extract(),
+                "targetId": node["id"],
+                "type": "general"
+            })
 
-        repository.link(link)
+            repository.link(link)
 
     return node
 
+# Creates many nodes, and links from their parents to them, at once.
+# Every node is given a temporary ID `tempId` (unique within the command)
+# by the client. `parentIds` are the IDs of existing nodes and `parentTempIds`
+# the temporary IDs of new nodes that become parents of the node; the latter
+# must come before the node in `nodes`, so the new nodes cannot form cycles.
+# All nodes are validated before any of them is created.
+CreateNodesCommand = AggregateDataType({
+    "nodes": ListDataType(AggregateDataType({
+        "tempId": StringDataType,
+        "nodeData": NodeData,
+        "parentIds": WithDefault(ListDataType(StringDataType), []),
+        "parentTempIds": WithDefault(ListDataType(StringDataType), []),
+    }, lambda node: Result.success(None))),
+}, lambda cmd: Result.ensure([
+    (len(cmd["nodes"]) <= 1000, "The number of nodes given must not be higher than 1000."),
+    (len(set(node["tempId"] for node in cmd["nodes"])) == len(cmd["nodes"]), "The temporary IDs must be unique."),
+    (parentTempIdsComeFirst(cmd["nodes"]), "Every parent must come before its children."),
+]))
+
+def parentTempIdsComeFirst(nodes):
+    tempIds = set()
+    for node in nodes:
+        if any(tempId not in tempIds for tempId in node["parentTempIds"]):
+            return False
+        tempIds.add(node["tempId"])
+    return True
+
+# `idMap` maps the temporary IDs to the IDs of the created nodes.
+CreateNodesResult = AggregateDataType({
+    "idMap": MapDataType(StringDataType, StringDataType),
+}, lambda result: Result.success(None))
+
+def executeCreateNodesCommand(cmd, repository: NodeRepository):
+    indexes = {node["tempId"]: index for (index, node) in enumerate(cmd["nodes"])}
+    links = [(indexes[parentTempId], index, "general") for (index, node) in enumerate(cmd["nodes"]) for parentTempId in node["parentTempIds"]]
+    parentLinks = [(parentId, index, "general") for (index, node) in enumerate(cmd["nodes"]) for parentId in node["parentIds"]]
+    nodes = repository.createMany([node["nodeData"] for node in cmd["nodes"]], links, parentLinks)
+    return {"idMap": {node["tempId"]: created["id"] for (node, created) in zip(cmd["nodes"], nodes)}}
+
+# Copies the nodes of the subtree with the given depth below the node `id`
+# and the links between them, and links the copy of `id` below `parentId`
+# (if given). Nodes that are reachable on several paths are copied once,
+# so the copy has the same shape as the original.
+# The subtree is collected like the result of a GetNodesCommand
+# and must not be truncated, i.e. contain more than 2000 nodes.
+CloneSubtreeCommand = AggregateDataType({
+    "id": StringDataType,
+    "depth": IntDataType,
+    "parentId": Nullable(StringDataType),
+}, lambda cmd: Result.ensure([
+    (cmd["depth"] >= 0, "The depth must be nonnegative"),
+    (cmd["depth"] <= 10, "The depth must be at most 10"),
+]))
+
+# `idMap` maps the IDs of the copied nodes to the IDs of their copies.
+CloneSubtreeResult = AggregateDataType({
+    "node": Node,
+    "idMap": MapDataType(StringDataType, StringDataType),
+}, lambda result: Result.success(None))
+
+def executeCloneSubtreeCommand(cmd, repository: NodeRepository):
+    with transaction.atomic():
+        subtree = executeGetNodesCommand(GetNodesCommand.create({"ids": [cmd["id"]], "depth": cmd["depth"]}), repository)
+        if cmd["id"] not in subtree["nodesById"]:
+            raise NodeNotFoundException()
+        if len(subtree["truncatedIds"]) > 0:
+            raise ValidationException("The subtree must not contain more than 2000 nodes.")
+
+        ids = list(subtree["nodesById"].keys())
+        indexes = {id: index for (index, id) in enumerate(ids)}
+        # the children of the nodes on the last level have not been fetched,
+        # so all links end in the subtree except for the ones going up
+        links = [
+            (indexes[link["sourceId"]], indexes[link["targetId"]], link["type"])
+            for children in subtree["childrenByParentId"].values()
+            for link in children
+            if link["targetId"] in indexes
+        ]
+        parentLinks = [(cmd["parentId"].extract(), indexes[cmd["id"]], "general")] if cmd["parentId"].hasValue() else []
+        copies = repository.createMany([subtree["nodesById"][id]["data"] for id in ids], links, parentLinks)
+
+    return {
+        "node": copies[indexes[cmd["id"]]],
+        "idMap": {id: copy["id"] for (id, copy) in zip(ids, copies)},
+    }
+
  # Either creates a new link or updates the type
  # of an existing one.
 LinkCommand = AggregateDataType({
@@ -90,8 +393,7 @@ LinkCommand = AggregateDataType({
 ]))
 
 def executeLinkCommand(cmd, repository: NodeRepository):
-    for link in cmd["links"]:
-        repository.link(link)
+    repository.linkMany(cmd["links"])
 
 UnlinkCommand = AggregateDataType({
     "links": ListDataType(LinkID),
@@ -100,8 +402,7 @@ UnlinkCommand = AggregateDataType({
 ]))
 
 def executeUnlinkCommand(cmd, repository: NodeRepository):
-    for linkID in cmd["links"]:
-        repository.unlink(linkID)
+    repository.unlinkMany(cmd["links"])
 
 MoveCommand = AggregateDataType({
     "oldLinks": ListDataType(LinkID),
@@ -111,15 +412,7 @@ MoveCommand = AggregateDataType({
 ]))
 
 def executeMoveCommand(cmd, repository: NodeRepository):
-    unlinkCmd = UnlinkCommand.create({
-        "links": ListDataType(LinkID).serialize(cmd["oldLinks"]),
-    })
-    linkCmd = LinkCommand.create({
-        "links": ListDataType(Link).serialize(cmd["newLinks"]),
-    })
-
-    executeUnlinkCommand(unlinkCmd, repository)
-    executeLinkCommand(linkCmd, repository)
+    repository.move(cmd["oldLinks"], cmd["newLinks"])
 
 UpdateNodeDataCommand = AggregateDataType({
     "id": StringDataType,
@@ -129,7 +422,10 @@ UpdateNodeDataCommand = AggregateDataType({
 
 def executeUpdateNodeDataCommand(cmd, repository: NodeRepository):
     # retrieve current node data
-    nodeData = repository.get([cmd["id"]])[cmd["id"]]["data"]
+    node = repository.get([cmd["id"]])[cmd["id"]]
+    if node is None:
+        raise NodeNotFoundException()
+    nodeData = node["data"]
 
     # change the fields that are to be changed
     if cmd["title"].hasValue():
@@ -140,4 +436,92 @@ def executeUpdateNodeDataCommand(cmd, repository: NodeRepository):
     # store the modified node data
     repository.update(cmd["id"], nodeData)
 
+# Executes several commands in the given order in a single transaction.
+# If one of them fails, none of them takes effect.
+# The nodes returned by all GetNodesCommands are collected in one Cache
+# (see BatchResult), so that nodes shared by several of them are sent once,
+# and subtrees already fetched by an earlier command are not fetched again
+# (see NodeRepository.forBatch).
+BatchCommand = AggregateDataType({
+    "commands": ListDataType(TaggedUnionDataType({
+        "getNodes": GetNodesCommand,
+        "createNode": CreateNodeCommand,
+        "createNodes": CreateNodesCommand,
+        "cloneSubtree": CloneSubtreeCommand,
+        "link": LinkCommand,
+        "unlink": UnlinkCommand,
+        "move": MoveCommand,
+        "updateNode": UpdateNodeDataCommand,
+    })),
+}, lambda data: Result.ensure([
+    (len(data["commands"]) <= 50, "The number of commands given must not be higher than 50."),
+]))
+
+# The result of a GetNodesCommand are the IDs of the nodes it returned
+# and of the nodes whose subtrees were truncated, and the cursors of
+# the children that were left out (see GetNodesResult),
+# the result of a CreateNodeCommand is the new node,
+# the result of a CreateNodesCommand is a CreateNodesResult,
+# the result of a CloneSubtreeCommand is a CloneSubtreeResult,
+# and the other commands do not return anything.
+BatchResult = AggregateDataType({
+    "results": ListDataType(TaggedUnionDataType({
+        "getNodes": AggregateDataType({
+            "nodeIds": ListDataType(StringDataType),
+            "truncatedIds": ListDataType(StringDataType),
+            "childCursors": MapDataType(StringDataType, StringDataType),
+        }, lambda result: Result.success(None)),
+        "createNode": Node,
+        "createNodes": CreateNodesResult,
+        "cloneSubtree": CloneSubtreeResult,
+        "link": NoneDataType,
+        "unlink": NoneDataType,
+        "move": NoneDataType,
+        "updateNode": NoneDataType,
+    })),
+    "cache": Cache,
+}, lambda result: Result.success(None))
+
+def executeBatchCommand(cmd, repository: NodeRepository):
+    batchRepository = repository.forBatch(10000)
+    cache = Cache.createEmpty()
+    results = []
+    # the nodes whose children have all been returned since the last write,
+    # which the first page of their children (see `maxChildren`) must not replace
+    completeIds = set()
+    with transaction.atomic():
+        for command in cmd["commands"]:
+            (type, value) = (command["type"], command["value"])
+            if type == "getNodes":
+                result = executeGetNodesCommand(value, batchRepository)
+                cache["nodesById"].update(result["nodesById"])
+                for (id, children) in result["childrenByParentId"].items():
+                    if id not in result["childCursors"]:
+                        completeIds.add(id)
+                    elif id in completeIds:
+                        continue
+                    cache["childrenByParentId"][id] = children
+                results.append({"type": type, "value": {
+                    "nodeIds": list(result["nodesById"].keys()),
+                    "truncatedIds": result["truncatedIds"],
+                    "childCursors": result["childCursors"],
+                }})
+            else:
+                results.append({"type": type, "value": batchCommandExecutors[type](value, batchRepository)})
+                completeIds = set()
+
+    return {
+        "results": results,
+        "cache": cache,
+    }
 
+# the commands of a batch besides GetNodesCommand
+batchCommandExecutors = {
+    "createNode": executeCreateNodeCommand,
+    "createNodes": executeCreateNodesCommand,
+    "cloneSubtree": executeCloneSubtreeCommand,
+    "link": executeLinkCommand,
+    "unlink": executeUnlinkCommand,
+    "move": executeMoveCommand,
+    "updateNode": executeUpdateNodeDataCommand,
+}
@@ -0,0 +1,210 @@
+import json
+import random
+import statistics
+import time
+
+import django
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from . import views
+from .models import Node as DBNode, Link as DBLink
+from .repositories import NodeRepository
+from .closure import rebuildClosure
+from .api import GetNodesCommand, LinkCommand, UnlinkCommand, MoveCommand, executeGetNodesCommand, executeLinkCommand, executeUnlinkCommand, executeMoveCommand
+from .domain.cache import Cache
+
+#
+# Benchmarks of the command pipeline on synthetic graphs.
+# Every graph is created inside a transaction that is rolled back
+# afterwards, so the benchmarks must run against a test database
+# (see the `benchmark` management command).
+#
+
+# Creates nodes and links with explicit IDs, which is much faster
+# than going through the repository. `node` returns the ID of the new node.
+class GraphBuilder:
+    def __init__(self):
+        self.nextId = (DBNode.objects.order_by("-id").values_list("id", flat=True).first() or 0) + 1
+        self.nodes = []
+        self.links = []
+
+    def node(self, title):
+        id = self.nextId
+        self.nextId += 1
+        self.nodes.append(DBNode(id=id, title=title, content="Content of " + title, node_type="general"))
+        return id
+
+    def link(self, sourceId, targetId, deleted=False):
+        self.links.append(DBLink(from_node_id=sourceId, to_node_id=targetId, type="general", deleted=deleted))
+
+    def save(self):
+        DBNode.objects.bulk_create(self.nodes, batch_size=500)
+        DBLink.objects.bulk_create(self.links, batch_size=500)
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [DBNode, DBLink]):
+                cursor.execute(sql)
+        rebuildClosure()
+
+# A root with `width` children.
+def buildWideGraph(builder, width):
+    root = builder.node("root")
+    for i in range(width):
+        builder.link(root, builder.node("child " + str(i)))
+    return root
+
+# A complete tree with the given depth and number of children per node.
+def buildDeepGraph(builder, depth, branching):
+    root = builder.node("root")
+    level = [root]
+    for d in range(depth):
+        nextLevel = []
+        for parent in level:
+            for i in range(branching):
+                child = builder.node("node " + str(d) + "." + str(len(nextLevel)))
+                builder.link(parent, child)
+                nextLevel.append(child)
+        level = nextLevel
+    return root
+
+# `depth` levels of `width` nodes, where every node has `parentCount`
+# randomly chosen parents on the level above.
+def buildDagGraph(builder, depth, width, parentCount):
+    randomness = random.Random(0)
+    root = builder.node("root")
+    level = [root]
+    for d in range(depth):
+        nextLevel = [builder.node("node " + str(d) + "." + str(i)) for i in range(width)]
+        for child in nextLevel:
+            for parent in randomness.sample(level, min(parentCount, len(level))):
+                builder.link(parent, child)
+        level = nextLevel
+    return root
+
+# A root with `width` children, of which all but every `liveEvery`-th link are deleted.
+def buildTombstonedGraph(builder, width, liveEvery):
+    root = builder.node("root")
+    for i in range(width):
+        builder.link(root, builder.node("child " + str(i)), deleted=(i % liveEvery != 0))
+    return root
+
+# Loads the nodes of a dump created by `dumpdata`
+# (like dump-2019-04-16.json) and links them by their `parents` field.
+def buildGraphFromDump(builder, path):
+    with open(path) as f:
+        objects = json.load(f)
+    offset = builder.nextId
+    nodes = [o for o in objects if o["model"] == "xtreembackend.node"]
+    for o in nodes:
+        builder.nodes.append(DBNode(id=offset + o["pk"], title=o["fields"]["title"], content=o["fields"]["content"], node_type=o["fields"]["node_type"]))
+        for parentId in o["fields"]["parents"]:
+            builder.link(offset + parentId, offset + o["pk"])
+    builder.nextId = offset + max(o["pk"] for o in nodes) + 1
+    parentIds = set(parentId for o in nodes for parentId in o["fields"]["parents"])
+    return offset + min(parentIds or [nodes[0]["pk"]])
+
+# Clears the process-wide caches of the views, so that
+# getNodes requests are answered from the database.
+# The tests use it as well, since the caches outlive the data of a TestCase,
+# and the IDs and the graph revision start over in every TestCase.
+def clearViewCaches():
+    if views.nodeRepository.graphCache is not None:
+        views.nodeRepository.graphCache.clear()
+    if views.responseCache is not None:
+        views.responseCache.clear()
+
+def measure(operation, repetitions, prepare=None):
+    durations = []
+    queryCounts = []
+    for _ in range(repetitions):
+        if prepare is not None:
+            prepare()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            operation()
+            durations.append((time.perf_counter() - start) * 1000)
+        queryCounts.append(len(queries))
+    return {
+        "repetitions": repetitions,
+        "meanMs": statistics.mean(durations),
+        "medianMs": statistics.median(durations),
+        "minMs": min(durations),
+        "queries": max(queryCounts),
+    }
+
+def benchmarkGraph(name, root, depth, repetitions):
+    repository = NodeRepository()
+    getCmd = GetNodesCommand.create({"ids": [str(root)], "depth": depth})
+    cache = executeGetNodesCommand(getCmd, repository)
+    nodeIds = sorted(cache["nodesById"].keys(), key=int)
+
+    # links from the last 100 nodes to a new node, which do not exist yet
+    # (links to the root would create cycles). The node is inserted like the
+    # ones of the GraphBuilder, since writing the graph revision in the transaction
+    # of the graph would lock it for reads on other connections (see AsyncNodeRepository).
+    sink = DBNode.objects.create(title="sink", content="", node_type="general")
+    newLinks = [{"sourceId": id, "targetId": str(sink.id), "type": "pro_arg"} for id in nodeIds[-100:]]
+    linkCmd = LinkCommand.create({"links": newLinks})
+    unlinkCmd = UnlinkCommand.create({"links": [{"sourceId": l["sourceId"], "targetId": l["targetId"]} for l in newLinks]})
+    moveCmd = MoveCommand.create({
+        "oldLinks": [{"sourceId": l["sourceId"], "targetId": l["targetId"]} for l in newLinks[:50]],
+        "newLinks": newLinks[50:],
+    })
+
+    client = Client()
+    rawCommand = json.dumps(GetNodesCommand.serialize(getCmd))
+
+    operations = [
+        ("getNodes", lambda: executeGetNodesCommand(getCmd, repository), None),
+        ("serializeCache", lambda: Cache.serialize(cache), None),
+        ("getNodesView", lambda: client.get("/api/nodes/get", {"command": rawCommand}), clearViewCaches),
+        ("getNodesViewCached", lambda: client.get("/api/nodes/get", {"command": rawCommand}), None),
+        ("link", lambda: executeLinkCommand(linkCmd, repository), lambda: executeUnlinkCommand(unlinkCmd, repository)),
+        ("unlink", lambda: executeUnlinkCommand(unlinkCmd, repository), lambda: executeLinkCommand(linkCmd, repository)),
+        ("move", lambda: executeMoveCommand(moveCmd, repository), lambda: executeLinkCommand(linkCmd, repository)),
+    ]
+
+    results = []
+    for (operation, run, prepare) in operations:
+        result = measure(run, repetitions, prepare)
+        result.update({
+            "graph": name,
+            "operation": operation,
+            "nodesReturned": len(cache["nodesById"]),
+        })
+        results.append(result)
+    return results
+
+# Runs all benchmarks and returns their results as a JSON-serializable dictionary.
+# `scale` multiplies the sizes of the synthetic graphs.
+def runBenchmarks(scale=1.0, repetitions=10, dumpPath=None, label=None):
+    graphs = [
+        ("wide", lambda builder: buildWideGraph(builder, int(2000 * scale)), 1),
+        ("deep", lambda builder: buildDeepGraph(builder, 10, 2), 10),
+        ("dag", lambda builder: buildDagGraph(builder, 10, max(1, int(200 * scale)), 3), 10),
+        ("tombstoned", lambda builder: buildTombstonedGraph(builder, int(8000 * scale), 4), 1),
+    ]
+    if dumpPath is not None:
+        graphs.append(("dump", lambda builder: buildGraphFromDump(builder, dumpPath), 10))
+
+    clearViewCaches()
+    results = []
+    for (name, build, depth) in graphs:
+        with transaction.atomic():
+            builder = GraphBuilder()
+            root = build(builder)
+            builder.save()
+            results.extend(benchmarkGraph(name, root, depth, repetitions))
+            transaction.set_rollback(True)
+        # the process-wide caches still contain the rolled back graph,
+        # and the IDs and the graph revision repeat in the next one
+        clearViewCaches()
+
+    return {
+        "label": label,
+        "django": django.get_version(),
+        "database": connection.vendor,
+        "results": results,
+    }
@@ -0,0 +1,157 @@
+from collections import defaultdict
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import Link as DBLink, Closure
+from .validation import ValidationException
+
+#
+# Maintains the closure table of the links that are not deleted:
+# for every pair of distinct nodes (ancestor, descendant) such that
+# the descendant can be reached from the ancestor, the table `Closure`
+# contains a row. Pairs of a node with itself are not stored.
+#
+# Creating links adds the pairs of their ancestors and descendants.
+# Deleting links can only disconnect pairs of an ancestor of a source
+# and a descendant of a target, so only the ancestors of these descendants
+# among these ancestors are computed again.
+# Both work for graphs with cycles, too, although
+# no links that close cycles can be created (see addToClosure).
+#
+# The number of queries of both does not depend on the number of links
+# (unless the number of affected nodes or changed rows exceeds the chunk size).
+# They must be called in the transaction that changes the links,
+# after the graph revision has been bumped (see NodeRepository._recordChanges):
+# the lock on the revision serializes concurrent updates of the closure.
+#
+
+class CycleException(ValidationException):
+    pass
+
+# Adds the pairs connected by the links `keys` (pairs of integers
+# (sourceId, targetId)), which have just been created or restored.
+# Raises a CycleException if one of the links would close a cycle,
+# i.e. if its source can be reached from its target, in which case
+# the transaction must be rolled back. The links are checked as a whole,
+# so links that only close a cycle together are rejected as well.
+def addToClosure(keys):
+    keys = list(keys)
+    if len(keys) == 0:
+        return
+    (ancestorsOf, descendantsOf) = loadAncestorsAndDescendants(keys)
+
+    # added one link after another, since each can connect the next ones
+    pairs = set()
+    for (sourceId, targetId) in keys:
+        if sourceId == targetId or sourceId in descendantsOf[targetId]:
+            raise CycleException("The link from %d to %d would create a cycle." % (sourceId, targetId))
+        ancestors = ancestorsOf[sourceId] | {sourceId}
+        descendants = descendantsOf[targetId] | {targetId}
+        for ancestorId in ancestors:
+            for descendantId in descendants:
+                if ancestorId == descendantId:
+                    continue
+                pairs.add((ancestorId, descendantId))
+                if descendantId in ancestorsOf:
+                    ancestorsOf[descendantId].add(ancestorId)
+                if ancestorId in descendantsOf:
+                    descendantsOf[ancestorId].add(descendantId)
+
+    Closure.objects.bulk_create(
+        [Closure(ancestor_id=ancestorId, descendant_id=descendantId) for (ancestorId, descendantId) in pairs],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+# Removes the pairs that are no longer connected after the links `keys`
+# (pairs of integers (sourceId, targetId)) have been deleted.
+def removeFromClosure(keys):
+    keys = list(keys)
+    if len(keys) == 0:
+        return
+    sourceIds = set(sourceId for (sourceId, _) in keys)
+    (ancestorsOf, descendantsOf) = loadAncestorsAndDescendants(keys)
+    # only pairs of these may have been disconnected
+    candidateIds = set().union(*[ancestors | {sourceId} for (sourceId, ancestors) in ancestorsOf.items()])
+    affectedIds = set().union(*[descendants | {targetId} for (targetId, descendants) in descendantsOf.items()])
+    # the same as `ancestor_id__in=candidateIds`, with a constant number of parameters
+    isCandidate = Q(ancestor_id__in=sourceIds) | Q(ancestor_id__in=Closure.objects.filter(descendant_id__in=sourceIds).values("ancestor_id"))
+
+    parentIdsOf = defaultdict(list)
+    childIdsOf = defaultdict(list)
+    for ids in chunked(affectedIds):
+        for (sourceId, targetId) in DBLink.objects.filter(to_node_id__in=ids, deleted=False).values_list("from_node_id", "to_node_id"):
+            parentIdsOf[targetId].append(sourceId)
+            childIdsOf[sourceId].append(targetId)
+
+    # maps nodes to their ancestors among the candidates,
+    # starting with the parents of the affected nodes that are not affected
+    candidateAncestorsOf = defaultdict(set)
+    for ids in chunked(set(childIdsOf) - affectedIds):
+        for (ancestorId, descendantId) in Closure.objects.filter(isCandidate, descendant_id__in=ids).values_list("ancestor_id", "descendant_id"):
+            candidateAncestorsOf[descendantId].add(ancestorId)
+
+    # The candidate ancestors of the affected nodes are the least solution of:
+    # the candidate ancestors of a node are its parents that are candidates
+    # and the candidate ancestors of its parents.
+    changedIds = list(affectedIds)
+    while len(changedIds) > 0:
+        id = changedIds.pop()
+        ancestors = set()
+        for parentId in parentIdsOf[id]:
+            ancestors |= candidateAncestorsOf[parentId]
+            if parentId in candidateIds:
+                ancestors.add(parentId)
+        ancestors.discard(id)
+        if not ancestors <= candidateAncestorsOf[id]:
+            candidateAncestorsOf[id] |= ancestors
+            changedIds.extend(childId for childId in childIdsOf[id] if childId in affectedIds)
+
+    disconnectedIds = []
+    for ids in chunked(affectedIds):
+        rows = Closure.objects.filter(isCandidate, descendant_id__in=ids).values_list("id", "ancestor_id", "descendant_id")
+        disconnectedIds += [id for (id, ancestorId, descendantId) in rows if ancestorId not in candidateAncestorsOf[descendantId]]
+    for ids in chunked(disconnectedIds):
+        Closure.objects.filter(id__in=ids).delete()
+
+# Splits `ids` into lists that can be passed as query parameters.
+def chunked(ids, size=10000):
+    ids = list(ids)
+    return [ids[start:start + size] for start in range(0, len(ids), size)]
+
+# Returns a pair (ancestorsOf, descendantsOf) of dictionaries that map
+# the sources of the given links to the sets of their ancestors
+# and the targets to the sets of their descendants.
+def loadAncestorsAndDescendants(keys):
+    ancestorsOf = {sourceId: set() for (sourceId, _) in keys}
+    descendantsOf = {targetId: set() for (_, targetId) in keys}
+    rows = Closure.objects \
+        .filter(Q(descendant_id__in=ancestorsOf.keys()) | Q(ancestor_id__in=descendantsOf.keys())) \
+        .values_list("ancestor_id", "descendant_id")
+    for (ancestorId, descendantId) in rows:
+        if descendantId in ancestorsOf:
+            ancestorsOf[descendantId].add(ancestorId)
+        if ancestorId in descendantsOf:
+            descendantsOf[ancestorId].add(descendantId)
+    return (ancestorsOf, descendantsOf)
+
+# Replaces the closure table by the closure of all links that are not deleted,
+# e.g. after links have been written without going through the NodeRepository.
+# The closure is computed and inserted by the database with a single recursive
+# query, so no pairs are kept in memory here. UNION (instead of UNION ALL) drops
+# the pairs that were reached before, which ends the recursion on cycles as well.
+def rebuildClosure(linkModel=DBLink, closureModel=Closure):
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM {closure}".format(closure=closureModel._meta.db_table))
+        cursor.execute("""
+            INSERT INTO {closure} (ancestor_id, descendant_id)
+            WITH RECURSIVE reach(ancestor_id, descendant_id) AS (
+                SELECT from_node_id, to_node_id FROM {link} WHERE NOT deleted
+                UNION
+                SELECT r.ancestor_id, l.to_node_id
+                FROM reach r JOIN {link} l ON l.from_node_id = r.descendant_id
+                WHERE NOT l.deleted
+            )
+            SELECT ancestor_id, descendant_id FROM reach WHERE ancestor_id <> descendant_id
+        """.format(closure=closureModel._meta.db_table, link=linkModel._meta.db_table))
@@ -0,0 +1,88 @@
+import gzip
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#
+# Compression of API responses, and a cache of encoded (and compressed)
+# response bodies, so that repeated reads of the same data
+# skip the traversal, the serialization and the compression.
+#
+
+# Smaller bodies are not worth compressing.
+MIN_COMPRESSED_SIZE = 1024
+
+# Returns the content encoding the client prefers among the supported ones
+# ("br" if the brotli package is installed, and "gzip"), or None.
+def chooseContentEncoding(request):
+    accepted = {}
+    for entry in request.headers.get("Accept-Encoding", "").split(","):
+        parts = [part.strip() for part in entry.split(";")]
+        quality = 1.0
+        for parameter in parts[1:]:
+            if parameter.startswith("q="):
+                try:
+                    quality = float(parameter[2:])
+                except ValueError:
+                    quality = 0.0
+        if parts[0] != "":
+            accepted[parts[0].lower()] = quality
+
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    candidates = [c for c in candidates if accepted.get(c, accepted.get("*", 0.0)) > 0]
+    if len(candidates) == 0:
+        return None
+    # on equal quality, the order of `candidates` decides
+    return max(candidates, key=lambda c: accepted.get(c, accepted.get("*", 0.0)))
+
+# Returns the pair (body, contentEncoding), where `contentEncoding`
+# is None if the body was not compressed.
+def compress(body, contentEncoding):
+    if contentEncoding is None or len(body) < MIN_COMPRESSED_SIZE:
+        return (body, None)
+    if contentEncoding == "br":
+        # higher qualities are much slower while compressing only slightly better
+        return (brotli.compress(body, quality=5), "br")
+    return (gzip.compress(body, compresslevel=6), "gzip")
+
+# A bounded, process-wide cache of response bodies, which evicts entries
+# in least-recently-used order as soon as their total size (in bytes)
+# exceeds `maxSize`. The keys must identify the data of the response,
+# e.g. by including the graph revision, since the cache is never invalidated.
+class ResponseCache:
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    # `value` is a pair (body, contentEncoding).
+    def store(self, key, value):
+        size = len(value[0])
+        if size > self.maxSize:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous[0])
+            self._entries[key] = value
+            self._size += size
+            while self._size > self.maxSize:
+                (_, (body, _)) = self._entries.popitem(last=False)
+                self._size -= len(body)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
@@ -16,10 +16,7 @@ class Result:
 
     @staticmethod
     def ensure(requirements):
-        def processRequirement(r):
-            (cond, error) = r
-            return None if cond else error
-        errors = [x for x in map(processRequirement, requirements) if x is not None]
+        errors = [error for (cond, error) in requirements if not cond]
         if len(errors) == 0:
             return Result.success(None)
         else:
@@ -60,6 +57,42 @@ class Maybe:
     def extract(self):
         return self._value
 
+# ======
+# Compilation of data types
+#
+# `create` and `serialize` walk the specification of a data type
+# each time they are called. To avoid this overhead, every data type
+# can be compiled into a pair of closures (a parser and a serializer)
+# that are specialized for the data type. The closures must behave exactly
+# like `create` and `serialize`, including the errors they throw.
+# Composite data types compile themselves lazily on their first use.
+# ======
+
+def compileParser(dataType):
+    if hasattr(dataType, "compileParser"):
+        return dataType.compileParser()
+    else:
+        return dataType.create
+
+# Returns the pair (Python type, error message) if `create` of the data type
+# only checks whether the data is an instance of this Python type, otherwise None.
+def primitiveCheckOf(dataType):
+    if dataType is IntDataType:
+        return (int, "should be an integer")
+    elif dataType is StringDataType:
+        return (str, "should be a string")
+    elif dataType is BoolDataType:
+        return (bool, "should be a boolean")
+    else:
+        return None
+
+# Returns None if the data type serializes every value to itself.
+def compileSerializer(dataType):
+    if hasattr(dataType, "compileSerializer"):
+        return dataType.compileSerializer()
+    else:
+        return dataType.serialize
+
 # ======
 # Here come the data types
 # ======
@@ -67,27 +100,72 @@ class Maybe:
 class Nullable:
     def __init__(self, innerType):
         self.innerType = innerType
+        self._parser = None
+        self._serializer = None
 
     def equals(self, otherType):
         return isinstance(otherType, Nullable) and self.innerType.equals(otherType.innerType)
 
     def serialize(self, data):
-        if not data.hasValue():
-            return None
-        else:
-            return self.innerType.serialize(data.extract())
+        if self._serializer is None:
+            self._serializer = self.compileSerializer()
+        return self._serializer(data)
 
     def create(self, data):
-        if data is None:
-            return Maybe.nothing()
-        else:
-            innerObject = self.innerType.create(data)
-            return Maybe.value(innerObject)
+        if self._parser is None:
+            self._parser = self.compileParser()
+        return self._parser(data)
+
+    def compileSerializer(self):
+        serializeInner = compileSerializer(self.innerType)
+
+        def serialize(data):
+            if not data.hasValue():
+                return None
+            elif serializeInner is None:
+                return data.extract()
+            else:
+                return serializeInner(data.extract())
+        return serialize
+
+    def compileParser(self):
+        parseInner = compileParser(self.innerType)
+
+        def parse(data):
+            if data is None:
+                return Maybe.nothing()
+            else:
+                return Maybe.value(parseInner(data))
+        return parse
+
+# Can only be used for fields of an AggregateDataType.
+# If the field is missing, it takes the value `default`.
+class WithDefault:
+    def __init__(self, innerType, default):
+        self.innerType = innerType
+        self.default = default
+
+    def equals(self, otherType):
+        return isinstance(otherType, WithDefault) and self.innerType.equals(otherType.innerType) and self.default == otherType.default
+
+    def serialize(self, data):
+        return self.innerType.serialize(data)
+
+    def create(self, data):
+        return self.innerType.create(data)
+
+    def compileSerializer(self):
+        return compileSerializer(self.innerType)
+
+    def compileParser(self):
+        return compileParser(self.innerType)
 
 class AggregateDataType:
     def __init__(self, schema, consistencyCheck):
         self.schema = schema
         self.consistencyCheck = consistencyCheck
+        self._parser = None
+        self._serializer = None
 
     def getSchema(self):
         return self.schema
@@ -96,54 +174,89 @@ class AggregateDataType:
         return self == otherType
 
     def serialize(self, fields):
-        data = {}
-        for (field, fieldType) in self.getSchema().items():
-            data[field] = fieldType.serialize(fields[field])
-
-        return data
+        if self._serializer is None:
+            self._serializer = self.compileSerializer()
+        return self._serializer(fields)
 
     # might throw a ValidationException
     def create(self, data):
-        self.checkPrerequisites(data)
-        fields = self.parseFields(data)
-
-        result = self.consistencyCheck(fields)
-        if not result.isOk():
-            raise ValidationException({
-                "message": "AggregateDataType: consistency check failed",
-                "innerErrors": result.extract(),
-            })
-
-        return fields
-
-    def checkPrerequisites(self, data):
-        if not isinstance(data, dict):
-            raise ValidationException("AggregateDataType: data must be a dictionary")
+        if self._parser is None:
+            self._parser = self.compileParser()
+        return self._parser(data)
+
+    # Returns `data` without validating it. Only use this for data
+    # that is known to satisfy the specification because this server
+    # produced it itself, e.g. rows read from the database.
+    def createTrusted(self, data):
+        return data
 
-        for (field, fieldType) in self.schema.items():
-            if field not in data:
-                raise ValidationException("AggregateDataType: field " + field + " is missing")
+    def compileSerializer(self):
+        fieldSerializers = [(field, compileSerializer(fieldType)) for (field, fieldType) in self.schema.items()]
+        if all(serializeField is None for (_, serializeField) in fieldSerializers):
+            fieldNames = [field for (field, _) in fieldSerializers]
+            return lambda fields: {field: fields[field] for field in fieldNames}
 
-    def parseFields(self, data):
-        fields = {}
-        errors = {}
-        errorsOccured = False
+        def serialize(fields):
+            data = {}
+            for (field, serializeField) in fieldSerializers:
+                data[field] = fields[field] if serializeField is None else serializeField(fields[field])
+            return data
+        return serialize
+
+    def compileParser(self):
+        # Fields of primitive types are checked inline instead of calling their parsers.
+        fieldParsers = [
+            (field, isinstance(fieldType, WithDefault)) + (primitiveCheckOf(fieldType) or (None, None)) + (compileParser(fieldType),)
+            for (field, fieldType) in self.schema.items()
+        ]
+        defaults = {field: fieldType.default for (field, fieldType) in self.schema.items() if isinstance(fieldType, WithDefault)}
+        consistencyCheck = self.consistencyCheck
+
+        def parse(data):
+            if not isinstance(data, dict):
+                raise ValidationException("AggregateDataType: data must be a dictionary")
+
+            # A missing field is reported even if other fields could not be parsed,
+            # so errors are only collected while walking through the fields.
+            fields = {}
+            errors = None
+            for (field, hasDefault, pythonType, message, parseField) in fieldParsers:
+                if field not in data:
+                    if hasDefault:
+                        fields[field] = defaults[field]
+                        continue
+                    raise ValidationException("AggregateDataType: field " + field + " is missing")
+                value = data[field]
+                if pythonType is not None:
+                    if isinstance(value, pythonType):
+                        fields[field] = value
+                        continue
+                    error = ValidationException(message)
+                else:
+                    try:
+                        fields[field] = parseField(value)
+                        continue
+                    except ValidationException as e:
+                        error = e
+                if errors is None:
+                    errors = {}
+                errors[field] = error
+
+            if errors is not None:
+                raise ValidationException({
+                    "message": "AggregateDataType: could not parse fields",
+                    "innerErrors": errors
+                })
 
-        for (field, fieldType) in self.schema.items():
-            try:
-                fields[field] = fieldType.create(data[field])
-            except ValidationException as e:
-                errorsOccured = True
-                errors[field] = e
+            result = consistencyCheck(fields)
+            if not result.isOk():
+                raise ValidationException({
+                    "message": "AggregateDataType: consistency check failed",
+                    "innerErrors": result.extract(),
+                })
 
-        if errorsOccured:
-            errorObject = {
-                "message": "AggregateDataType: could not parse fields",
-                "innerErrors": errors
-            }
-            raise ValidationException(errorObject)
-        else:
             return fields
+        return parse
 
 class IntDataType:
     @staticmethod
@@ -161,6 +274,38 @@ class IntDataType:
         else:
             raise ValidationException("should be an integer")
 
+    @staticmethod
+    def compileSerializer():
+        return None
+
+    @staticmethod
+    def compileParser():
+        return IntDataType.create
+
+class BoolDataType:
+    @staticmethod
+    def equals(otherType):
+        return otherType == BoolDataType
+
+    @staticmethod
+    def serialize(value):
+        return value
+
+    @staticmethod
+    def create(data):
+        if isinstance(data, bool):
+            return data
+        else:
+            raise ValidationException("should be a boolean")
+
+    @staticmethod
+    def compileSerializer():
+        return None
+
+    @staticmethod
+    def compileParser():
+        return BoolDataType.create
+
 class StringDataType:
     @staticmethod
     def equals(otherType):
@@ -177,32 +322,84 @@ class StringDataType:
         else:
             raise ValidationException("should be a string")
 
+    @staticmethod
+    def compileSerializer():
+        return None
+
+    @staticmethod
+    def compileParser():
+        return StringDataType.create
+
+# The type of the single value None, e.g. for results of commands that return nothing.
+class NoneDataType:
+    @staticmethod
+    def equals(otherType):
+        return otherType == NoneDataType
+
+    @staticmethod
+    def serialize(value):
+        return value
+
+    @staticmethod
+    def create(data):
+        if data is None:
+            return data
+        else:
+            raise ValidationException("should be null")
+
+    @staticmethod
+    def compileSerializer():
+        return None
+
+    @staticmethod
+    def compileParser():
+        return NoneDataType.create
+
 class ListDataType:
     def __init__(self, innerType):
         self.innerType = innerType
+        self._parser = None
+        self._serializer = None
 
     def equals(self, otherType):
         return isinstance(otherType, ListDataType) and self.innerType.equals(otherType.innerType)
 
     def serialize(self, items):
-        return list(map(lambda item: self.innerType.serialize(item), items))
+        if self._serializer is None:
+            self._serializer = self.compileSerializer()
+        return self._serializer(items)
 
     def create(self, data):
-        if isinstance(data, list):
-            try:
-                return list(map(lambda inner: self.innerType.create(inner), data))
-            except ValidationException as e:
-                # This implementation only reports the first error while parsing the list.
-                # It would be possible to write a more sophisticated method that
-                # reports errors for all items.
+        if self._parser is None:
+            self._parser = self.compileParser()
+        return self._parser(data)
+
+    def compileSerializer(self):
+        serializeItem = compileSerializer(self.innerType)
+        if serializeItem is None:
+            return list
+        return lambda items: [serializeItem(item) for item in items]
+
+    def compileParser(self):
+        parseItem = compileParser(self.innerType)
+
+        def parse(data):
+            if isinstance(data, list):
+                try:
+                    return [parseItem(item) for item in data]
+                except ValidationException as e:
+                    # This implementation only reports the first error while parsing the list.
+                    # It would be possible to write a more sophisticated method that
+                    # reports errors for all items.
+                    raise ValidationException({
+                        "message": "ListDataType: could not parse items",
+                        "innerErrors": e,
+                    })
+            else:
                 raise ValidationException({
-                    "message": "ListDataType: could not parse items",
-                    "innerErrors": e,
+                    "message": "ListDataType: should be a list"
                 })
-        else:
-            raise ValidationException({
-                "message": "ListDataType: should be a list"
-            })
+        return parse
 
 class EnumDataType:
     def __init__(self, options):
@@ -220,12 +417,32 @@ class EnumDataType:
         else:
             raise ValidationException("EnumDataType: invalid value")
 
+    def compileSerializer(self):
+        return None
+
+    def compileParser(self):
+        optionSet = frozenset(self.options)
+
+        def parse(data):
+            try:
+                isOption = data in optionSet
+            except TypeError:
+                # unhashable values are never options
+                isOption = False
+            if isOption:
+                return data
+            else:
+                raise ValidationException("EnumDataType: invalid value")
+        return parse
+
 class MapDataType:
     def __init__(self, keyType, valueType):
         if keyType not in [IntDataType, StringDataType]:
             raise Exception("illegal key type")
         self.keyType = keyType
         self.valueType = valueType
+        self._parser = None
+        self._serializer = None
 
     def equals(self, otherType):
         return isinstance(otherType, MapDataType) and \
@@ -233,30 +450,100 @@ class MapDataType:
             self.valueType.equals(otherType.valueType)
 
     def serialize(self, data):
-        serialized = {}
-        for (key, value) in data.items():
-            serialized[self.keyType.serialize(key)] = self.valueType.serialize(value)
-        return serialized
+        if self._serializer is None:
+            self._serializer = self.compileSerializer()
+        return self._serializer(data)
 
     def create(self, data):
-        if isinstance(data, dict):
-            obj = {}
-            for (key, value) in data.items():
-                try:
-                    keyResult = self.keyType.create(key)
-                except ValidationException as e:
-                    raise ValidationException({
-                        "message": "MapDataType: could not parse key " + key,
-                        "innerErrors": e
-                    })
-                try:
-                    valueResult = self.valueType.create(value)
-                except ValidationException as e:
-                    raise ValidationException({
-                        "message": "MapDataType: could not parse value for " + key,
-                        "innerErrors": e
-                    })
-                
-                obj[keyResult] = valueResult
-            return obj
-        raise ValidationException("should be a dictionary")
+        if self._parser is None:
+            self._parser = self.compileParser()
+        return self._parser(data)
+
+    def compileSerializer(self):
+        # both possible key types serialize keys to themselves
+        serializeValue = compileSerializer(self.valueType)
+        if serializeValue is None:
+            return dict
+        return lambda data: {key: serializeValue(value) for (key, value) in data.items()}
+
+    def compileParser(self):
+        parseKey = compileParser(self.keyType)
+        parseValue = compileParser(self.valueType)
+
+        def parse(data):
+            if isinstance(data, dict):
+                obj = {}
+                for (key, value) in data.items():
+                    try:
+                        keyResult = parseKey(key)
+                    except ValidationException as e:
+                        raise ValidationException({
+                            "message": "MapDataType: could not parse key " + key,
+                            "innerErrors": e
+                        })
+                    try:
+                        valueResult = parseValue(value)
+                    except ValidationException as e:
+                        raise ValidationException({
+                            "message": "MapDataType: could not parse value for " + key,
+                            "innerErrors": e
+                        })
+
+                    obj[keyResult] = valueResult
+                return obj
+            raise ValidationException("should be a dictionary")
+        return parse
+
+# A value of one of several data types, which is represented as
+# {"type": tag, "value": value}, where `typesByTag` maps the tag
+# to the data type of the value.
+class TaggedUnionDataType:
+    def __init__(self, typesByTag):
+        self.typesByTag = typesByTag
+        self._parser = None
+        self._serializer = None
+
+    def equals(self, otherType):
+        return isinstance(otherType, TaggedUnionDataType) and \
+            self.typesByTag.keys() == otherType.typesByTag.keys() and \
+            all(valueType.equals(otherType.typesByTag[tag]) for (tag, valueType) in self.typesByTag.items())
+
+    def serialize(self, data):
+        if self._serializer is None:
+            self._serializer = self.compileSerializer()
+        return self._serializer(data)
+
+    def create(self, data):
+        if self._parser is None:
+            self._parser = self.compileParser()
+        return self._parser(data)
+
+    def compileSerializer(self):
+        valueSerializers = {tag: compileSerializer(valueType) for (tag, valueType) in self.typesByTag.items()}
+
+        def serialize(data):
+            serializeValue = valueSerializers[data["type"]]
+            return {
+                "type": data["type"],
+                "value": data["value"] if serializeValue is None else serializeValue(data["value"]),
+            }
+        return serialize
+
+    def compileParser(self):
+        valueParsers = {tag: compileParser(valueType) for (tag, valueType) in self.typesByTag.items()}
+
+        def parse(data):
+            if not isinstance(data, dict) or "type" not in data or "value" not in data:
+                raise ValidationException("TaggedUnionDataType: should be a dictionary with the fields type and value")
+            tag = data["type"]
+            parseValue = valueParsers.get(tag) if isinstance(tag, str) else None
+            if parseValue is None:
+                raise ValidationException("TaggedUnionDataType: invalid type")
+            try:
+                return {"type": tag, "value": parseValue(data["value"])}
+            except ValidationException as e:
+                raise ValidationException({
+                    "message": "TaggedUnionDataType: could not parse value of type " + tag,
+                    "innerErrors": e,
+                })
+        return parse
@@ -0,0 +1,96 @@
+import asyncio
+import json
+
+from django.http import QueryDict
+
+from . import views
+from .api import SubscribeCommand, GetChangesSinceCommand, ChangesResult, executeGetChangesSinceCommandAsync
+from .validation import Guard, ValidationException
+
+#
+# Pushes the changes below some nodes to the client as Server-Sent Events.
+#
+# This is a plain ASGI application (mounted by xtreem/asgi.py at EVENTS_PATH)
+# instead of a Django view, because a view cannot wait for changes
+# without blocking a thread for every connected client.
+#
+# The client passes a SubscribeCommand in the `command` query parameter,
+# just like for the other API endpoints. Whenever the ChangeHub of
+# `views.nodeRepository` publishes a change, the changes after the
+# current cursor are read with a GetChangesSinceCommand for the subscribed
+# subtree and, unless they are empty (and not a reset), sent as a `changes`
+# event containing a ChangesResult. The `id` of each event is the cursor after it.
+# Since the ChangeHub only sees the writes of this process, the change log
+# is polled as well with every keepalive.
+#
+
+EVENTS_PATH = "/api/nodes/events"
+
+# Seconds after which a comment is sent if nothing happened,
+# so that proxies do not close the connection.
+KEEPALIVE_INTERVAL = 15
+
+async def eventsApplication(scope, receive, send):
+    try:
+        command = SubscribeCommand.create(json.loads(Guard.access(QueryDict(scope["query_string"]), "command")))
+    except (ValidationException, ValueError):
+        await send({"type": "http.response.start", "status": 400, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    repository = views.asyncNodeRepository.outsideRequests()
+    changeHub = repository.repository.changeHub
+    subscription = changeHub.subscribe()
+    try:
+        if command["cursor"].hasValue():
+            cursor = command["cursor"].extract()
+            subscription.notify()
+        else:
+            cursor = await repository.getLastChangeNumber()
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"access-control-allow-origin", b"*"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": b": subscribed\n\n", "more_body": True})
+
+        disconnected = asyncio.ensure_future(waitForDisconnect(receive))
+        try:
+            while True:
+                changed = asyncio.ensure_future(subscription.wait())
+                await asyncio.wait([changed, disconnected], timeout=KEEPALIVE_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    changed.cancel()
+                    return
+                if not changed.done():
+                    changed.cancel()
+                    await send({"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True})
+                    # picks up the writes of other processes
+                    if await repository.getLastChangeNumber() <= cursor:
+                        continue
+
+                hasMore = True
+                while hasMore:
+                    result = await executeGetChangesSinceCommandAsync(GetChangesSinceCommand.create({
+                        "cursor": cursor,
+                        "subtree": {"ids": command["ids"], "depth": command["depth"]},
+                    }), repository)
+                    (cursor, hasMore) = (result["cursor"], result["hasMore"])
+                    if result["reset"] or len(result["changes"]["nodesById"]) > 0 or len(result["changes"]["childrenByParentId"]) > 0:
+                        await send({"type": "http.response.body", "body": encodeEvent("changes", cursor, ChangesResult.serialize(result)), "more_body": True})
+        finally:
+            disconnected.cancel()
+    finally:
+        changeHub.unsubscribe(subscription)
+
+async def waitForDisconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+def encodeEvent(name, id, data):
+    return ("event: %s\nid: %d\ndata: %s\n\n" % (name, id, json.dumps(data))).encode("utf-8")
@@ -0,0 +1,137 @@
+import threading
+from collections import OrderedDict
+
+#
+# A bounded, process-wide cache of nodes and of the (non-deleted)
+# children of nodes, used by the NodeRepository to answer reads
+# without touching the database.
+#
+# Entries are evicted in least-recently-used order as soon as
+# the total size exceeds `maxSize`. A node counts as one unit,
+# a list of children counts as the number of links it contains
+# (but at least one unit).
+#
+# The cache only knows about writes that are issued through
+# a NodeRepository of the same process. Writes of other processes
+# are noticed through the graph revision: whenever a request reads
+# a different revision than the one the cache was filled at, the entries
+# of the changes logged since then are dropped (see NodeRepository.validateCache).
+#
+class GraphCache:
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self._entries = OrderedDict()
+        self._size = 0
+        self._generation = 0
+        self._revision = None
+        self._changeNumber = None
+        self._lock = threading.Lock()
+
+    # All getters and store methods copy the mutable parts of the data,
+    # so that callers cannot modify the cached objects by accident.
+    #
+    # Every invalidation bumps the generation. Readers remember the
+    # generation before querying the database and pass it to the store
+    # methods, so that data which might have been read before a concurrent
+    # write was committed is never stored.
+    def generation(self):
+        return self._generation
+
+    def getNode(self, id):
+        node = self._get(("node", id))
+        return copyNode(node) if node is not None else None
+
+    def getChildren(self, id):
+        children = self._get(("children", id))
+        if children is None:
+            return None
+        return list(children)
+
+    def storeNodes(self, nodes, generation):
+        self._store([(("node", node["id"]), copyNode(node), 1) for node in nodes], generation)
+
+    def storeChildren(self, childrenByParentId, generation):
+        self._store([
+            (("children", id), list(children), max(1, len(children)))
+            for (id, children) in childrenByParentId.items()
+        ], generation)
+
+    def invalidateNode(self, id):
+        self._invalidate(("node", id))
+
+    def invalidateChildren(self, id):
+        self._invalidate(("children", id))
+
+    # Returns the pair (revision, changeNumber) of the graph revision
+    # and the sequence number of the last change the cache knows about,
+    # or (None, None) if it does not know them.
+    def revision(self):
+        with self._lock:
+            return (self._revision, self._changeNumber)
+
+    # Drops the entries of the given nodes and of the children of `childrenOfIds`,
+    # which were changed up to the change `changeNumber` and the revision `revision`.
+    def applyChanges(self, revision, changeNumber, nodeIds, childrenOfIds):
+        with self._lock:
+            self._generation += 1
+            for id in nodeIds:
+                self._remove(("node", id))
+            for id in childrenOfIds:
+                self._remove(("children", id))
+            self._revision = revision
+            self._changeNumber = max(changeNumber, self._changeNumber or 0)
+
+    # Drops all entries; they are filled at the given revision from now on.
+    def reset(self, revision, changeNumber):
+        with self._lock:
+            self._clear()
+            self._revision = revision
+            self._changeNumber = changeNumber
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+            self._revision = None
+            self._changeNumber = None
+        self._changeNumber = None
+
+    def _clear(self):
+        self._generation += 1
+        self._entries.clear()
+        self._size = 0
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def _store(self, items, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            for (key, value, size) in items:
+                self._remove(key)
+                self._entries[key] = (value, size)
+                self._size += size
+            while self._size > self.maxSize and len(self._entries) > 0:
+                (_, (_, size)) = self._entries.popitem(last=False)
+                self._size -= size
+
+    def _invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+def copyNode(node):
+    return {
+        "id": node["id"],
+        "data": dict(node["data"]),
+    }
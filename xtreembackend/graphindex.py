@@ -0,0 +1,167 @@
+import threading
+from array import array
+
+from .models import Link as DBLink, GraphRevision, Change
+from .domain.objects import LinkType
+
+#
+# A compact in-memory index of all links that are not deleted,
+# which lets the NodeRepository compute the nodes reachable from
+# some roots without querying the database.
+#
+# The links are stored in compressed sparse row format:
+# the children of the node with the (integer) ID `id` are
+# `targets[offsets[id]:offsets[id + 1]]`, and the types of the
+# corresponding links are `types[offsets[id]:offsets[id + 1]]`,
+# encoded as indices into `LinkType.options`.
+#
+# Since these arrays cannot be changed cheaply, writes are recorded
+# in an overlay that maps a node ID to the complete children of that node.
+# Rows of the overlay are never modified but replaced, so that readers
+# do not need to acquire the lock. As soon as the overlay becomes too large,
+# it is merged into new arrays.
+#
+# The index is loaded from the database on first use and learns about writes
+# that are committed through a NodeRepository of the same process. The writes
+# of other processes are applied when a request reads a different graph revision
+# than the one the index is at (see NodeRepository.validateCache).
+#
+class GraphIndex:
+    def __init__(self, maxOverlaySize=10000):
+        self.maxOverlaySize = maxOverlaySize
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._rows = (array("q", [0]), array("q"), array("b"))
+        self._overlay = {}
+        self._revision = None
+        self._changeNumber = None
+
+    def ensureLoaded(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._load()
+                    self._loaded = True
+
+    # Returns the pair (revision, changeNumber) of the graph revision
+    # and the sequence number of the last change the index knows about,
+    # or (None, None) if it is not loaded.
+    def revision(self):
+        with self._lock:
+            return (self._revision, self._changeNumber)
+
+    # `childrenByParentId` maps (integer) node IDs to all their children, as lists
+    # of pairs (targetId, type), which have been read from the database after the
+    # change `changeNumber` and the revision `revision` were committed.
+    def applyChanges(self, revision, changeNumber, childrenByParentId):
+        with self._lock:
+            if not self._loaded:
+                return
+            typeCodes = {type: code for (code, type) in enumerate(LinkType.options)}
+            for (id, children) in childrenByParentId.items():
+                self._overlay[id] = {targetId: typeCodes[type] for (targetId, type) in children}
+            self._revision = revision
+            self._changeNumber = max(changeNumber, self._changeNumber)
+            self._compactIfNecessary()
+
+    # Makes the index load all links again on its next use. Until then,
+    # readers that have already called `ensureLoaded` keep using the old links.
+    def unload(self):
+        with self._lock:
+            self._loaded = False
+            self._revision = None
+            self._changeNumber = None
+
+    # Returns the IDs of the children of the node with the given (integer) ID.
+    def getChildIds(self, id):
+        row = self._overlay.get(id)
+        if row is not None:
+            return list(row.keys())
+        (offsets, targets, _) = self._rows
+        if id + 1 >= len(offsets):
+            return []
+        return targets[offsets[id]:offsets[id + 1]].tolist()
+
+    # Returns the children of the node with the given (integer) ID
+    # as a list of links.
+    def getChildren(self, id):
+        return [
+            {
+                "sourceId": str(id),
+                "targetId": str(targetId),
+                "type": LinkType.options[typeCode],
+            }
+            for (targetId, typeCode) in self._getRow(id).items()
+        ]
+
+    # `typesByKey` maps pairs of integers (sourceId, targetId) to link types.
+    def storeLinks(self, typesByKey):
+        with self._lock:
+            if not self._loaded:
+                return
+            for ((sourceId, targetId), type) in typesByKey.items():
+                row = dict(self._getRow(sourceId))
+                row[targetId] = LinkType.options.index(type)
+                self._overlay[sourceId] = row
+            self._compactIfNecessary()
+
+    # `keys` are pairs of integers (sourceId, targetId).
+    def removeLinks(self, keys):
+        with self._lock:
+            if not self._loaded:
+                return
+            for (sourceId, targetId) in keys:
+                row = dict(self._getRow(sourceId))
+                if row.pop(targetId, None) is not None:
+                    self._overlay[sourceId] = row
+            self._compactIfNecessary()
+
+    # Returns the children of a node as a dictionary mapping
+    # the target IDs to the type codes.
+    def _getRow(self, id):
+        row = self._overlay.get(id)
+        if row is not None:
+            return row
+        (offsets, targets, types) = self._rows
+        if id + 1 >= len(offsets):
+            return {}
+        (start, end) = (offsets[id], offsets[id + 1])
+        return dict(zip(targets[start:end], types[start:end]))
+
+    def _load(self):
+        # read first, so that the changes committed during the load are applied again
+        self._revision = GraphRevision.current()
+        self._changeNumber = Change.objects.order_by("-id").values_list("id", flat=True).first() or 0
+        typeCodes = {type: code for (code, type) in enumerate(LinkType.options)}
+        rows = DBLink.objects \
+            .filter(deleted=False) \
+            .order_by("from_node_id", "id") \
+            .values_list("from_node_id", "to_node_id", "type") \
+            .iterator(chunk_size=10000)
+        self._build((sourceId, targetId, typeCodes[type]) for (sourceId, targetId, type) in rows)
+
+    def _compactIfNecessary(self):
+        if len(self._overlay) <= self.maxOverlaySize:
+            return
+
+        (offsets, targets, types) = self._rows
+        def links():
+            for id in range(max(len(offsets) - 1, max(self._overlay.keys()) + 1)):
+                for (targetId, typeCode) in self._getRow(id).items():
+                    yield (id, targetId, typeCode)
+        self._build(links())
+
+    # `links` must be sorted by their source IDs.
+    def _build(self, links):
+        offsets = array("q")
+        targets = array("q")
+        types = array("b")
+        for (sourceId, targetId, typeCode) in links:
+            while len(offsets) <= sourceId:
+                offsets.append(len(targets))
+            targets.append(targetId)
+            types.append(typeCode)
+        offsets.append(len(targets))
+
+        self._rows = (offsets, targets, types)
+        self._overlay = {}
@@ -0,0 +1,37 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from xtreembackend.benchmarks import runBenchmarks
+
+class Command(BaseCommand):
+    help = "Runs the benchmarks of the command pipeline against a fresh test database and prints the results as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scale", type=float, default=1.0, help="Multiplies the sizes of the synthetic graphs.")
+        parser.add_argument("--repetitions", type=int, default=10)
+        parser.add_argument("--label", default=None, help="Stored in the results, e.g. the commit that was measured.")
+        parser.add_argument("--output", default=None, help="Writes the results to this file instead of stdout.")
+        parser.add_argument("--no-dump", action="store_true", help="Skips the graph from dump-2019-04-16.json.")
+
+    def handle(self, *args, **options):
+        dumpPath = None if options["no_dump"] else os.path.join(settings.BASE_DIR, "dump-2019-04-16.json")
+
+        setup_test_environment()
+        oldName = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = runBenchmarks(options["scale"], options["repetitions"], dumpPath, options["label"])
+        finally:
+            connection.creation.destroy_test_db(oldName, verbosity=0)
+            teardown_test_environment()
+
+        encoded = json.dumps(results, indent=2)
+        if options["output"] is not None:
+            with open(options["output"], "w") as f:
+                f.write(encoded + "\n")
+        else:
+            self.stdout.write(encoded)
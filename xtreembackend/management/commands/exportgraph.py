@@ -0,0 +1,27 @@
+import gzip
+import sys
+
+from django.core.management.base import BaseCommand
+
+from xtreembackend.snapshots import exportSnapshot
+
+class Command(BaseCommand):
+    help = "Writes all nodes and links as a line-delimited JSON snapshot (see xtreembackend/snapshots.py)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The snapshot file; compressed with gzip if it ends with .gz, or - for stdout.")
+        parser.add_argument("--chunk-size", type=int, default=10000, help="The number of rows fetched from the database at once.")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if path == "-":
+            counts = exportSnapshot(sys.stdout, options["chunk_size"])
+        else:
+            with openSnapshot(path, "wt") as f:
+                counts = exportSnapshot(f, options["chunk_size"])
+            self.stdout.write("Exported %d nodes and %d links." % counts)
+
+def openSnapshot(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, encoding="utf-8")
+    return open(path, mode[0], encoding="utf-8")
@@ -0,0 +1,29 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from xtreembackend.snapshots import importSnapshot, SnapshotException
+from .exportgraph import openSnapshot
+
+class Command(BaseCommand):
+    help = "Reads a snapshot written by exportgraph into the database. Running servers must be restarted afterwards, since their caches do not notice the import."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The snapshot file; decompressed with gzip if it ends with .gz, or - for stdin.")
+        parser.add_argument("--chunk-size", type=int, default=10000, help="The number of rows inserted at once.")
+        parser.add_argument("--replace", action="store_true", help="Deletes all nodes and links first instead of requiring an empty database.")
+        parser.add_argument("--keep-indexes", action="store_true", help="Updates the link indexes for every chunk instead of creating them afterwards.")
+
+    def handle(self, *args, **options):
+        try:
+            if options["path"] == "-":
+                counts = self.importFrom(sys.stdin, options)
+            else:
+                with openSnapshot(options["path"], "rt") as f:
+                    counts = self.importFrom(f, options)
+        except SnapshotException as e:
+            raise CommandError(str(e))
+        self.stdout.write("Imported %d nodes and %d links." % counts)
+
+    def importFrom(self, f, options):
+        return importSnapshot(f, options["chunk_size"], options["replace"], not options["keep_indexes"])
@@ -0,0 +1,148 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+#
+# Instrumentation of the API views.
+#
+# While a request is processed by the MetricsMiddleware (see middleware.py),
+# the code that handles it can report durations (`timed`) and values (`record`),
+# which are collected in the RequestMetrics of the current request.
+# The queries are measured by `measuringQueries`.
+# Outside of a request, reporting does nothing.
+# After the request, the middleware adds the collected metrics
+# to the process-wide `metricsRegistry`.
+#
+
+# The code handling an async request may report from several threads at once.
+class RequestMetrics:
+    def __init__(self):
+        self.durations = {} # milliseconds by name
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def addDuration(self, name, milliseconds):
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0) + milliseconds
+
+    def addValue(self, name, value):
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+_currentRequestMetrics = contextvars.ContextVar("currentRequestMetrics", default=None)
+
+def currentRequestMetrics():
+    return _currentRequestMetrics.get()
+
+# Collects metrics until `stopCollecting` is called with the returned token.
+def startCollecting(requestMetrics):
+    return _currentRequestMetrics.set(requestMetrics)
+
+def stopCollecting(token):
+    _currentRequestMetrics.reset(token)
+
+@contextmanager
+def timed(name):
+    requestMetrics = _currentRequestMetrics.get()
+    if requestMetrics is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        requestMetrics.addDuration(name, (time.perf_counter() - start) * 1000)
+
+def record(name, value):
+    requestMetrics = _currentRequestMetrics.get()
+    if requestMetrics is not None:
+        requestMetrics.addValue(name, value)
+
+# Measures the number and duration of the queries issued on the
+# database connection of the current thread.
+# Does nothing if the queries of this connection are already measured.
+@contextmanager
+def measuringQueries():
+    if measureQuery in connection.execute_wrappers:
+        yield
+        return
+    with connection.execute_wrapper(measureQuery):
+        yield
+
+def measureQuery(execute, sql, params, many, context):
+    requestMetrics = _currentRequestMetrics.get()
+    if requestMetrics is None:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        requestMetrics.addDuration("sql", (time.perf_counter() - start) * 1000)
+        requestMetrics.addValue("queries", 1)
+
+# Upper bounds (in milliseconds) of the buckets of the latency histograms.
+LATENCY_BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+# Aggregates the metrics of all requests per command:
+# the number of requests and of failed requests, the sums of
+# all durations and values, and a histogram of the total latency.
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._commands = {}
+
+    def add(self, command, status, totalMilliseconds, requestMetrics):
+        with self._lock:
+            entry = self._commands.get(command)
+            if entry is None:
+                entry = {
+                    "requests": 0,
+                    "failedRequests": 0,
+                    "durationSums": {},
+                    "valueSums": {},
+                    "latencyHistogram": [0] * (len(LATENCY_BUCKETS) + 1),
+                }
+                self._commands[command] = entry
+
+            entry["requests"] += 1
+            if status >= 400:
+                entry["failedRequests"] += 1
+            durations = dict(requestMetrics.durations, total=totalMilliseconds)
+            for (name, milliseconds) in durations.items():
+                entry["durationSums"][name] = entry["durationSums"].get(name, 0) + milliseconds
+            for (name, value) in requestMetrics.values.items():
+                entry["valueSums"][name] = entry["valueSums"].get(name, 0) + value
+            entry["latencyHistogram"][bucketOf(totalMilliseconds)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "latencyBuckets": LATENCY_BUCKETS,
+                "commands": {
+                    command: {
+                        "requests": entry["requests"],
+                        "failedRequests": entry["failedRequests"],
+                        "durationSums": dict(entry["durationSums"]),
+                        "valueSums": dict(entry["valueSums"]),
+                        "latencyHistogram": list(entry["latencyHistogram"]),
+                    }
+                    for (command, entry) in self._commands.items()
+                },
+            }
+
+    def clear(self):
+        with self._lock:
+            self._commands = {}
+
+def bucketOf(milliseconds):
+    for (i, bound) in enumerate(LATENCY_BUCKETS):
+        if milliseconds <= bound:
+            return i
+    return len(LATENCY_BUCKETS)
+
+metricsRegistry = MetricsRegistry()
@@ -0,0 +1,71 @@
+import asyncio
+import time
+
+from .metrics import RequestMetrics, measuringQueries, metricsRegistry, startCollecting, stopCollecting
+
+# Measures each request to a view of `xtreembackend.views`:
+# the number and duration of the SQL queries, the durations reported
+# by the views (e.g. for parsing and serializing) and the values they report
+# (e.g. the number of nodes returned). The measurements are sent to the client
+# in a `Server-Timing` header and aggregated per view in the `metricsRegistry`.
+#
+# For streaming responses, only the work done before the response
+# is returned is measured.
+#
+# In async mode, the queries are issued in other threads, so they
+# are measured by the AsyncNodeRepository instead (see repositories.py).
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # tells Django that this middleware is in async mode
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self._callAsync(request)
+
+        requestMetrics = RequestMetrics()
+        token = startCollecting(requestMetrics)
+        start = time.perf_counter()
+        try:
+            with measuringQueries():
+                response = self.get_response(request)
+        finally:
+            stopCollecting(token)
+        return self._finish(request, response, requestMetrics, start)
+
+    async def _callAsync(self, request):
+        requestMetrics = RequestMetrics()
+        token = startCollecting(requestMetrics)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            stopCollecting(token)
+        return self._finish(request, response, requestMetrics, start)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if view_func.__module__ == "xtreembackend.views" and not getattr(view_func, "excludedFromMetrics", False):
+            request._metricsCommand = view_func.__name__
+        return None
+
+    def _finish(self, request, response, requestMetrics, start):
+        totalMilliseconds = (time.perf_counter() - start) * 1000
+        command = getattr(request, "_metricsCommand", None)
+        if command is not None:
+            response["Server-Timing"] = serverTiming(requestMetrics, totalMilliseconds)
+            metricsRegistry.add(command, response.status_code, totalMilliseconds, requestMetrics)
+        return response
+
+def serverTiming(requestMetrics, totalMilliseconds):
+    entries = []
+    for (name, milliseconds) in requestMetrics.durations.items():
+        entries.append("%s;dur=%.2f" % (name, milliseconds))
+    for (name, value) in requestMetrics.values.items():
+        entries.append('%s;desc="%s"' % (name, value))
+    entries.append("total;dur=%.2f" % totalMilliseconds)
+    return ", ".join(entries)
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xtreembackend', '0015_auto_20210519_2121'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='link',
+            index=models.Index(fields=['from_node', 'deleted'], include=('to_node', 'type'), name='link_children_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='link',
+            index=models.Index(condition=models.Q(('deleted', False)), fields=['from_node', 'to_node', 'type'], name='link_live_children_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:28
+
+from django.db import migrations, models
+
+
+def createRevision(apps, schema_editor):
+    GraphRevision = apps.get_model('xtreembackend', 'GraphRevision')
+    GraphRevision.objects.create(id=1, value=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xtreembackend', '0016_link_traversal_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GraphRevision',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(createRevision, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xtreembackend', '0017_graphrevision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('node_id', models.BigIntegerField()),
+                ('target_id', models.BigIntegerField(null=True)),
+            ],
+        ),
+    ]
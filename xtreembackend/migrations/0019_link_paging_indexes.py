@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xtreembackend', '0018_change'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='link',
+            index=models.Index(condition=models.Q(('deleted', False)), fields=['from_node', 'id'], name='link_children_by_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='link',
+            index=models.Index(condition=models.Q(('deleted', False)), fields=['from_node', 'type', 'id'], name='link_children_by_type_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:48
+
+from django.db import migrations, models
+
+
+# A frozen copy of xtreembackend.closure.rebuildClosure at the time of this migration.
+def buildClosure(apps, schema_editor):
+    Link = apps.get_model('xtreembackend', 'Link')
+    Closure = apps.get_model('xtreembackend', 'Closure')
+    schema_editor.execute("""
+        INSERT INTO {closure} (ancestor_id, descendant_id)
+        WITH RECURSIVE reach(ancestor_id, descendant_id) AS (
+            SELECT from_node_id, to_node_id FROM {link} WHERE NOT deleted
+            UNION
+            SELECT r.ancestor_id, l.to_node_id
+            FROM reach r JOIN {link} l ON l.from_node_id = r.descendant_id
+            WHERE NOT l.deleted
+        )
+        SELECT ancestor_id, descendant_id FROM reach WHERE ancestor_id <> descendant_id
+    """.format(closure=Closure._meta.db_table, link=Link._meta.db_table))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xtreembackend', '0019_link_paging_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Closure',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('ancestor_id', models.BigIntegerField()),
+                ('descendant_id', models.BigIntegerField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='closure',
+            index=models.Index(fields=['descendant_id', 'ancestor_id'], name='closure_ancestors_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='closure',
+            unique_together={('ancestor_id', 'descendant_id')},
+        ),
+        migrations.RunPython(buildClosure, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xtreembackend', '0020_closure'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='link',
+            name='link_children_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='link',
+            name='link_live_children_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='link',
+            name='link_children_by_id_idx',
+        ),
+        migrations.AddIndex(
+            model_name='link',
+            index=models.Index(condition=models.Q(('deleted', False)), fields=['from_node', 'id', 'to_node', 'type'], name='link_live_children_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xtreembackend', '0021_merge_link_children_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='change',
+            name='reset',
+            field=models.BooleanField(default=False),
+        ),
+    ]
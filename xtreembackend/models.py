@@ -57,4 +57,68 @@ class Link(models.Model):
     class Meta:
         db_table = "xtreembackend_node_x_link"
         unique_together = ('to_node', 'from_node')
+        indexes = [
+            # Used to look up the children of nodes, ordered by ID (see NodeRepository.getChildrenPage).
+            # Only contains the links that have not been deleted, on backends that support
+            # partial indexes, and covers the columns that are read for them.
+            models.Index(fields=["from_node", "id", "to_node", "type"], condition=models.Q(deleted=False), name="link_live_children_idx"),
+            # Used to page through the children of nodes ordered by type.
+            models.Index(fields=["from_node", "type", "id"], condition=models.Q(deleted=False), name="link_children_by_type_idx"),
+        ]
 
+
+# A counter that is incremented by every transaction that changes
+# nodes or links. The table contains a single row with the ID 1.
+class GraphRevision(models.Model):
+    value = models.BigIntegerField(default=0)
+
+    # Returns the current revision. A missing row (e.g. after the
+    # database was flushed) counts as revision 0.
+    @staticmethod
+    def current():
+        return GraphRevision.objects.values_list("value", flat=True).filter(id=1).first() or 0
+
+    # Increments the revision, creating the row if it is missing.
+    # Must be called inside a transaction; the row lock serializes the writers.
+    @staticmethod
+    def increment():
+        if GraphRevision.objects.filter(id=1).update(value=models.F("value") + 1) == 0:
+            (_, created) = GraphRevision.objects.get_or_create(id=1, defaults={"value": 1})
+            if not created:
+                GraphRevision.objects.filter(id=1).update(value=models.F("value") + 1)
+
+# An append-only log of the changes to nodes and links. The ID is the
+# sequence number of the change, which increases with every change.
+# A change only records which node or link was changed; readers of the
+# log fetch the current state of the node or link.
+# A reset marker records that all nodes and links may have changed
+# (e.g. by importing a snapshot), so readers must fetch everything again.
+class Change(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    # the ID of the changed node, or the source ID of the changed link
+    # (0 for a reset marker)
+    node_id = models.BigIntegerField()
+    # the target ID of the changed link, or null if a node was changed
+    target_id = models.BigIntegerField(null=True)
+    reset = models.BooleanField(default=False)
+
+    # Must be called in the same transaction as the change, after
+    # incrementing the GraphRevision.
+    @staticmethod
+    def recordReset():
+        Change.objects.create(node_id=0, reset=True)
+
+# The closure of the links that are not deleted: a row for every pair
+# of distinct nodes such that the descendant can be reached from the ancestor
+# (see closure.py).
+class Closure(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    ancestor_id = models.BigIntegerField()
+    descendant_id = models.BigIntegerField()
+
+    class Meta:
+        # the unique index is used to look up descendants and single pairs
+        unique_together = ("ancestor_id", "descendant_id")
+        indexes = [
+            models.Index(fields=["descendant_id", "ancestor_id"], name="closure_ancestors_idx"),
+        ]
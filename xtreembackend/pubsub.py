@@ -0,0 +1,59 @@
+import asyncio
+import threading
+
+#
+# An in-process publish/subscribe hub that tells subscribers
+# that the graph has changed.
+#
+# The NodeRepository publishes after every committed write (from any thread);
+# subscribers are coroutines that wait for the next change (see events.py).
+# Notifications carry no data: a subscriber that is notified reads
+# the change log itself, so notifications that arrive while it is busy
+# are coalesced into one.
+#
+# Only writes issued through a NodeRepository of the same process are published.
+#
+class ChangeHub:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+
+    # Must be called from a coroutine; the subscription
+    # belongs to the event loop it is running on.
+    def subscribe(self):
+        subscription = Subscription(asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def subscriberCount(self):
+        with self._lock:
+            return len(self._subscriptions)
+
+    def publish(self):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.notify()
+
+class Subscription:
+    def __init__(self, loop):
+        self._loop = loop
+        self._changed = asyncio.Event()
+
+    # May be called from any thread.
+    def notify(self):
+        try:
+            self._loop.call_soon_threadsafe(self._changed.set)
+        except RuntimeError:
+            # the event loop has been closed
+            pass
+
+    # Waits until a change has been published since the last call.
+    async def wait(self):
+        await self._changed.wait()
+        self._changed.clear()
@@ -1,59 +1,559 @@
 from typing import List
 
-from .models import Node as DBNode, Link as DBLink
+from asgiref.sync import sync_to_async
+from django.db import connection, transaction
+from django.db.models import Q
+
+from .models import Node as DBNode, Link as DBLink, GraphRevision, Change, Closure
 from .domain.objects import LinkID, Node, NodeType, NodeData, Link, LinkType
 from .validation import ValidationException
+from .metrics import measuringQueries
+from .graphcache import GraphCache
+from .closure import addToClosure, removeFromClosure
+
+# The number of logged changes up to which NodeRepository.validateCache
+# drops single entries of the graph cache instead of all of them.
+CACHE_CHANGE_LIMIT = 1000
 
 # Abstracts the database.
 # Note that Django ids are integers, while the dataspec requires strings.
 # So this class translates between these two formats.
 class NodeRepository:
+    # `graphCache` is an optional GraphCache that is consulted
+    # before querying the database and that is kept up to date
+    # by the write methods of this repository.
+    # `graphIndex` is an optional GraphIndex that is used to compute
+    # subgraphs without querying the links from the database.
+    # `changeHub` is an optional ChangeHub that is notified
+    # after every committed write.
+    def __init__(self, graphCache=None, graphIndex=None, changeHub=None):
+        self.graphCache = graphCache
+        self.graphIndex = graphIndex
+        self.changeHub = changeHub
+        # the cache and index of the repository a batch repository
+        # was created from (see `forBatch`), which its writes keep up to date
+        self._outerGraphCache = None
+        self._outerGraphIndex = None
+        self._inBatch = False
+
+    # Returns a repository for executing several commands in one transaction.
+    # Its reads go through a GraphCache of its own, so that subtrees are only
+    # fetched once per batch, and never through the caches and the index of this
+    # repository, which do not reflect the uncommitted writes of the batch.
+    # Its writes keep the caches and the index of this repository up to date.
+    def forBatch(self, cacheSize):
+        batch = NodeRepository(GraphCache(cacheSize), None, self.changeHub)
+        batch._outerGraphCache = self.graphCache
+        batch._outerGraphIndex = self.graphIndex
+        batch._inBatch = True
+        return batch
+
     def get(self, ids):
         ids = [int(id) for id in ids]
-        query = DBNode.objects.filter(id__in=ids)
         nodesById = {}
         for id in ids:
-            nodesById[str(id)] = None
-        for dbNode in query.all():
-            nodesById[str(dbNode.id)] = self._toDomainNode(dbNode)
+            nodesById[str(id)] = self.graphCache.getNode(str(id)) if self.graphCache is not None else None
+        missingIds = [id for id in ids if nodesById[str(id)] is None]
+        if len(missingIds) == 0:
+            return nodesById
+
+        generation = self._cacheGeneration()
+        # values_list avoids instantiating model objects
+        query = DBNode.objects.filter(id__in=missingIds).values_list("id", "title", "content", "node_type")
+        fetchedNodes = [self._rowToDomainNode(*row) for row in query]
+        for node in fetchedNodes:
+            nodesById[node["id"]] = node
+        if self.graphCache is not None:
+            self.graphCache.storeNodes(fetchedNodes, generation)
         return nodesById
 
     def getChildren(self, ids):
         ids = [int(id) for id in ids]
-        query = DBLink.objects.filter(from_node_id__in=ids)
         linksByParentId = {}
+        missingIds = []
         for id in ids:
-            linksByParentId[str(id)] = []
-        for dbLink in query.all():
-            if not dbLink.deleted:
-                linksByParentId[str(dbLink.from_node_id)].append(self._toDomainLink(dbLink))
+            cachedLinks = self.graphCache.getChildren(str(id)) if self.graphCache is not None else None
+            if cachedLinks is None:
+                missingIds.append(id)
+                linksByParentId[str(id)] = []
+            else:
+                linksByParentId[str(id)] = cachedLinks
+        if len(missingIds) == 0:
+            return linksByParentId
+
+        generation = self._cacheGeneration()
+        query = DBLink.objects.filter(from_node_id__in=missingIds, deleted=False).values_list("from_node_id", "to_node_id", "type")
+        for row in query:
+            linksByParentId[str(row[0])].append(self._rowToDomainLink(*row))
+        if self.graphCache is not None:
+            self.graphCache.storeChildren({str(id): linksByParentId[str(id)] for id in missingIds}, generation)
         return linksByParentId
 
+    # Returns a page of at most `limit` children of the node `parentId`
+    # as a pair (links, lastKey). The links are ordered by `orderBy`:
+    # "id" orders them by their (database) IDs, i.e. in the order they were
+    # created, "type" orders them by their types and then by their IDs.
+    # The page starts after the key `after` (None for the first page).
+    # The key of a link is its ID if ordered by "id" and the pair (type, ID)
+    # if ordered by "type". `lastKey` is the key of the last link of the page,
+    # or None if there are no more children.
+    def getChildrenPage(self, parentId, orderBy, after, limit):
+        query = DBLink.objects.filter(from_node_id=int(parentId), deleted=False)
+        if orderBy == "id":
+            if after is not None:
+                query = query.filter(id__gt=after)
+            query = query.order_by("id")
+        else:
+            if after is not None:
+                (type, id) = after
+                query = query.filter(Q(type__gt=type) | Q(type=type, id__gt=id))
+            query = query.order_by("type", "id")
+
+        # one more row tells whether there is another page
+        rows = list(query.values_list("id", "from_node_id", "to_node_id", "type")[:limit + 1])
+        links = [self._rowToDomainLink(sourceId, targetId, type) for (_, sourceId, targetId, type) in rows[:limit]]
+        if len(rows) <= limit:
+            return (links, None)
+        (lastId, _, _, lastType) = rows[limit - 1]
+        return (links, lastId if orderBy == "id" else (lastType, lastId))
+
+    # Returns the first pages (ordered by "id", see getChildrenPage) of the children
+    # of several nodes with a single query, as a pair (childrenByParentId, lastKeysByParentId),
+    # where lastKeysByParentId only contains the nodes that have more children.
+    def getFirstChildrenPages(self, ids, limit):
+        ids = [int(id) for id in ids]
+        childrenByParentId = {str(id): [] for id in ids}
+        lastKeysByParentId = {}
+        if len(ids) == 0:
+            return (childrenByParentId, lastKeysByParentId)
+
+        with connection.cursor() as cursor:
+            cursor.execute(self._firstChildrenPagesQuery(len(ids)), ids + [limit + 1])
+            for (id, sourceId, targetId, type, childNumber) in cursor.fetchall():
+                if childNumber <= limit:
+                    childrenByParentId[str(sourceId)].append(self._rowToDomainLink(sourceId, targetId, type))
+                    lastId = id
+                else:
+                    lastKeysByParentId[str(sourceId)] = lastId
+        return (childrenByParentId, lastKeysByParentId)
+
+    # Fetches the subgraph below `ids` with a single recursive query.
+    # Every node is assigned the lowest level it is reachable on,
+    # so nodes shared by several parents are only fetched and counted once.
+    # At most `maxNodeCount` nodes are returned, the lowest levels first.
+    # If this limit is hit, the last level is cut off and
+    # the children of the nodes on that level are not fetched;
+    # otherwise the children of all nodes above `depth` are fetched.
+    # If `titlesOnly` is set, the content of all nodes except for
+    # those with the given ids is not fetched and replaced by an empty string.
+    # If `maxChildren` is given, only the first `maxChildren` children of
+    # every node are fetched and followed (see _iterSubgraphWithFanOut);
+    # the last keys of the nodes with more children are added to `lastChildKeys`.
+    # Returns a pair (nodesById, childrenByParentId).
+    def getSubgraph(self, ids, depth, maxNodeCount, titlesOnly=False, maxChildren=None, lastChildKeys=None):
+        nodesById = {}
+        childrenByParentId = {}
+        for (nodesOnLevel, childrenOnLevel) in self.iterSubgraph(ids, depth, maxNodeCount, titlesOnly, maxChildren, lastChildKeys):
+            nodesById.update(nodesOnLevel)
+            childrenByParentId.update(childrenOnLevel)
+        return (nodesById, childrenByParentId)
+
+    # Same as getSubgraph, but yields the subgraph level by level
+    # as a pair (nodesById, childrenByParentId) for each level,
+    # where childrenByParentId contains the children of the nodes on that level.
+    # The rows are read from the database while the levels are consumed.
+    # If there is a graph index, only the nodes are fetched from the database.
+    # Otherwise, if the graph cache already contains the whole subgraph,
+    # the database is not queried at all. In a batch (see `forBatch`), if it
+    # contains the roots and their children, the subgraph is walked level by level
+    # and only the nodes and children missing from the cache are fetched.
+    def iterSubgraph(self, ids, depth, maxNodeCount, titlesOnly=False, maxChildren=None, lastChildKeys=None):
+        ids = [int(id) for id in ids]
+        if len(ids) == 0 or maxNodeCount <= 0:
+            return
+
+        if maxChildren is not None:
+            yield from self._iterSubgraphWithFanOut(ids, depth, maxNodeCount, titlesOnly, maxChildren, lastChildKeys)
+            return
+
+        if self.graphIndex is not None:
+            yield from self._iterSubgraphFromIndex(ids, depth, maxNodeCount, titlesOnly)
+            return
+
+        if self.graphCache is not None:
+            levels = walkSubgraph(ids, depth, maxNodeCount, self.graphCache.getNode, self.graphCache.getChildren)
+            if levels is not None:
+                for (level, (nodesById, childrenByParentId)) in enumerate(levels):
+                    if titlesOnly and level > 0:
+                        nodesById = {id: withoutContent(node) for (id, node) in nodesById.items()}
+                    yield (nodesById, childrenByParentId)
+                return
+            if self._inBatch and all(self.graphCache.getNode(str(id)) is not None and self.graphCache.getChildren(str(id)) is not None for id in ids):
+                yield from self._iterSubgraphByLevels(ids, depth, maxNodeCount, titlesOnly, self.getChildren)
+                return
+
+        # The recursion stops after `reachLimit` rows (a node has a row for every
+        # level it is reached on), so that its work is bounded by `maxNodeCount`
+        # and not by the size of the graph. If it stops early, the query only
+        # returns a row of kind 2 and the subgraph is walked level by level,
+        # which stops as soon as `maxNodeCount` nodes have been picked.
+        reachLimit = 2 * maxNodeCount
+        generation = self._cacheGeneration()
+        with connection.cursor() as cursor:
+            cursor.execute(*self._subgraphQuery(ids, depth, maxNodeCount, reachLimit, titlesOnly))
+            rows = cursor.fetchmany(500)
+            reachStopped = len(rows) > 0 and rows[0][0] == 2
+
+            currentLevel = 0
+            nodesById = {}
+            childrenByParentId = {}
+            while len(rows) > 0 and not reachStopped:
+                for (kind, id, level, boundLevel, title, content, type, sourceId, targetId) in rows:
+                    if level != currentLevel:
+                        yield self._storeLevelInCache(nodesById, childrenByParentId, generation, titlesOnly and currentLevel > 0)
+                        currentLevel = level
+                        nodesById = {}
+                        childrenByParentId = {}
+
+                    if kind == 0:
+                        nodesById[str(id)] = self._rowToDomainNode(id, title, content, type)
+                        if level < boundLevel:
+                            childrenByParentId[str(id)] = []
+                    else:
+                        childrenByParentId[str(sourceId)].append(self._rowToDomainLink(sourceId, targetId, type))
+                rows = cursor.fetchmany(500)
+
+        if reachStopped:
+            yield from self._iterSubgraphByLevels(ids, depth, maxNodeCount, titlesOnly, self.getChildren)
+        elif len(nodesById) > 0:
+            yield self._storeLevelInCache(nodesById, childrenByParentId, generation, titlesOnly and currentLevel > 0)
+
+    def _iterSubgraphFromIndex(self, ids, depth, maxNodeCount, titlesOnly):
+        self.graphIndex.ensureLoaded()
+        (pickedLevels, boundLevel) = planSubgraph(ids, depth, maxNodeCount, self.graphIndex.getChildIds)
+
+        if titlesOnly:
+            nodesById = self.get(pickedLevels[0])
+            nodesById.update(self._getWithoutContent([id for idsOnLevel in pickedLevels[1:] for id in idsOnLevel]))
+        else:
+            nodesById = self.get([id for idsOnLevel in pickedLevels for id in idsOnLevel])
+
+        for (level, idsOnLevel) in enumerate(pickedLevels):
+            # roots that do not exist are left out, as in the query
+            nodesOnLevel = {str(id): nodesById[str(id)] for id in idsOnLevel if nodesById[str(id)] is not None}
+            childrenOnLevel = {}
+            if level < boundLevel:
+                for id in nodesOnLevel:
+                    childrenOnLevel[id] = self.graphIndex.getChildren(int(id))
+            yield (nodesOnLevel, childrenOnLevel)
+
+    # Walks the subgraph level by level with one query for the nodes and
+    # one for the first pages of the children of each level, since the
+    # recursive query cannot limit the number of children per node.
+    # Returns the same levels as the recursive query would return if every node
+    # only had the first `maxChildren` of its children (ordered by link ID).
+    def _iterSubgraphWithFanOut(self, ids, depth, maxNodeCount, titlesOnly, maxChildren, lastChildKeys):
+        def getFirstChildren(parentIds):
+            (childrenByParentId, lastKeys) = self.getFirstChildrenPages(parentIds, maxChildren)
+            if lastChildKeys is not None:
+                lastChildKeys.update(lastKeys)
+            return childrenByParentId
+
+        return self._iterSubgraphByLevels(ids, depth, maxNodeCount, titlesOnly, getFirstChildren)
+
+    # Returns the same levels as the recursive query with one query for the nodes
+    # and one for the children (fetched with `getChildren`) of each level.
+    # Only the levels up to the one where `maxNodeCount` is reached are fetched.
+    def _iterSubgraphByLevels(self, ids, depth, maxNodeCount, titlesOnly, getChildren):
+        visitedIds = set()
+        idsOnLevel = []
+        for id in ids:
+            if id not in visitedIds:
+                visitedIds.add(id)
+                idsOnLevel.append(id)
+
+        nodeCount = 0
+        for level in range(depth + 1):
+            idsOnLevel = sorted(idsOnLevel)[:maxNodeCount - nodeCount]
+            if len(idsOnLevel) == 0:
+                return
+
+            if titlesOnly and level > 0:
+                fetchedNodes = self._getWithoutContent(idsOnLevel)
+            else:
+                fetchedNodes = self.get(idsOnLevel)
+            # nodes that do not exist are left out, as in the query
+            nodesById = {id: node for (id, node) in fetchedNodes.items() if node is not None}
+            nodeCount += len(nodesById)
+
+            childrenByParentId = {}
+            if level < depth and nodeCount < maxNodeCount:
+                childrenByParentId = getChildren(nodesById.keys())
+            yield (nodesById, childrenByParentId)
+
+            idsOnLevel = []
+            for children in childrenByParentId.values():
+                for link in children:
+                    targetId = int(link["targetId"])
+                    if targetId not in visitedIds:
+                        visitedIds.add(targetId)
+                        idsOnLevel.append(targetId)
+
+    # Fetches nodes like `get`, but does not fetch their content
+    # (which is replaced by an empty string).
+    def _getWithoutContent(self, ids):
+        nodesById = {}
+        missingIds = []
+        for id in ids:
+            node = self.graphCache.getNode(str(id)) if self.graphCache is not None else None
+            nodesById[str(id)] = withoutContent(node) if node is not None else None
+            if node is None:
+                missingIds.append(id)
+        if len(missingIds) == 0:
+            return nodesById
+
+        query = DBNode.objects.filter(id__in=missingIds).values_list("id", "title", "node_type")
+        for (id, title, type) in query:
+            nodesById[str(id)] = self._rowToDomainNode(id, title, "", type)
+        return nodesById
+
+    # Returns the ancestors of the node `id`, i.e. the nodes it can be reached from,
+    # with the closure table (see closure.py), as a pair (nodesById, parentIdsById),
+    # where `nodesById` contains the node itself and its ancestors, and `parentIdsById`
+    # maps each of them to the IDs of its parents (which are ancestors, too).
+    def getAncestors(self, id):
+        ancestorIds = list(Closure.objects.filter(descendant_id=int(id)).values_list("ancestor_id", flat=True))
+        nodesById = self.get([id] + ancestorIds)
+        if nodesById[str(int(id))] is None:
+            raise NodeNotFoundException()
+
+        parentIdsById = {nodeId: [] for nodeId in nodesById}
+        query = DBLink.objects.filter(to_node_id__in=[int(id)] + ancestorIds, deleted=False).order_by("id").values_list("from_node_id", "to_node_id")
+        for (sourceId, targetId) in query:
+            parentIdsById[str(targetId)].append(str(sourceId))
+        return (nodesById, parentIdsById)
+
+    # Returns whether the node `targetId` can be reached from the node `sourceId`
+    # via links that are not deleted, with a single lookup in the closure table.
+    # Every node can be reached from itself.
+    def isReachable(self, sourceId, targetId):
+        if int(sourceId) == int(targetId):
+            return True
+        return Closure.objects.filter(ancestor_id=int(sourceId), descendant_id=int(targetId)).exists()
+
+    # Returns the graph revision, which changes whenever
+    # a node or a link is changed.
+    def getRevision(self):
+        return GraphRevision.current()
+
+    # Brings the graph cache and the graph index up to date with the graph
+    # revision `revision` (which is read if it is None), so that the writes
+    # of other processes are noticed: if they were filled at another revision,
+    # the changes logged since then are applied to them, i.e. the changed entries
+    # of the cache are dropped and the changed children of the index are read again.
+    # If more than CACHE_CHANGE_LIMIT changes have been logged since,
+    # or the log has been reset, the whole cache is dropped and the index
+    # is loaded again on its next use.
+    # Must be called at the start of every request that reads through them.
+    def validateCache(self, revision=None):
+        if self.graphCache is None and self.graphIndex is None:
+            return
+        if revision is None:
+            revision = self.getRevision()
+        if self.graphCache is not None:
+            self._validateGraphCache(revision)
+        if self.graphIndex is not None:
+            self._validateGraphIndex(revision)
+
+    def _validateGraphCache(self, revision):
+        (cachedRevision, changeNumber) = self.graphCache.revision()
+        if revision == cachedRevision:
+            return
+        if changeNumber is not None and revision < cachedRevision:
+            if self._logWasReset(changeNumber):
+                self.graphCache.reset(revision, self.getLastChangeNumber())
+            return
+
+        changes = self._changesToApply(changeNumber) if changeNumber is not None else None
+        if changes is None:
+            self.graphCache.reset(revision, self.getLastChangeNumber())
+        else:
+            (lastNumber, nodeIds, parentIds) = changes
+            self.graphCache.applyChanges(revision, lastNumber, nodeIds, parentIds)
+
+    def _validateGraphIndex(self, revision):
+        (indexedRevision, changeNumber) = self.graphIndex.revision()
+        # an index that is not loaded yet is up to date once it is loaded
+        if changeNumber is None or revision == indexedRevision:
+            return
+        if revision < indexedRevision:
+            if self._logWasReset(changeNumber):
+                self.graphIndex.unload()
+            return
+
+        changes = self._changesToApply(changeNumber)
+        if changes is None:
+            self.graphIndex.unload()
+            return
+        (lastNumber, _, parentIds) = changes
+        childrenByParentId = {int(id): [] for id in parentIds}
+        query = DBLink.objects.filter(from_node_id__in=childrenByParentId.keys(), deleted=False).order_by("id").values_list("from_node_id", "to_node_id", "type")
+        for (sourceId, targetId, type) in query:
+            childrenByParentId[sourceId].append((targetId, type))
+        self.graphIndex.applyChanges(revision, lastNumber, childrenByParentId)
+
+    # Returns the changes logged after the change `changeNumber` as a tuple
+    # (lastNumber, changedNodeIds, parentIdsOfChangedLinks), or None if there
+    # are more than CACHE_CHANGE_LIMIT of them, they include a reset marker
+    # or the log has been reset.
+    # Must only be called if the graph revision has moved on since that change.
+    def _changesToApply(self, changeNumber):
+        (lastNumber, nodeIds, parentIds, hasMore, reset) = self.getChangesSince(changeNumber, CACHE_CHANGE_LIMIT)
+        # every write logs changes, so none means that the log has been reset
+        if hasMore or reset or lastNumber <= changeNumber:
+            return None
+        return (lastNumber, nodeIds, parentIds)
+
+    # Whether the log has been reset (e.g. by restoring the database) since the
+    # change `changeNumber`, if the graph revision seems to have gone back.
+    def _logWasReset(self, changeNumber):
+        return self.getLastChangeNumber() < changeNumber
+
     def create(self, data):
         dbNode = DBNode(title=data["title"], content=data["content"], node_type=data["type"])
         dbNode.full_clean()
-        dbNode.save()
+        with transaction.atomic():
+            dbNode.save()
+            self._recordChanges(nodeIds=[dbNode.id])
+        self._invalidateCache(nodeIds=[dbNode.id])
 
         return self._toDomainNode(dbNode)
 
+    # Creates nodes with the NodeData `dataList` and links between them
+    # in one transaction and returns the new nodes in the same order.
+    # `links` are triples (sourceIndex, targetIndex, type) of indexes into `dataList`,
+    # `parentLinks` are triples (parentId, targetIndex, type) that link
+    # existing nodes to new ones.
+    # The links are inserted with a single statement, and so are the nodes
+    # if the backend returns the IDs of bulk inserts (see below).
+    def createMany(self, dataList, links=(), parentLinks=()):
+        dbNodes = [DBNode(title=data["title"], content=data["content"], node_type=data["type"]) for data in dataList]
+        for dbNode in dbNodes:
+            dbNode.clean_fields()
+
+        with transaction.atomic():
+            parentIds = set(int(parentId) for (parentId, _, _) in parentLinks)
+            if DBNode.objects.filter(id__in=parentIds).count() != len(parentIds):
+                raise NodeNotFoundException()
+
+            if connection.features.can_return_rows_from_bulk_insert:
+                DBNode.objects.bulk_create(dbNodes)
+            else:
+                # otherwise, bulk_create does not set the IDs
+                for dbNode in dbNodes:
+                    dbNode.save()
+
+            typesByKey = {}
+            for (sourceIndex, targetIndex, type) in links:
+                typesByKey[(dbNodes[sourceIndex].id, dbNodes[targetIndex].id)] = type
+            for (parentId, targetIndex, type) in parentLinks:
+                typesByKey[(int(parentId), dbNodes[targetIndex].id)] = type
+            DBLink.objects.bulk_create([DBLink(from_node_id=sourceId, to_node_id=targetId, type=type) for ((sourceId, targetId), type) in typesByKey.items()])
+
+            nodeIds = [dbNode.id for dbNode in dbNodes]
+            self._recordChanges(nodeIds=nodeIds, linkKeys=typesByKey.keys())
+            addToClosure(typesByKey.keys())
+            self._invalidateCache(nodeIds=nodeIds, childrenOfIds=set(sourceId for (sourceId, _) in typesByKey))
+            for graphIndex in self._graphIndexes():
+                transaction.on_commit(lambda graphIndex=graphIndex: graphIndex.storeLinks(typesByKey))
+
+        return [self._toDomainNode(dbNode) for dbNode in dbNodes]
+
     def link(self, link: Link):
-        query = self._linkOrLinkIdToQuery(link)
-        if not query.exists():
-            dbLink = DBLink(from_node_id=int(link["sourceId"]), to_node_id=int(link["targetId"]), type=link["type"])
-            dbLink.full_clean()
-            dbLink.save()
-        else:
-            dbLink = query.get()
-            dbLink.deleted = False
-            dbLink.type = link["type"]
-            dbLink.save()
+        self.linkMany([link])
 
     def unlink(self, linkID: LinkID):
-        query = self._linkOrLinkIdToQuery(linkID)
-        if query.exists():
-            dbLink = query.get()
-            dbLink.deleted = True
-            dbLink.save()
+        self.unlinkMany([linkID])
+
+    # Creates the given links or, if a link with the same LinkID already exists,
+    # restores it and updates its type. If a LinkID occurs several times,
+    # the last occurrence wins, just as if the links were created one after another.
+    # Raises a CycleException if the links would create a cycle (see closure.py),
+    # in which case none of them is created.
+    # The number of queries does not depend on the number of links.
+    def linkMany(self, links):
+        typesByKey = {}
+        for link in links:
+            typesByKey[(int(link["sourceId"]), int(link["targetId"]))] = link["type"]
+        if len(typesByKey) == 0:
+            return
+
+        with transaction.atomic():
+            nodeIds = set(id for key in typesByKey for id in key)
+            if DBNode.objects.filter(id__in=nodeIds).count() != len(nodeIds):
+                raise NodeNotFoundException()
+
+            # locked, so that concurrent writes cannot restore a link twice (see closure.py)
+            existingLinks = {}
+            for dbLink in self._linkIdsToQuery(typesByKey.keys()).select_for_update():
+                existingLinks[(dbLink.from_node_id, dbLink.to_node_id)] = dbLink
+
+            newLinks = []
+            changedLinks = []
+            # the links that did not exist or were deleted
+            addedKeys = []
+            for (key, type) in typesByKey.items():
+                dbLink = existingLinks.get(key)
+                if dbLink is None:
+                    newLinks.append(DBLink(from_node_id=key[0], to_node_id=key[1], type=type))
+                    addedKeys.append(key)
+                elif dbLink.deleted or dbLink.type != type:
+                    if dbLink.deleted:
+                        addedKeys.append(key)
+                    dbLink.deleted = False
+                    dbLink.type = type
+                    changedLinks.append(dbLink)
+
+            if len(newLinks) > 0:
+                DBLink.objects.bulk_create(newLinks)
+            if len(changedLinks) > 0:
+                DBLink.objects.bulk_update(changedLinks, ["deleted", "type"])
+            if len(newLinks) > 0 or len(changedLinks) > 0:
+                self._recordChanges(linkKeys=[(l.from_node_id, l.to_node_id) for l in newLinks + changedLinks])
+            addToClosure(addedKeys)
+
+            self._invalidateCache(childrenOfIds=set(sourceId for (sourceId, _) in typesByKey))
+            for graphIndex in self._graphIndexes():
+                transaction.on_commit(lambda graphIndex=graphIndex: graphIndex.storeLinks(typesByKey))
+
+    # Marks the given links as deleted with a single statement
+    # (besides the ones that update the closure table).
+    # LinkIDs without a corresponding link are ignored.
+    def unlinkMany(self, linkIDs):
+        keys = set((int(linkID["sourceId"]), int(linkID["targetId"])) for linkID in linkIDs)
+        if len(keys) == 0:
+            return
+
+        with transaction.atomic():
+            # If only some of the links existed, changes are recorded for all of them,
+            # which is harmless since readers of the log fetch the current state.
+            # The links that are deleted are locked first,
+            # so that the closure table is updated for exactly those.
+            query = self._linkIdsToQuery(keys).filter(deleted=False)
+            deletedKeys = list(query.select_for_update().values_list("from_node_id", "to_node_id"))
+            if query.update(deleted=True) > 0:
+                self._recordChanges(linkKeys=keys)
+            removeFromClosure(deletedKeys)
+            self._invalidateCache(childrenOfIds=set(sourceId for (sourceId, _) in keys))
+            for graphIndex in self._graphIndexes():
+                transaction.on_commit(lambda graphIndex=graphIndex: graphIndex.removeLinks(keys))
+
+    # Deletes the links `oldLinkIDs` and creates the links `newLinks` atomically.
+    # A link that occurs in both lists is kept.
+    def move(self, oldLinkIDs, newLinks):
+        with transaction.atomic():
+            self.unlinkMany(oldLinkIDs)
+            self.linkMany(newLinks)
 
     def update(self, id, data) -> Node:
         # TODO: It would be better to catch errors
@@ -66,31 +566,379 @@ class NodeRepository:
             node.content = data["content"]
             node.node_type = data["type"]
             node.full_clean()
-            node.save()
+            with transaction.atomic():
+                node.save()
+                self._recordChanges(nodeIds=[node.id])
+            self._invalidateCache(nodeIds=[id])
             return self._toDomainNode(node)
         else:
             raise NodeNotFoundException()
 
-    def _linkOrLinkIdToQuery(self, link: Link):
-        return DBLink.objects.filter(from_node_id=int(link["sourceId"]), to_node_id=int(link["targetId"]))
+    # `reach` collects every (node, level) pair reachable from the roots
+    # via non-deleted links; `UNION` (instead of `UNION ALL`) drops duplicate pairs,
+    # which keeps the recursion finite even if the graph contains cycles.
+    # `limited` only takes its first pairs, which stops the recursion after them
+    # (PostgreSQL evaluates `reach` only as far as it is read). SQLite computes
+    # `reach` completely when it is read more than once, so there the recursive
+    # query itself is limited, which other backends do not support.
+    # If the limit is reached, nothing is picked and only a row of kind 2 is returned.
+    # `bound` is the level whose nodes do not get their children fetched.
+    # The result is ordered by level; on each level, the node rows (kind 0)
+    # come before the rows of the links to their children (kind 1).
+    # Returns the pair (sql, params).
+    def _subgraphQuery(self, ids, depth, maxNodeCount, reachLimit, titlesOnly):
+        limitsRecursion = connection.vendor == "sqlite"
+        sql = """
+            WITH RECURSIVE reach(id, lvl) AS (
+                SELECT id, 0 FROM {node} WHERE id IN ({placeholders})
+                UNION
+                SELECT l.to_node_id, r.lvl + 1
+                FROM reach r JOIN {link} l ON l.from_node_id = r.id
+                WHERE r.lvl < %s AND NOT l.deleted
+                {recursionLimit}
+            ),
+            limited(id, lvl) AS (
+                SELECT id, lvl FROM reach LIMIT %s
+            ),
+            levels(id, lvl) AS (
+                SELECT id, MIN(lvl) FROM limited GROUP BY id
+                HAVING (SELECT COUNT(*) FROM limited) < %s
+            ),
+            picked(id, lvl) AS (
+                SELECT id, lvl FROM levels ORDER BY lvl, id LIMIT %s
+            ),
+            bound(lvl) AS (
+                SELECT CASE WHEN COUNT(*) >= %s THEN MAX(lvl) ELSE %s END FROM picked
+            )
+            SELECT 0, n.id, p.lvl, b.lvl, n.title, CASE WHEN p.lvl > 0 AND %s THEN '' ELSE n.content END, n.node_type, NULL, NULL
+            FROM picked p CROSS JOIN bound b JOIN {node} n ON n.id = p.id
+            UNION ALL
+            SELECT 1, l.id, p.lvl, b.lvl, NULL, NULL, l.type, l.from_node_id, l.to_node_id
+            FROM picked p CROSS JOIN bound b JOIN {link} l ON l.from_node_id = p.id
+            WHERE p.lvl < b.lvl AND NOT l.deleted
+            UNION ALL
+            SELECT 2, NULL, -1, NULL, NULL, NULL, NULL, NULL, NULL
+            WHERE (SELECT COUNT(*) FROM limited) >= %s
+            ORDER BY 3, 1, 2
+        """.format(
+            node=DBNode._meta.db_table,
+            link=DBLink._meta.db_table,
+            placeholders=", ".join(["%s"] * len(ids)),
+            recursionLimit="LIMIT %s" if limitsRecursion else "",
+        )
+        params = ids + [depth] + ([reachLimit] if limitsRecursion else []) + [reachLimit, reachLimit, maxNodeCount, maxNodeCount, depth, titlesOnly, reachLimit]
+        return (sql, params)
+
+    # Numbers the non-deleted links of each of the given nodes by their IDs
+    # and returns the ones up to the given row number, ordered by source and ID.
+    def _firstChildrenPagesQuery(self, idCount):
+        return """
+            SELECT id, from_node_id, to_node_id, type, child_number FROM (
+                SELECT l.id, l.from_node_id, l.to_node_id, l.type,
+                    ROW_NUMBER() OVER (PARTITION BY l.from_node_id ORDER BY l.id) AS child_number
+                FROM {link} l
+                WHERE l.from_node_id IN ({placeholders}) AND NOT l.deleted
+            ) numbered
+            WHERE child_number <= %s
+            ORDER BY from_node_id, id
+        """.format(
+            link=DBLink._meta.db_table,
+            placeholders=", ".join(["%s"] * idCount),
+        )
+
+    # Nodes without content must not be stored in the cache.
+    def _storeLevelInCache(self, nodesById, childrenByParentId, generation, withoutContent):
+        if self.graphCache is not None:
+            if not withoutContent:
+                self.graphCache.storeNodes(nodesById.values(), generation)
+            self.graphCache.storeChildren(childrenByParentId, generation)
+        return (nodesById, childrenByParentId)
+
+    # Bumps the revision and appends the changed nodes and links
+    # (as pairs of integers) to the change log.
+    # Must be called in the same transaction as the change,
+    # so that no client sees the new revision together with the old data.
+    # Updating the revision locks its row until the transaction ends,
+    # so the sequence numbers of the changes are assigned in commit order
+    # and a client never misses a change that commits after it read the log.
+    def _recordChanges(self, nodeIds=(), linkKeys=()):
+        GraphRevision.increment()
+        changes = [Change(node_id=id) for id in nodeIds]
+        changes += [Change(node_id=sourceId, target_id=targetId) for (sourceId, targetId) in linkKeys]
+        Change.objects.bulk_create(changes)
+        if self.changeHub is not None:
+            transaction.on_commit(self.changeHub.publish)
 
+    # Returns the sequence number of the last change, or 0 if nothing has changed yet.
+    def getLastChangeNumber(self):
+        return Change.objects.order_by("-id").values_list("id", flat=True).first() or 0
+
+    # Returns the changes after the sequence number `cursor` as a tuple
+    # (lastSequenceNumber, changedNodeIds, parentIdsOfChangedLinks, hasMore, reset),
+    # where the IDs are strings. At most `limit` changes are read;
+    # if there are more, `hasMore` is set. If they include a reset marker
+    # (see Change), `reset` is set and only the changes after it are returned.
+    def getChangesSince(self, cursor, limit):
+        rows = list(Change.objects
+            .filter(id__gt=cursor)
+            .order_by("id")
+            .values_list("id", "node_id", "target_id", "reset")[:limit + 1])
+        hasMore = len(rows) > limit
+        rows = rows[:limit]
+
+        nodeIds = set()
+        parentIds = set()
+        reset = False
+        for (_, nodeId, targetId, isReset) in rows:
+            if isReset:
+                nodeIds = set()
+                parentIds = set()
+                reset = True
+            elif targetId is None:
+                nodeIds.add(str(nodeId))
+            else:
+                parentIds.add(str(nodeId))
+        lastSequenceNumber = rows[-1][0] if len(rows) > 0 else cursor
+        return (lastSequenceNumber, nodeIds, parentIds, hasMore, reset)
+
+    def _cacheGeneration(self):
+        return self.graphCache.generation() if self.graphCache is not None else None
+
+    # Invalidates the affected cache entries right away (so that this
+    # transaction reads its own writes) and once more after the commit
+    # (so that concurrent readers cannot cache the data from before the commit).
+    def _invalidateCache(self, nodeIds=(), childrenOfIds=()):
+        graphCaches = [c for c in [self.graphCache, self._outerGraphCache] if c is not None]
+        if len(graphCaches) == 0:
+            return
+
+        def invalidate():
+            for graphCache in graphCaches:
+                for id in nodeIds:
+                    graphCache.invalidateNode(str(id))
+                for id in childrenOfIds:
+                    graphCache.invalidateChildren(str(id))
+
+        invalidate()
+        transaction.on_commit(invalidate)
+
+    def _graphIndexes(self):
+        return [i for i in [self.graphIndex, self._outerGraphIndex] if i is not None]
+
+    # `keys` are pairs of integers (sourceId, targetId)
+    def _linkIdsToQuery(self, keys):
+        condition = Q()
+        for (sourceId, targetId) in keys:
+            condition |= Q(from_node_id=sourceId, to_node_id=targetId)
+        return DBLink.objects.filter(condition)
+
+    # The database only contains data that has been validated
+    # before it was written, so it is not validated again.
     def _toDomainNode(self, dbNode: DBNode) -> Node:
-        return Node.create({
-            "id": str(dbNode.id),
+        return self._rowToDomainNode(dbNode.id, dbNode.title, dbNode.content, dbNode.node_type)
+
+    def _rowToDomainNode(self, id, title, content, type) -> Node:
+        return Node.createTrusted({
+            "id": str(id),
             "data": {
-                "title": dbNode.title,
-                "content": dbNode.content,
-                "type": dbNode.node_type,
+                "title": title,
+                "content": content,
+                "type": type,
             },
         })
 
-    def _toDomainLink(self, dbLink: DBLink) -> Link:
-        return Link.create({
-            "id": str(dbLink.id),
-            "sourceId": str(dbLink.from_node_id),
-            "targetId": str(dbLink.to_node_id),
-            "type": dbLink.type,
+    def _rowToDomainLink(self, sourceId, targetId, type) -> Link:
+        return Link.createTrusted({
+            "sourceId": str(sourceId),
+            "targetId": str(targetId),
+            "type": type,
         })
 
+# Makes a NodeRepository usable from async code. Since the ORM is synchronous,
+# every call runs in a thread:
+# - Writes and `execute` run in the thread of the current request,
+#   so they share its database connection and transactions.
+# - So do the reads that are awaited on their own, e.g. `getRevision`.
+# - If `concurrentReads` is set, the reads that are meant to be awaited
+#   concurrently (with asyncio.gather), i.e. `get`, `getChildren` and `getSubgraph`,
+#   run in a thread pool, on connections of their own. Each of these connections
+#   is opened and closed again (unless CONN_MAX_AGE is set), so this only pays off
+#   for a fan-out of several reads. It requires that all connections see the same
+#   data, so the reads do not see uncommitted writes of the request.
+#   Otherwise, they run in the thread of the current request as well.
+# - Callers outside of Django's request cycle (see `outsideRequests`) have no
+#   request thread: asgiref would run all of them in its single global thread,
+#   on a single connection. If `concurrentReads` is set, their calls run in
+#   the thread pool as well.
+class AsyncNodeRepository:
+    def __init__(self, repository, concurrentReads=True, inRequests=True):
+        self.repository = repository
+        self.concurrentReads = concurrentReads
+        self.inRequests = inRequests
+
+    # Returns a repository for long-lived callers that are not
+    # Django requests, e.g. the event streams of events.py.
+    def outsideRequests(self):
+        return AsyncNodeRepository(self.repository, self.concurrentReads, False)
+
+    # Runs `execute(cmd, repository)`, e.g. executeLinkCommand,
+    # in the thread of the current request, after validating the graph cache
+    # with the graph revision `revision` (which is read if it is None).
+    async def execute(self, execute, cmd, revision=None):
+        def validateAndExecute():
+            self.repository.validateCache(revision)
+            return execute(cmd, self.repository)
+        return await self._inRequestThread(validateAndExecute)
+
+    async def validateCache(self):
+        return await self._inRequestThread(self.repository.validateCache)
+
+    async def get(self, ids):
+        return await self._read(self.repository.get, ids)
+
+    async def getChildren(self, ids):
+        return await self._read(self.repository.getChildren, ids)
+
+    async def getSubgraph(self, ids, depth, maxNodeCount, titlesOnly=False):
+        return await self._read(self.repository.getSubgraph, ids, depth, maxNodeCount, titlesOnly)
+
+    async def getAncestors(self, id):
+        return await self._inRequestThread(self.repository.getAncestors, id)
+
+    async def isReachable(self, sourceId, targetId):
+        return await self._inRequestThread(self.repository.isReachable, sourceId, targetId)
+
+    async def getRevision(self):
+        return await self._inRequestThread(self.repository.getRevision)
+
+    async def getChangesSince(self, cursor, limit):
+        return await self._inRequestThread(self.repository.getChangesSince, cursor, limit)
+
+    async def getLastChangeNumber(self):
+        return await self._inRequestThread(self.repository.getLastChangeNumber)
+
+    async def create(self, data):
+        return await self._inRequestThread(self.repository.create, data)
+
+    async def createMany(self, dataList, links=(), parentLinks=()):
+        return await self._inRequestThread(self.repository.createMany, dataList, links, parentLinks)
+
+    async def update(self, id, data):
+        return await self._inRequestThread(self.repository.update, id, data)
+
+    async def linkMany(self, links):
+        return await self._inRequestThread(self.repository.linkMany, links)
+
+    async def unlinkMany(self, linkIDs):
+        return await self._inRequestThread(self.repository.unlinkMany, linkIDs)
+
+    async def move(self, oldLinkIDs, newLinks):
+        return await self._inRequestThread(self.repository.move, oldLinkIDs, newLinks)
+
+    async def _read(self, method, *args):
+        if not self.concurrentReads:
+            return await self._inRequestThread(method, *args)
+        return await self._inPoolThread(method, *args)
+
+    async def _inRequestThread(self, method, *args):
+        if not self.inRequests and self.concurrentReads:
+            return await self._inPoolThread(method, *args)
+        return await sync_to_async(runMeasured, thread_sensitive=True)(method, *args)
+
+    async def _inPoolThread(self, method, *args):
+        return await sync_to_async(runInPoolThread, thread_sensitive=False)(method, *args)
+
+def runMeasured(method, *args):
+    with measuringQueries():
+        return method(*args)
+
+# Pool threads are not managed by Django's request cycle,
+# so their connections are closed the way it would close them
+# at the end of a request.
+def runInPoolThread(method, *args):
+    try:
+        return runMeasured(method, *args)
+    finally:
+        connection.close_if_unusable_or_obsolete()
+
 class NodeNotFoundException(Exception):
     pass
+
+def withoutContent(node):
+    return {
+        "id": node["id"],
+        "data": {
+            "title": node["data"]["title"],
+            "content": "",
+            "type": node["data"]["type"],
+        },
+    }
+
+# Computes which nodes NodeRepository.iterSubgraph returns
+# from the lookup function `getChildIds`, which takes an (integer) node ID
+# and returns the IDs of its children, or None if it does not know them.
+# Returns None as soon as a lookup fails, otherwise a pair (levels, boundLevel),
+# where `levels` is the list of the (sorted) node IDs on each level
+# and the children of the nodes on `boundLevel` and below are not part of the subgraph.
+def planSubgraph(ids, depth, maxNodeCount, getChildIds):
+    levels = []
+    visited = set(int(id) for id in ids)
+    idsOnLevel = sorted(visited)
+    levelCount = 0
+    while len(idsOnLevel) > 0:
+        levels.append(idsOnLevel)
+        levelCount += len(idsOnLevel)
+        # the nodes on the following levels would not be picked
+        if len(levels) > depth or levelCount >= maxNodeCount:
+            break
+
+        idsOnNextLevel = set()
+        for id in idsOnLevel:
+            childIds = getChildIds(id)
+            if childIds is None:
+                return None
+            for childId in childIds:
+                if childId not in visited:
+                    visited.add(childId)
+                    idsOnNextLevel.add(childId)
+        idsOnLevel = sorted(idsOnNextLevel)
+
+    pickedLevels = []
+    nodeCount = 0
+    for idsOnLevel in levels:
+        pickedLevels.append(idsOnLevel[0:maxNodeCount - nodeCount])
+        nodeCount += len(pickedLevels[-1])
+        if nodeCount >= maxNodeCount:
+            break
+    boundLevel = len(pickedLevels) - 1 if nodeCount >= maxNodeCount else depth
+
+    return (pickedLevels, boundLevel)
+
+# Computes the same levels as NodeRepository.iterSubgraph
+# from the lookup functions `getNode` and `getChildren`,
+# which take a node ID (as a string) and return None if they do not know the answer.
+# Returns None as soon as a lookup fails.
+def walkSubgraph(ids, depth, maxNodeCount, getNode, getChildren):
+    def getChildIds(id):
+        children = getChildren(str(id))
+        return [int(link["targetId"]) for link in children] if children is not None else None
+
+    plan = planSubgraph(ids, depth, maxNodeCount, getChildIds)
+    if plan is None:
+        return None
+    (pickedLevels, boundLevel) = plan
+
+    result = []
+    for (level, idsOnLevel) in enumerate(pickedLevels):
+        nodesById = {}
+        childrenByParentId = {}
+        for id in idsOnLevel:
+            node = getNode(str(id))
+            if node is None:
+                return None
+            nodesById[str(id)] = node
+            if level < boundLevel:
+                childrenByParentId[str(id)] = getChildren(str(id))
+        result.append((nodesById, childrenByParentId))
+
+    return result
@@ -0,0 +1,139 @@
+import json
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from .models import Node as DBNode, Link as DBLink, GraphRevision, Change
+from .domain.objects import NodeType, LinkType
+from .validation import ValidationException
+from .closure import rebuildClosure
+
+#
+# Snapshots of all nodes and links in a line-delimited JSON format,
+# which can be written and read with bounded memory:
+#
+#   {"format": "xtreem-snapshot", "version": 1}
+#   ["n", id, title, content, type]             (one line per node)
+#   ["l", id, sourceId, targetId, type, deleted] (one line per link)
+#
+# All nodes come before all links.
+# The change log, the graph revision and the closure table
+# are not part of a snapshot; the closure table is rebuilt on import,
+# and a reset marker is appended to the change log.
+#
+
+HEADER = {"format": "xtreem-snapshot", "version": 1}
+
+class SnapshotException(Exception):
+    pass
+
+# Writes all nodes and links to the text file `f`.
+# Returns the pair (nodeCount, linkCount).
+def exportSnapshot(f, chunkSize=10000):
+    f.write(json.dumps(HEADER) + "\n")
+    nodeCount = 0
+    for (id, title, content, type) in DBNode.objects.order_by("id").values_list("id", "title", "content", "node_type").iterator(chunk_size=chunkSize):
+        f.write(json.dumps(["n", id, title, content, type]) + "\n")
+        nodeCount += 1
+    linkCount = 0
+    for (id, sourceId, targetId, type, deleted) in DBLink.objects.order_by("id").values_list("id", "from_node_id", "to_node_id", "type", "deleted").iterator(chunk_size=chunkSize):
+        f.write(json.dumps(["l", id, sourceId, targetId, type, deleted]) + "\n")
+        linkCount += 1
+    return (nodeCount, linkCount)
+
+# Reads a snapshot from the text file `f` into the database, which
+# must not contain any nodes unless `replace` is set, in which case
+# all nodes and links are deleted first. The rows are inserted in chunks
+# of `chunkSize` within one transaction, so a failed import changes nothing.
+# If `deferIndexes` is set, the indexes of the links (see Link.Meta) are
+# dropped during the import and created again afterwards, which is much
+# faster than updating them for every chunk. Schema changes are not possible
+# within a transaction on every backend, so this happens outside of it.
+# Returns the pair (nodeCount, linkCount).
+#
+# Processes that keep a GraphCache or a GraphIndex see the reset marker
+# in the change log and drop them (see NodeRepository.validateCache).
+def importSnapshot(f, chunkSize=10000, replace=False, deferIndexes=True):
+    lines = iter(f)
+    try:
+        header = json.loads(next(lines))
+    except (StopIteration, ValueError):
+        raise SnapshotException("line 1: missing header")
+    if header != HEADER:
+        raise SnapshotException("line 1: unsupported snapshot format " + json.dumps(header))
+
+    # checked before the indexes are dropped (and again in the transaction)
+    if not replace and DBNode.objects.exists():
+        raise SnapshotException("the database already contains nodes")
+
+    if deferIndexes:
+        with connection.schema_editor() as editor:
+            for index in DBLink._meta.indexes:
+                editor.remove_index(DBLink, index)
+    try:
+        with transaction.atomic():
+            if DBNode.objects.exists():
+                if not replace:
+                    raise SnapshotException("the database already contains nodes")
+                # without the deletion collector, which would load every row
+                DBLink.objects.all()._raw_delete(DBLink.objects.db)
+                DBNode.objects.all()._raw_delete(DBNode.objects.db)
+
+            counts = insertRows(enumerate(lines, start=2), chunkSize)
+            rebuildClosure()
+
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), [DBNode, DBLink]):
+                    cursor.execute(sql)
+            GraphRevision.increment()
+            Change.recordReset()
+    finally:
+        if deferIndexes:
+            with connection.schema_editor() as editor:
+                for index in DBLink._meta.indexes:
+                    editor.add_index(DBLink, index)
+
+    return counts
+
+# `numberedLines` are pairs (line number, line). Only one chunk of rows
+# is kept in memory; the nodes are all inserted before the first link.
+def insertRows(numberedLines, chunkSize):
+    nodes = []
+    links = []
+    nodeCount = 0
+    linkCount = 0
+    for (lineNumber, line) in numberedLines:
+        if line.strip() == "":
+            continue
+        try:
+            row = json.loads(line)
+            if row[0] == "n" and len(row) == 5:
+                if linkCount > 0 or len(links) > 0:
+                    raise SnapshotException("line %d: nodes must come before links" % lineNumber)
+                (_, id, title, content, type) = row
+                nodes.append(DBNode(id=int(id), title=checkString(title), content=checkString(content), node_type=NodeType.create(type)))
+            elif row[0] == "l" and len(row) == 6:
+                (_, id, sourceId, targetId, type, deleted) = row
+                links.append(DBLink(id=int(id), from_node_id=int(sourceId), to_node_id=int(targetId), type=LinkType.create(type), deleted=bool(deleted)))
+            else:
+                raise SnapshotException("line %d: invalid row" % lineNumber)
+        except (ValueError, TypeError, IndexError, KeyError, ValidationException) as e:
+            raise SnapshotException("line %d: invalid row (%s)" % (lineNumber, e))
+
+        if len(nodes) >= chunkSize or (len(nodes) > 0 and len(links) > 0):
+            DBNode.objects.bulk_create(nodes)
+            nodeCount += len(nodes)
+            nodes = []
+        if len(links) >= chunkSize:
+            DBLink.objects.bulk_create(links)
+            linkCount += len(links)
+            links = []
+
+    DBNode.objects.bulk_create(nodes)
+    DBLink.objects.bulk_create(links)
+    return (nodeCount + len(nodes), linkCount + len(links))
+
+def checkString(value):
+    if not isinstance(value, str):
+        raise ValidationException("expected a string")
+    return value
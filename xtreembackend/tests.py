@@ -1,12 +1,43 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import os
+import random
+import unittest
+from unittest import mock
+from urllib.parse import urlencode
 
-from .repositories import NodeRepository
-from .api import CreateNodeCommand, GetNodesCommand, LinkCommand, executeCreateNodeCommand, executeGetNodesCommand, executeLinkCommand
-from .domain.objects import Node, NodeData, NodeType, Link, LinkType
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from . import views
+
+from .repositories import AsyncNodeRepository, NodeRepository, NodeNotFoundException
+from .models import Node as DBNode, Link as DBLink, Change, Closure, GraphRevision
+from .closure import CycleException
+from .benchmarks import GraphBuilder, clearViewCaches, runBenchmarks
+from .snapshots import SnapshotException, exportSnapshot, importSnapshot
+from . import events
+from .events import EVENTS_PATH, eventsApplication
+from .metrics import metricsRegistry
+from .graphcache import GraphCache
+from .graphindex import GraphIndex
+from . import compression
+from .compression import chooseContentEncoding
+from .api import CloneSubtreeCommand, CreateNodeCommand, GetChangesSinceCommand, GetChildrenPageCommand, GetNodesCommand, LinkCommand, MoveCommand, executeCloneSubtreeCommand, executeCreateNodeCommand, executeGetChangesSinceCommand, executeGetChangesSinceCommandAsync, executeGetChildrenPageCommand, executeGetNodesCommand, executeLinkCommand, executeMoveCommand
+from .domain.objects import Node, NodeData, NodeType, Link, LinkID, LinkType
 from .domain.cache import Cache
-from .dataspecs import MapDataType, ListDataType, IntDataType, StringDataType
+from .dataspecs import MapDataType, ListDataType, IntDataType, StringDataType, TaggedUnionDataType
 from .validation import ValidationException
 
+# The data of a TestCase is never committed, so the views
+# must not read it on other connections.
+views.asyncNodeRepository.concurrentReads = False
+
 class DataSpecTestCase(TestCase):
     def test_map(self):
         ismap = MapDataType(IntDataType, StringDataType)
@@ -23,6 +54,39 @@ class DataSpecTestCase(TestCase):
         self.assertEqual(len(serialized), 1)
         self.assertEqual(serialized[0], 1)
 
+    def test_aggregate_errors(self):
+        with self.assertRaisesMessage(ValidationException, "field type is missing"):
+            NodeData.create({"title": 1, "content": ""})
+
+        try:
+            NodeData.create({"title": 1, "content": "", "type": {}})
+            self.fail("NodeData.create should throw a ValidationException")
+        except ValidationException as e:
+            (error,) = e.args
+            self.assertEqual(error["message"], "AggregateDataType: could not parse fields")
+            self.assertEqual(set(error["innerErrors"].keys()), {"title", "type"})
+
+        with self.assertRaisesMessage(ValidationException, "consistency check failed"):
+            NodeData.create({"title": "x" * 141, "content": "", "type": "general"})
+
+    def test_serialize_copies_data(self):
+        node = Node.create({"id": "1", "data": {"title": "One", "content": "", "type": "general"}})
+        serialized = Node.serialize(node)
+        serialized["data"]["title"] = "Two"
+
+        self.assertEqual(node["data"]["title"], "One")
+        self.assertEqual(Node.serialize(Node.createTrusted(node)), {"id": "1", "data": {"title": "One", "content": "", "type": "general"}})
+
+    def test_tagged_union(self):
+        union = TaggedUnionDataType({"int": IntDataType, "node": Node})
+        node = {"id": "1", "data": {"title": "One", "content": "", "type": "general"}}
+        self.assertEqual(union.create({"type": "int", "value": 1}), {"type": "int", "value": 1})
+        self.assertEqual(union.serialize(union.create({"type": "node", "value": node})), {"type": "node", "value": node})
+
+        for data in [{"type": "int", "value": "1"}, {"type": "string", "value": "1"}, {"type": "int"}, [], {"type": [], "value": 1}]:
+            with self.assertRaises(ValidationException):
+                union.create(data)
+
 class LinkCommandTestCase(TestCase):
     def test_empty_list(self):
         repo = NodeRepository()
@@ -180,6 +244,182 @@ class LinkCommandTestCase(TestCase):
                 ],
             })        
 
+class BulkLinkTestCase(TestCase):
+    def createNodes(self, repo, count):
+        return [repo.create(NodeData.create({"title": str(i), "content": "", "type": "general"})) for i in range(count)]
+
+    def test_link_many(self):
+        repo = NodeRepository()
+        (root, *children) = self.createNodes(repo, 51)
+        repo.link(Link.create({"sourceId": root["id"], "targetId": children[0]["id"], "type": "general"}))
+        repo.unlink(LinkID.create({"sourceId": root["id"], "targetId": children[0]["id"]}))
+
+        links = [{"sourceId": root["id"], "targetId": child["id"], "type": "general"} for child in children]
+        links.append({"sourceId": root["id"], "targetId": children[1]["id"], "type": "pro_arg"})
+        with self.assertNumQueries(10):
+            executeLinkCommand(LinkCommand.create({"links": links}), repo)
+
+        linksToChildren = repo.getChildren([root["id"]])[root["id"]]
+        self.assertEqual(len(linksToChildren), 50)
+        self.assertEqual([l["type"] for l in linksToChildren if l["targetId"] == children[1]["id"]], ["pro_arg"])
+
+    def test_unlink_many(self):
+        repo = NodeRepository()
+        (root, *children) = self.createNodes(repo, 4)
+        repo.linkMany([Link.create({"sourceId": root["id"], "targetId": child["id"], "type": "general"}) for child in children])
+
+        with self.assertNumQueries(10):
+            repo.unlinkMany([
+                LinkID.create({"sourceId": root["id"], "targetId": children[0]["id"]}),
+                LinkID.create({"sourceId": root["id"], "targetId": children[2]["id"]}),
+                LinkID.create({"sourceId": children[0]["id"], "targetId": children[1]["id"]}),
+            ])
+
+        linksToChildren = repo.getChildren([root["id"]])[root["id"]]
+        self.assertEqual([l["targetId"] for l in linksToChildren], [children[1]["id"]])
+
+    def test_link_to_missing_node(self):
+        repo = NodeRepository()
+        (root,) = self.createNodes(repo, 1)
+
+        with self.assertRaises(NodeNotFoundException):
+            repo.link(Link.create({"sourceId": root["id"], "targetId": "1000", "type": "general"}))
+
+class ClosureTestCase(TestCase):
+    def setUp(self):
+        clearViewCaches()
+
+    def test_incremental_updates(self):
+        repo = NodeRepository()
+        ids = [repo.create(NodeData.create({"title": str(i), "content": "", "type": "general"}))["id"] for i in range(12)]
+        randomness = random.Random(0)
+        for _ in range(30):
+            keys = [tuple(randomness.sample(ids, 2)) for _ in range(randomness.randint(1, 4))]
+            if randomness.random() < 0.6:
+                try:
+                    repo.linkMany([Link.create({"sourceId": sourceId, "targetId": targetId, "type": "general"}) for (sourceId, targetId) in keys])
+                except CycleException:
+                    pass
+            else:
+                # mostly links that exist
+                liveKeys = list(DBLink.objects.filter(deleted=False).values_list("from_node_id", "to_node_id"))
+                keys += randomness.sample(liveKeys, min(3, len(liveKeys)))
+                repo.unlinkMany([LinkID.create({"sourceId": str(sourceId), "targetId": str(targetId)}) for (sourceId, targetId) in keys])
+
+            self.assertEqual(set(Closure.objects.values_list("ancestor_id", "descendant_id")), self.reachablePairs())
+
+    def test_rebuild(self):
+        builder = GraphBuilder()
+        ids = [builder.node(str(i)) for i in range(6)]
+        for (sourceId, targetId) in [(0, 1), (1, 2), (2, 0), (2, 3), (0, 3), (3, 4)]:
+            builder.link(ids[sourceId], ids[targetId])
+        builder.link(ids[4], ids[5], deleted=True)
+        builder.save()
+        pairs = set(Closure.objects.values_list("ancestor_id", "descendant_id"))
+        self.assertEqual(pairs, self.reachablePairs())
+        self.assertIn((ids[1], ids[4]), pairs)
+        self.assertNotIn((ids[4], ids[5]), pairs)
+
+    # Returns the pairs of distinct nodes connected by the links that are not deleted.
+    def reachablePairs(self):
+        childIds = {}
+        for (sourceId, targetId) in DBLink.objects.filter(deleted=False).values_list("from_node_id", "to_node_id"):
+            childIds.setdefault(sourceId, []).append(targetId)
+        pairs = set()
+        for ancestorId in childIds:
+            stack = [ancestorId]
+            reached = set()
+            while len(stack) > 0:
+                for childId in childIds.get(stack.pop(), []):
+                    if childId not in reached:
+                        reached.add(childId)
+                        stack.append(childId)
+            pairs |= set((ancestorId, descendantId) for descendantId in reached if descendantId != ancestorId)
+        return pairs
+
+    def test_ancestors(self):
+        repo = views.nodeRepository
+        (root, a, b, c, other) = [repo.create(NodeData.create({"title": title, "content": "", "type": "general"})) for title in ["root", "a", "b", "c", "other"]]
+        repo.linkMany([
+            Link.create({"sourceId": root["id"], "targetId": a["id"], "type": "general"}),
+            Link.create({"sourceId": root["id"], "targetId": b["id"], "type": "general"}),
+            Link.create({"sourceId": a["id"], "targetId": c["id"], "type": "general"}),
+            Link.create({"sourceId": b["id"], "targetId": c["id"], "type": "general"}),
+            Link.create({"sourceId": c["id"], "targetId": other["id"], "type": "general"}),
+        ])
+
+        response = self.client.get("/api/nodes/ancestors", {"command": json.dumps({"id": c["id"]})})
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content)
+        self.assertEqual(set(result["nodesById"].keys()), {root["id"], a["id"], b["id"], c["id"]})
+        self.assertEqual(result["parentIdsById"], {root["id"]: [], a["id"]: [root["id"]], b["id"]: [root["id"]], c["id"]: [a["id"], b["id"]]})
+        response = self.client.get("/api/nodes/ancestors", {"command": json.dumps({"id": str(int(other["id"]) + 1)})})
+        self.assertEqual(response.status_code, 404)
+
+        isReachable = lambda sourceId, targetId: json.loads(self.client.get("/api/nodes/reachable", {"command": json.dumps({"sourceId": sourceId, "targetId": targetId})}).content)["reachable"]
+        self.assertTrue(isReachable(root["id"], other["id"]))
+        self.assertFalse(isReachable(other["id"], root["id"]))
+
+        repo.unlink(LinkID.create({"sourceId": a["id"], "targetId": c["id"]}))
+        self.assertTrue(isReachable(root["id"], other["id"]))
+        self.assertFalse(isReachable(a["id"], other["id"]))
+
+class CycleTestCase(TestCase):
+    def setUp(self):
+        clearViewCaches()
+
+    def test_links_that_close_cycles(self):
+        repo = views.nodeRepository
+        (a, b, c) = [repo.create(NodeData.create({"title": title, "content": "", "type": "general"}))["id"] for title in ["a", "b", "c"]]
+        link = lambda sourceId, targetId: {"sourceId": sourceId, "targetId": targetId, "type": "general"}
+        repo.linkMany([Link.create(link(a, b)), Link.create(link(b, c))])
+
+        for links in [[link(a, a)], [link(c, a)], [link(a, c), link(c, b)]]:
+            with self.assertRaises(CycleException):
+                executeLinkCommand(LinkCommand.create({"links": links}), repo)
+        self.assertEqual(set(DBLink.objects.filter(deleted=False).values_list("from_node_id", "to_node_id")), {(int(a), int(b)), (int(b), int(c))})
+
+        response = self.client.post("/api/links/add", json.dumps({"links": [link(c, a)]}), content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+        # a link can be turned around by moving it
+        executeMoveCommand(MoveCommand.create({"oldLinks": [{"sourceId": b, "targetId": c}], "newLinks": [link(c, b)]}), repo)
+        self.assertTrue(repo.isReachable(c, b))
+        self.assertFalse(repo.isReachable(b, c))
+        # restoring a deleted link is checked, too
+        with self.assertRaises(CycleException):
+            repo.link(Link.create(link(b, c)))
+
+class MoveCommandTestCase(TestCase):
+    def test_move(self):
+        repo = NodeRepository()
+        (oldParent, newParent, child) = [repo.create(NodeData.create({"title": title, "content": "", "type": "general"})) for title in ["old", "new", "child"]]
+        repo.link(Link.create({"sourceId": oldParent["id"], "targetId": child["id"], "type": "general"}))
+
+        cmd = MoveCommand.create({
+            "oldLinks": [{"sourceId": oldParent["id"], "targetId": child["id"]}],
+            "newLinks": [{"sourceId": newParent["id"], "targetId": child["id"], "type": "pro_arg"}],
+        })
+        executeMoveCommand(cmd, repo)
+
+        children = repo.getChildren([oldParent["id"], newParent["id"]])
+        self.assertEqual(children[oldParent["id"]], [])
+        self.assertEqual(children[newParent["id"]], [{"sourceId": newParent["id"], "targetId": child["id"], "type": "pro_arg"}])
+
+    def test_failed_move_changes_nothing(self):
+        repo = NodeRepository()
+        (parent, child) = [repo.create(NodeData.create({"title": title, "content": "", "type": "general"})) for title in ["parent", "child"]]
+        repo.link(Link.create({"sourceId": parent["id"], "targetId": child["id"], "type": "general"}))
+
+        cmd = MoveCommand.create({
+            "oldLinks": [{"sourceId": parent["id"], "targetId": child["id"]}],
+            "newLinks": [{"sourceId": "1000", "targetId": child["id"], "type": "general"}],
+        })
+        with self.assertRaises(NodeNotFoundException):
+            executeMoveCommand(cmd, repo)
+
+        self.assertEqual(len(repo.getChildren([parent["id"]])[parent["id"]]), 1)
+
 class CreateNodeTestCase(TestCase):
     def test(self):
         repo = NodeRepository()
@@ -213,6 +453,1024 @@ class CreateNodeTestCase(TestCase):
         self.assertListEqual([Cache.getChildrenOf(cache, 1)[0]["targetId"]], [2], "Node 2 is a child of node 1")
         self.assertFalse(Cache.hasChildrenOf(cache, 2), "The children of node 2 are not in the cache")
 
+class CreateNodesTestCase(TestCase):
+    def setUp(self):
+        clearViewCaches()
+
+    def test_create_nodes(self):
+        parent = views.nodeRepository.create(NodeData.create({"title": "parent", "content": "", "type": "general"}))
+        nodeData = lambda title: {"title": title, "content": "Content of " + title, "type": "question"}
+        command = {"nodes": [
+            {"tempId": "a", "nodeData": nodeData("a"), "parentIds": [parent["id"]]},
+            {"tempId": "b", "nodeData": nodeData("b"), "parentTempIds": ["a"]},
+            {"tempId": "c", "nodeData": nodeData("c"), "parentIds": [parent["id"]], "parentTempIds": ["a", "b"]},
+        ]}
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/nodes/createMany", json.dumps(command), content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        idMap = json.loads(response.content)["idMap"]
+        self.assertEqual(set(idMap.keys()), {"a", "b", "c"})
+
+        cache = executeGetNodesCommand(GetNodesCommand.create({"ids": [parent["id"]], "depth": 3}), views.nodeRepository)
+        self.assertEqual(Cache.getNode(cache, idMap["b"])["data"], nodeData("b"))
+        childIds = lambda id: [link["targetId"] for link in cache["childrenByParentId"][id]]
+        self.assertEqual(childIds(parent["id"]), [idMap["a"], idMap["c"]])
+        self.assertEqual(childIds(idMap["a"]), [idMap["b"], idMap["c"]])
+        self.assertEqual(childIds(idMap["b"]), [idMap["c"]])
+
+    def test_invalid_commands(self):
+        nodeData = {"title": "node", "content": "", "type": "general"}
+        invalidCommands = [
+            {"nodes": [{"tempId": "a", "nodeData": nodeData}, {"tempId": "a", "nodeData": nodeData}]},
+            {"nodes": [{"tempId": "a", "nodeData": nodeData, "parentTempIds": ["b"]}, {"tempId": "b", "nodeData": nodeData}]},
+            {"nodes": [{"tempId": "a", "nodeData": nodeData, "parentTempIds": ["a"]}]},
+            {"nodes": [{"tempId": "a", "nodeData": dict(nodeData, type="unknown")}]},
+        ]
+        for command in invalidCommands:
+            response = self.client.post("/api/nodes/createMany", json.dumps(command), content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(DBNode.objects.count(), 0)
+
+    def test_missing_parent(self):
+        parent = views.nodeRepository.create(NodeData.create({"title": "parent", "content": "", "type": "general"}))
+        command = {"nodes": [{"tempId": "a", "nodeData": {"title": "a", "content": "", "type": "general"}, "parentIds": [str(int(parent["id"]) + 1)]}]}
+        response = self.client.post("/api/nodes/createMany", json.dumps(command), content_type="application/json")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(DBNode.objects.count(), 1)
+
+class MissingNodesTestCase(TestCase):
+    def setUp(self):
+        clearViewCaches()
+
+    def post(self, path, command):
+        return self.client.post(path, json.dumps(command), content_type="application/json")
+
+    def test_write_views(self):
+        node = views.nodeRepository.create(NodeData.create({"title": "node", "content": "", "type": "general"}))
+        missingId = str(int(node["id"]) + 1000)
+        link = {"sourceId": node["id"], "targetId": missingId, "type": "general"}
+        nodeData = {"title": "new", "content": "", "type": "general"}
+
+        self.assertEqual(self.post("/api/nodes/create", {"nodeData": nodeData, "parentId": missingId}).status_code, 404)
+        self.assertEqual(self.post("/api/links/add", {"links": [link]}).status_code, 404)
+        self.assertEqual(self.post("/api/links/move", {"oldLinks": [], "newLinks": [link]}).status_code, 404)
+        self.assertEqual(self.post("/api/nodes/update", {"id": missingId, "title": "changed", "content": None}).status_code, 404)
+        for command in [{"type": "link", "value": {"links": [link]}}, {"type": "updateNode", "value": {"id": missingId, "title": "changed", "content": None}}]:
+            self.assertEqual(self.post("/api/batch", {"commands": [command]}).status_code, 404)
+
+        # in particular, the node without its parent is not created
+        self.assertEqual(DBNode.objects.count(), 1)
+
+class CloneSubtreeTestCase(TestCase):
+    def test_clone(self):
+        repo = NodeRepository(GraphCache(1000000), GraphIndex())
+        (root, a, b, c, below, target) = [repo.create(NodeData.create({"title": title, "content": "Content of " + title, "type": "idea"})) for title in ["root", "a", "b", "c", "below", "target"]]
+        repo.linkMany([
+            Link.create({"sourceId": root["id"], "targetId": a["id"], "type": "pro_arg"}),
+            Link.create({"sourceId": root["id"], "targetId": b["id"], "type": "general"}),
+            Link.create({"sourceId": a["id"], "targetId": c["id"], "type": "general"}),
+            Link.create({"sourceId": b["id"], "targetId": c["id"], "type": "general"}),
+            Link.create({"sourceId": c["id"], "targetId": below["id"], "type": "general"}),
+        ])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            result = executeCloneSubtreeCommand(CloneSubtreeCommand.create({"id": root["id"], "depth": 2, "parentId": target["id"]}), repo)
+        idMap = result["idMap"]
+        self.assertEqual(set(idMap.keys()), {root["id"], a["id"], b["id"], c["id"]})
+        self.assertEqual(result["node"]["id"], idMap[root["id"]])
+        self.assertEqual(result["node"]["data"], root["data"])
+
+        copy = executeGetNodesCommand(GetNodesCommand.create({"ids": [target["id"]], "depth": 4}), repo)
+        self.assertEqual(len(copy["nodesById"]), 5)
+        self.assertEqual(copy["childrenByParentId"][idMap[root["id"]]], [
+            {"sourceId": idMap[root["id"]], "targetId": idMap[a["id"]], "type": "pro_arg"},
+            {"sourceId": idMap[root["id"]], "targetId": idMap[b["id"]], "type": "general"},
+        ])
+        self.assertEqual([link["targetId"] for link in copy["childrenByParentId"][idMap[b["id"]]]], [idMap[c["id"]]])
+        # the children of the last level are not copied
+        self.assertEqual(copy["childrenByParentId"][idMap[c["id"]]], [])
+
+    def test_missing_nodes(self):
+        repo = NodeRepository()
+        node = repo.create(NodeData.create({"title": "node", "content": "", "type": "general"}))
+        with self.assertRaises(NodeNotFoundException):
+            executeCloneSubtreeCommand(CloneSubtreeCommand.create({"id": str(int(node["id"]) + 1), "depth": 1, "parentId": None}), repo)
+        with self.assertRaises(NodeNotFoundException):
+            executeCloneSubtreeCommand(CloneSubtreeCommand.create({"id": node["id"], "depth": 1, "parentId": str(int(node["id"]) + 1)}), repo)
+        self.assertEqual(DBNode.objects.count(), 1)
+
+        for command in [{"id": str(int(node["id"]) + 1), "depth": 1, "parentId": None}, {"id": node["id"], "depth": 1, "parentId": str(int(node["id"]) + 1)}]:
+            response = self.client.post("/api/nodes/clone", json.dumps(command), content_type="application/json")
+            self.assertEqual(response.status_code, 404)
+        self.assertEqual(DBNode.objects.count(), 1)
+
+class GetNodesTestCase(TestCase):
+    def createNode(self, repo, title):
+        return repo.create(NodeData.create({
+            "title": title,
+            "content": "Content of " + title,
+            "type": "general",
+        }))
+
+    def linkNodes(self, repo, parent, child):
+        repo.link(Link.create({
+            "sourceId": parent["id"],
+            "targetId": child["id"],
+            "type": "general",
+        }))
+
+    def test_depth_limit(self):
+        repo = NodeRepository()
+        nodes = [self.createNode(repo, "Node " + str(i)) for i in range(4)]
+        for i in range(3):
+            self.linkNodes(repo, nodes[i], nodes[i + 1])
+
+        cmd = GetNodesCommand.create({
+            "ids": [nodes[0]["id"]],
+            "depth": 2,
+        })
+        with self.assertNumQueries(1):
+            cache = executeGetNodesCommand(cmd, repo)
+
+        self.assertTrue(Cache.hasNode(cache, nodes[2]["id"]))
+        self.assertFalse(Cache.hasNode(cache, nodes[3]["id"]))
+        self.assertEqual(Cache.getNode(cache, nodes[0]["id"])["data"]["content"], "Content of Node 0")
+        self.assertEqual([l["targetId"] for l in Cache.getChildrenOf(cache, nodes[1]["id"])], [nodes[2]["id"]])
+        self.assertFalse(Cache.hasChildrenOf(cache, nodes[2]["id"]))
+
+    def test_shared_children_and_deleted_links(self):
+        repo = NodeRepository()
+        (root, left, right, shared, removed) = [self.createNode(repo, title) for title in ["root", "left", "right", "shared", "removed"]]
+        self.linkNodes(repo, root, left)
+        self.linkNodes(repo, root, right)
+        self.linkNodes(repo, left, shared)
+        self.linkNodes(repo, right, shared)
+        self.linkNodes(repo, root, removed)
+        repo.unlink(LinkID.create({"sourceId": root["id"], "targetId": removed["id"]}))
+
+        cmd = GetNodesCommand.create({
+            "ids": [root["id"]],
+            "depth": 3,
+        })
+        cache = executeGetNodesCommand(cmd, repo)
+
+        self.assertEqual(len(cache["nodesById"]), 4)
+        self.assertFalse(Cache.hasNode(cache, removed["id"]))
+        self.assertEqual(len(Cache.getChildrenOf(cache, root["id"])), 2)
+        self.assertEqual(Cache.getChildrenOf(cache, shared["id"]), [])
+
+    def test_cycle(self):
+        repo = NodeRepository()
+        (first, second) = [self.createNode(repo, title) for title in ["first", "second"]]
+        self.linkNodes(repo, first, second)
+        # links that close cycles are rejected, but may exist in older data
+        DBLink.objects.create(from_node_id=int(second["id"]), to_node_id=int(first["id"]))
+
+        cmd = GetNodesCommand.create({
+            "ids": [first["id"]],
+            "depth": 10,
+        })
+        cache = executeGetNodesCommand(cmd, repo)
+
+        self.assertEqual(len(cache["nodesById"]), 2)
+        self.assertEqual(Cache.getChildrenOf(cache, second["id"])[0]["targetId"], first["id"])
+
+    def test_titles_only(self):
+        for graphCache in [None, GraphCache(1000)]:
+            repo = NodeRepository(graphCache)
+            (parent, child) = [self.createNode(repo, title) for title in ["parent", "child"]]
+            self.linkNodes(repo, parent, child)
+
+            cmd = GetNodesCommand.create({
+                "ids": [parent["id"]],
+                "depth": 1,
+                "titlesOnly": True,
+            })
+            cache = executeGetNodesCommand(cmd, repo)
+
+            self.assertEqual(Cache.getNode(cache, parent["id"])["data"]["content"], "Content of parent")
+            self.assertEqual(Cache.getNode(cache, child["id"])["data"], {"title": "child", "content": "", "type": "general"})
+            self.assertEqual(repo.get([child["id"]])[child["id"]]["data"]["content"], "Content of child")
+
+    def test_node_limit(self):
+        repo = NodeRepository()
+        root = self.createNode(repo, "root")
+        children = [self.createNode(repo, "child " + str(i)) for i in range(3)]
+        for child in children:
+            self.linkNodes(repo, root, child)
+
+        (nodesById, childrenByParentId) = repo.getSubgraph([root["id"]], 2, 3)
+
+        self.assertEqual(len(nodesById), 3)
+        self.assertEqual(len(childrenByParentId[root["id"]]), 3)
+        self.assertEqual(set(childrenByParentId.keys()), {root["id"]})
+
+    def test_truncated_subtrees(self):
+        builder = GraphBuilder()
+        (root, first, second) = [builder.node(title) for title in ["root", "first", "second"]]
+        builder.link(root, first)
+        builder.link(root, second)
+        # shared by both parents, but counted once
+        shared = builder.node("shared")
+        builder.link(first, shared)
+        builder.link(second, shared)
+        for parent in [first, second]:
+            for i in range(1100):
+                builder.link(parent, builder.node(str(parent) + "." + str(i)))
+        builder.save()
+
+        repo = NodeRepository()
+        result = executeGetNodesCommand(GetNodesCommand.create({"ids": [str(first), str(second)], "depth": 1}), repo)
+        self.assertEqual(len(result["nodesById"]), 2000)
+        self.assertEqual(result["truncatedIds"], [str(second)])
+
+        result = executeGetNodesCommand(GetNodesCommand.create({"ids": [str(root)], "depth": 3}), repo)
+        self.assertEqual(len(result["nodesById"]), 2000)
+        self.assertIn(str(second), result["truncatedIds"])
+        # the nodes on the second level whose children were not fetched
+        self.assertEqual(len(result["truncatedIds"]), 1 + 2000 - 3)
+
+        result = executeGetNodesCommand(GetNodesCommand.create({"ids": [str(root)], "depth": 1}), repo)
+        self.assertEqual(result["truncatedIds"], [])
+
+    def test_query_without_limited_recursion(self):
+        builder = GraphBuilder()
+        root = builder.node("root")
+        for i in range(30):
+            child = builder.node("child " + str(i))
+            builder.link(root, child)
+            builder.link(child, builder.node("grandchild " + str(i)))
+        builder.save()
+
+        repo = NodeRepository()
+        expected = [repo.getSubgraph([str(root)], 2, maxNodeCount) for maxNodeCount in [100, 20]]
+        # the query for the backends that do not support a LIMIT in a recursive query
+        connection.vendor = "other"
+        try:
+            self.assertEqual([repo.getSubgraph([str(root)], 2, maxNodeCount) for maxNodeCount in [100, 20]], expected)
+        finally:
+            del connection.vendor
+        self.assertEqual(len(expected[1][0]), 20)
+
+    @unittest.skipUnless(connection.vendor == "sqlite", "counts SQLite instructions")
+    def test_work_bounded_by_node_limit(self):
+        # counts the instructions SQLite executes to get the subgraph of a root
+        # with 2100 children, below each of which hangs a path of `pathLength` nodes
+        def countInstructions(pathLength):
+            builder = GraphBuilder()
+            root = builder.node("root")
+            children = [builder.node("child " + str(i)) for i in range(2100)]
+            for child in children:
+                builder.link(root, child)
+                parent = child
+                for i in range(pathLength):
+                    node = builder.node(str(child) + "." + str(i))
+                    builder.link(parent, node)
+                    parent = node
+            builder.save()
+
+            counter = [0]
+            def count():
+                counter[0] += 1
+            connection.ensure_connection()
+            connection.connection.set_progress_handler(count, 100)
+            try:
+                with self.assertNumQueries(4):
+                    (nodesById, childrenByParentId) = NodeRepository().getSubgraph([str(root)], 10, 2000)
+            finally:
+                connection.connection.set_progress_handler(None, 100)
+
+            self.assertEqual(set(nodesById), {str(id) for id in [root] + children[:1999]})
+            self.assertEqual(set(childrenByParentId), {str(root)})
+            return counter[0]
+
+        small = countInstructions(1)
+        DBLink.objects.all().delete()
+        DBNode.objects.all().delete()
+        large = countInstructions(10)
+        self.assertLess(large, 1.5 * small)
+
+class ChildrenPageTestCase(TestCase):
+    def setUp(self):
+        clearViewCaches()
+        builder = GraphBuilder()
+        self.root = builder.node("root")
+        self.children = [builder.node("child " + str(i)) for i in range(5)]
+        self.grandchildren = [builder.node("grandchild " + str(i)) for i in range(5)]
+        for (i, child) in enumerate(self.children):
+            builder.links.append(DBLink(from_node_id=self.root, to_node_id=child, type=["pro_arg", "con_arg"][i % 2]))
+            builder.link(child, self.grandchildren[i])
+        builder.save()
+        DBLink.objects.filter(from_node_id=self.root, to_node_id=self.children[1]).update(deleted=True)
+
+    def getPages(self, orderBy, limit):
+        repo = NodeRepository()
+        pages = []
+        command = {"parentId": str(self.root), "orderBy": orderBy, "limit": limit}
+        while True:
+            page = executeGetChildrenPageCommand(GetChildrenPageCommand.create(command), repo)
+            pages.append([int(link["targetId"]) for link in page["children"]])
+            self.assertEqual(set(page["nodesById"].keys()), set(link["targetId"] for link in page["children"]))
+            if not page["cursor"].hasValue():
+                return pages
+            command["cursor"] = page["cursor"].extract()
+
+    def test_pages(self):
+        (c0, c1, c2, c3, c4) = self.children
+        self.assertEqual(self.getPages("id", 2), [[c0, c2], [c3, c4]])
+        self.assertEqual(self.getPages("id", 3), [[c0, c2, c3], [c4]])
+        self.assertEqual(self.getPages("type", 1), [[c3], [c0], [c2], [c4]])
+
+    def test_invalid_cursor(self):
+        for cursor in ["x", "pro_arg:1"]:
+            with self.assertRaises(ValidationException):
+                executeGetChildrenPageCommand(GetChildrenPageCommand.create({"parentId": str(self.root), "cursor": cursor, "limit": 1}), NodeRepository())
+        with self.assertRaises(ValidationException):
+            executeGetChildrenPageCommand(GetChildrenPageCommand.create({"parentId": str(self.root), "orderBy": "type", "cursor": "nonsense:1", "limit": 1}), NodeRepository())
+
+    def test_get_nodes_with_max_children(self):
+        (c0, c2, c3, c4) = [str(self.children[i]) for i in [0, 2, 3, 4]]
+        command = GetNodesCommand.create({"ids": [str(self.root)], "depth": 2, "maxChildren": 2})
+        with self.assertNumQueries(5):
+            result = executeGetNodesCommand(command, NodeRepository())
+
+        self.assertEqual([link["targetId"] for link in result["childrenByParentId"][str(self.root)]], [c0, c2])
+        self.assertEqual(set(result["nodesById"].keys()), set(str(id) for id in [self.root, self.children[0], self.children[2], self.grandchildren[0], self.grandchildren[2]]))
+        self.assertEqual(result["truncatedIds"], [])
+
+        page = executeGetChildrenPageCommand(GetChildrenPageCommand.create({"parentId": str(self.root), "cursor": result["childCursors"][str(self.root)], "limit": 10}), NodeRepository())
+        self.assertEqual([link["targetId"] for link in page["children"]], [c3, c4])
+
+        response = self.client.get("/api/nodes/get", {"command": json.dumps(GetNodesCommand.serialize(command))})
+        self.assertEqual(json.loads(response.content)["childCursors"], result["childCursors"])
+
+class GraphCacheTestCase(TestCase):
+    def createNode(self, repo, title):
+        return repo.create(NodeData.create({
+            "title": title,
+            "content": "",
+            "type": "general",
+        }))
+
+    def test_lru_eviction(self):
+        graphCache = GraphCache(2)
+        for id in ["1", "2", "3"]:
+            graphCache.storeNodes([{"id": id, "data": {"title": id, "content": "", "type": "general"}}], graphCache.generation())
+            graphCache.getNode("1")
+
+        self.assertIsNotNone(graphCache.getNode("1"))
+        self.assertIsNone(graphCache.getNode("2"))
+        self.assertIsNotNone(graphCache.getNode("3"))
+
+    def test_subgraph_is_served_from_cache(self):
+        repo = NodeRepository(GraphCache(1000))
+        (parent, child) = [self.createNode(repo, title) for title in ["parent", "child"]]
+        repo.link(Link.create({"sourceId": parent["id"], "targetId": child["id"], "type": "general"}))
+
+        cmd = GetNodesCommand.create({"ids": [parent["id"]], "depth": 1})
+        executeGetNodesCommand(cmd, repo)
+        with self.assertNumQueries(0):
+            cache = executeGetNodesCommand(cmd, repo)
+            repo.get([child["id"]])
+            repo.getChildren([parent["id"]])
+
+        self.assertTrue(Cache.hasNode(cache, child["id"]))
+
+    def test_writes_invalidate_cache(self):
+        repo = NodeRepository(GraphCache(1000))
+        (parent, child) = [self.createNode(repo, title) for title in ["parent", "child"]]
+        cmd = GetNodesCommand.create({"ids": [parent["id"]], "depth": 1})
+        executeGetNodesCommand(cmd, repo)
+
+        repo.link(Link.create({"sourceId": parent["id"], "targetId": child["id"], "type": "general"}))
+        repo.update(parent["id"], {"title": "new title", "content": "", "type": "general"})
+        cache = executeGetNodesCommand(cmd, repo)
+        self.assertEqual(Cache.getNode(cache, parent["id"])["data"]["title"], "new title")
+        self.assertEqual(len(Cache.getChildrenOf(cache, parent["id"])), 1)
+
+        repo.unlink(LinkID.create({"sourceId": parent["id"], "targetId": child["id"]}))
+        self.assertEqual(repo.getChildren([parent["id"]])[parent["id"]], [])
+
+    def test_writes_of_other_processes_drop_cache(self):
+        repo = NodeRepository(GraphCache(1000))
+        # writes through the repository of another process, which the cache does not see
+        otherRepo = NodeRepository()
+        node = self.createNode(repo, "node")
+        repo.validateCache()
+        repo.get([node["id"]])
+
+        otherRepo.update(node["id"], {"title": "new title", "content": "", "type": "general"})
+        self.assertEqual(repo.get([node["id"]])[node["id"]]["data"]["title"], "node")
+        repo.validateCache()
+        self.assertEqual(repo.get([node["id"]])[node["id"]]["data"]["title"], "new title")
+
+    def test_other_processes_only_drop_changed_entries(self):
+        repo = NodeRepository(GraphCache(1000))
+        otherRepo = NodeRepository()
+        (changed, unchanged) = [self.createNode(repo, title) for title in ["changed", "unchanged"]]
+        repo.validateCache()
+        repo.get([changed["id"], unchanged["id"]])
+        repo.getChildren([changed["id"], unchanged["id"]])
+
+        otherRepo.update(changed["id"], {"title": "new title", "content": "", "type": "general"})
+        otherRepo.link(Link.create({"sourceId": changed["id"], "targetId": unchanged["id"], "type": "general"}))
+        # the revision and the changes since the cache was filled
+        with self.assertNumQueries(2):
+            repo.validateCache()
+        with self.assertNumQueries(0):
+            self.assertEqual(repo.get([unchanged["id"]])[unchanged["id"]]["data"]["title"], "unchanged")
+            self.assertEqual(repo.getChildren([unchanged["id"]])[unchanged["id"]], [])
+        with self.assertNumQueries(2):
+            self.assertEqual(repo.get([changed["id"]])[changed["id"]]["data"]["title"], "new title")
+            self.assertEqual(len(repo.getChildren([changed["id"]])[changed["id"]]), 1)
+
+    def test_data_read_before_changes_is_not_stored(self):
+        graphCache = GraphCache(1000)
+        graphCache.reset(1, 10)
+        generation = graphCache.generation()
+        graphCache.applyChanges(2, 11, ["1"], [])
+        graphCache.storeNodes([{"id": "1", "data": {"title": "old", "content": "", "type": "general"}}], generation)
+        self.assertIsNone(graphCache.getNode("1"))
+        self.assertEqual(graphCache.revision(), (2, 11))
+
+        graphCache.storeNodes([{"id": "1", "data": {"title": "new", "content": "", "type": "general"}}], graphCache.generation())
+        self.assertEqual(graphCache.getNode("1")["data"]["title"], "new")
+        graphCache.reset(3, 20)
+        self.assertIsNone(graphCache.getNode("1"))
+
+class GraphIndexTestCase(TestCase):
+    def createNode(self, repo, title):
+        return repo.create(NodeData.create({"title": title, "content": "Content of " + title, "type": "general"}))
+
+    def test_subgraph_equals_query_result(self):
+        repo = NodeRepository()
+        nodes = [self.createNode(repo, str(i)) for i in range(6)]
+        repo.linkMany([
+            Link.create({"sourceId": nodes[source]["id"], "targetId": nodes[target]["id"], "type": "pro_arg"})
+            for (source, target) in [(0, 1), (0, 2), (1, 3), (2, 3), (3, 4), (4, 5)]
+        ])
+        # links that close cycles are rejected, but may exist in older data
+        DBLink.objects.create(from_node_id=int(nodes[3]["id"]), to_node_id=int(nodes[0]["id"]), type="pro_arg")
+        indexedRepo = NodeRepository(graphIndex=GraphIndex())
+        indexedRepo.graphIndex.ensureLoaded()
+
+        for (depth, maxNodeCount) in [(0, 2000), (3, 2000), (10, 2000), (10, 3)]:
+            expected = repo.getSubgraph([nodes[0]["id"]], depth, maxNodeCount)
+            with self.assertNumQueries(1):
+                self.assertEqual(indexedRepo.getSubgraph([nodes[0]["id"]], depth, maxNodeCount), expected)
+
+    def test_index_follows_writes(self):
+        graphIndex = GraphIndex(maxOverlaySize=1)
+        repo = NodeRepository(graphIndex=graphIndex)
+        nodes = [self.createNode(repo, str(i)) for i in range(3)]
+        graphIndex.ensureLoaded()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            repo.link(Link.create({"sourceId": nodes[0]["id"], "targetId": nodes[1]["id"], "type": "general"}))
+        with self.captureOnCommitCallbacks(execute=True):
+            repo.link(Link.create({"sourceId": nodes[1]["id"], "targetId": nodes[2]["id"], "type": "con_arg"}))
+        with self.captureOnCommitCallbacks(execute=True):
+            repo.unlink(LinkID.create({"sourceId": nodes[0]["id"], "targetId": nodes[1]["id"]}))
+
+        self.assertEqual(graphIndex.getChildIds(int(nodes[0]["id"])), [])
+        self.assertEqual(graphIndex.getChildren(int(nodes[1]["id"])), [{"sourceId": nodes[1]["id"], "targetId": nodes[2]["id"], "type": "con_arg"}])
+
+    def test_writes_of_other_processes(self):
+        repo = NodeRepository(graphIndex=GraphIndex())
+        # writes through the repository of another process, which the index does not see
+        otherRepo = NodeRepository()
+        nodes = [self.createNode(repo, str(i)) for i in range(3)]
+        repo.link(Link.create({"sourceId": nodes[0]["id"], "targetId": nodes[1]["id"], "type": "general"}))
+        repo.graphIndex.ensureLoaded()
+
+        otherRepo.link(Link.create({"sourceId": nodes[0]["id"], "targetId": nodes[2]["id"], "type": "con_arg"}))
+        otherRepo.unlink(LinkID.create({"sourceId": nodes[0]["id"], "targetId": nodes[1]["id"]}))
+        repo.validateCache()
+        self.assertEqual(repo.graphIndex.getChildren(int(nodes[0]["id"])), [{"sourceId": nodes[0]["id"], "targetId": nodes[2]["id"], "type": "con_arg"}])
+        self.assertEqual(repo.getSubgraph([nodes[0]["id"]], 1, 2000), otherRepo.getSubgraph([nodes[0]["id"]], 1, 2000))
+
+        # the index is loaded again if the changes cannot be applied
+        Change.objects.all().delete()
+        otherRepo.update(nodes[0]["id"], {"title": "changed", "content": "", "type": "general"})
+        Change.objects.all().delete()
+        repo.validateCache()
+        self.assertEqual(repo.graphIndex.revision(), (None, None))
+        self.assertEqual(repo.getSubgraph([nodes[0]["id"]], 1, 2000), otherRepo.getSubgraph([nodes[0]["id"]], 1, 2000))
+        self.assertEqual(repo.graphIndex.revision()[0], repo.getRevision())
+
+class GetNodesViewTestCase(TestCase):
+    def setUp(self):
+        clearViewCaches()
+
+    def test_streamed_response_equals_response(self):
+        repo = NodeRepository()
+        nodes = [repo.create(NodeData.create({"title": str(i), "content": "", "type": "general"})) for i in range(4)]
+        for child in nodes[1:]:
+            repo.link(Link.create({"sourceId": nodes[0]["id"], "targetId": child["id"], "type": "pro_arg"}))
+
+        command = json.dumps({"ids": [nodes[0]["id"]], "depth": 2})
+        response = self.client.get("/api/nodes/get", {"command": command})
+        streamedResponse = self.client.get("/api/nodes/stream", {"command": command})
+
+        self.assertEqual(streamedResponse.status_code, 200)
+        streamedCache = json.loads(b"".join(streamedResponse.streaming_content))
+        self.assertEqual(streamedCache, json.loads(response.content))
+        self.assertEqual(len(streamedCache["nodesById"]), 4)
+        self.assertEqual(len(streamedCache["childrenByParentId"][nodes[0]["id"]]), 3)
+
+    def test_writes_of_other_processes(self):
+        node = views.nodeRepository.create(NodeData.create({"title": "node", "content": "", "type": "general"}))
+        command = json.dumps({"ids": [node["id"]], "depth": 1})
+        self.client.get("/api/nodes/get", {"command": command})
+
+        NodeRepository().update(node["id"], {"title": "new title", "content": "", "type": "general"})
+        for path in ["/api/nodes/get", "/api/nodes/stream"]:
+            response = self.client.get(path, {"command": command})
+            content = b"".join(response.streaming_content) if response.streaming else response.content
+            self.assertEqual(json.loads(content)["nodesById"][node["id"]]["data"]["title"], "new title")
+
+    def test_invalid_command(self):
+        response = self.client.get("/api/nodes/stream", {"command": json.dumps({"ids": [1], "depth": 2})})
+        self.assertEqual(response.status_code, 400)
+
+    def test_not_modified(self):
+        repo = views.nodeRepository
+        (parent, child) = [repo.create(NodeData.create({"title": title, "content": "", "type": "general"})) for title in ["parent", "child"]]
+        repo.link(Link.create({"sourceId": parent["id"], "targetId": child["id"], "type": "general"}))
+
+        command = json.dumps({"ids": [parent["id"]], "depth": 1})
+        response = self.client.get("/api/nodes/get", {"command": command})
+        etag = response["ETag"]
+
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/nodes/get", {"command": command}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get("/api/nodes/stream", {"command": command}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # a different command has a different ETag
+        response = self.client.get("/api/nodes/get", {"command": json.dumps({"ids": [parent["id"]], "depth": 2})}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        repo.unlink(LinkID.create({"sourceId": parent["id"], "targetId": child["id"]}))
+        response = self.client.get("/api/nodes/get", {"command": command}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(json.loads(response.content)["childrenByParentId"], {parent["id"]: []})
+
+        # unlinking a link that is already deleted does not change the revision
+        etag = response["ETag"]
+        repo.unlink(LinkID.create({"sourceId": parent["id"], "targetId": child["id"]}))
+        response = self.client.get("/api/nodes/get", {"command": command}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+class GetChangesSinceTestCase(TestCase):
+    def createNode(self, repo, title):
+        return repo.create(NodeData.create({"title": title, "content": "", "type": "general"}))
+
+    def getChanges(self, repo, command):
+        return executeGetChangesSinceCommand(GetChangesSinceCommand.create(command), repo)
+
+    def test_changes(self):
+        repo = NodeRepository()
+        cursor = self.getChanges(repo, {"cursor": 0})["cursor"]
+        (parent, child, other) = [self.createNode(repo, title) for title in ["parent", "child", "other"]]
+        repo.link(Link.create({"sourceId": parent["id"], "targetId": child["id"], "type": "general"}))
+
+        result = self.getChanges(repo, {"cursor": cursor})
+        self.assertFalse(result["hasMore"])
+        self.assertEqual(set(result["changes"]["nodesById"].keys()), {parent["id"], child["id"], other["id"]})
+        self.assertEqual([l["targetId"] for l in result["changes"]["childrenByParentId"][parent["id"]]], [child["id"]])
+
+        cursor = result["cursor"]
+        self.assertEqual(self.getChanges(repo, {"cursor": cursor}), {"cursor": cursor, "hasMore": False, "reset": False, "changes": Cache.createEmpty()})
+
+        repo.update(other["id"], {"title": "changed", "content": "", "type": "general"})
+        repo.unlink(LinkID.create({"sourceId": parent["id"], "targetId": child["id"]}))
+        result = self.getChanges(repo, {"cursor": cursor})
+        self.assertEqual(list(result["changes"]["nodesById"].keys()), [other["id"]])
+        self.assertEqual(result["changes"]["nodesById"][other["id"]]["data"]["title"], "changed")
+        self.assertEqual(result["changes"]["childrenByParentId"], {parent["id"]: []})
+        self.assertGreater(result["cursor"], cursor)
+
+    def test_subtree(self):
+        repo = NodeRepository()
+        (parent, child, other) = [self.createNode(repo, title) for title in ["parent", "child", "other"]]
+        repo.link(Link.create({"sourceId": parent["id"], "targetId": child["id"], "type": "general"}))
+        cursor = self.getChanges(repo, {"cursor": 0})["cursor"]
+
+        repo.update(child["id"], {"title": "changed", "content": "", "type": "general"})
+        repo.update(other["id"], {"title": "changed", "content": "", "type": "general"})
+        repo.link(Link.create({"sourceId": other["id"], "targetId": child["id"], "type": "general"}))
+
+        result = self.getChanges(repo, {"cursor": cursor, "subtree": {"ids": [parent["id"]], "depth": 1}})
+        self.assertEqual(list(result["changes"]["nodesById"].keys()), [child["id"]])
+        self.assertEqual(result["changes"]["childrenByParentId"], {})
+
+    def test_reset(self):
+        repo = NodeRepository()
+        cursor = self.getChanges(repo, {"cursor": 0})["cursor"]
+        self.createNode(repo, "before")
+        Change.recordReset()
+        after = self.createNode(repo, "after")
+
+        result = self.getChanges(repo, {"cursor": cursor})
+        self.assertTrue(result["reset"])
+        self.assertEqual(list(result["changes"]["nodesById"].keys()), [after["id"]])
+        self.assertFalse(self.getChanges(repo, {"cursor": result["cursor"]})["reset"])
+
+    def test_missing_revision_row(self):
+        repo = NodeRepository()
+        GraphRevision.objects.all().delete()
+        self.assertEqual(repo.getRevision(), 0)
+        self.createNode(repo, "node")
+        self.assertEqual(repo.getRevision(), 1)
+        self.createNode(repo, "other")
+        self.assertEqual(repo.getRevision(), 2)
+
+    def test_view(self):
+        node = self.createNode(views.nodeRepository, "node")
+        response = self.client.get("/api/nodes/changes", {"command": json.dumps({"cursor": 0})})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(node["id"], json.loads(response.content)["changes"]["nodesById"])
+
+        response = self.client.get("/api/nodes/changes", {"command": json.dumps({"cursor": -1})})
+        self.assertEqual(response.status_code, 400)
+
+class AsyncNodeRepositoryTestCase(TransactionTestCase):
+    # keeps the graph revision that the migrations create
+    serialized_rollback = True
+
+    def test_concurrent_reads(self):
+        repo = NodeRepository()
+        (parent, child) = [repo.create(NodeData.create({"title": title, "content": "", "type": "general"})) for title in ["parent", "child"]]
+        repo.link(Link.create({"sourceId": parent["id"], "targetId": child["id"], "type": "general"}))
+
+        command = GetChangesSinceCommand.create({"cursor": 0, "subtree": {"ids": [parent["id"]], "depth": 1}})
+        result = async_to_sync(executeGetChangesSinceCommandAsync)(command, AsyncNodeRepository(repo, True))
+        self.assertEqual(result, executeGetChangesSinceCommand(command, repo))
+        self.assertEqual(set(result["changes"]["nodesById"].keys()), {parent["id"], child["id"]})
+
+    def test_single_reads_use_request_connection(self):
+        repo = NodeRepository()
+        asyncRepo = AsyncNodeRepository(repo, True)
+        with transaction.atomic():
+            node = repo.create(NodeData.create({"title": "node", "content": "", "type": "general"}))
+            # the uncommitted writes are only visible on the connection of the request
+            self.assertEqual(async_to_sync(asyncRepo.getRevision)(), repo.getRevision())
+            self.assertEqual(async_to_sync(asyncRepo.getAncestors)(node["id"]), ({node["id"]: node}, {node["id"]: []}))
+            self.assertTrue(async_to_sync(asyncRepo.isReachable)(node["id"], node["id"]))
+
+class BatchTestCase(TestCase):
+    def setUp(self):
+        clearViewCaches()
+
+    def batch(self, commands):
+        return self.client.get("/api/batch", {"command": json.dumps({"commands": commands})})
+
+    def test_batch(self):
+        repo = views.nodeRepository
+        (parent, child) = [repo.create(NodeData.create({"title": title, "content": "", "type": "general"})) for title in ["parent", "child"]]
+        repo.link(Link.create({"sourceId": parent["id"], "targetId": child["id"], "type": "general"}))
+
+        getNodes = {"type": "getNodes", "value": {"ids": [parent["id"]], "depth": 1}}
+        # the revision and the last change (to validate the empty graph cache),
+        # the savepoint of the batch and a single subgraph query
+        with self.assertNumQueries(5):
+            response = self.batch([getNodes, getNodes, {"type": "getNodes", "value": {"ids": [child["id"]], "depth": 0}}])
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content)
+        self.assertEqual([r["value"]["nodeIds"] for r in result["results"]], [[parent["id"], child["id"]], [parent["id"], child["id"]], [child["id"]]])
+        self.assertEqual(set(result["cache"]["nodesById"].keys()), {parent["id"], child["id"]})
+
+        response = self.batch([
+            {"type": "createNode", "value": {"nodeData": {"title": "new", "content": "", "type": "general"}, "parentId": child["id"]}},
+            {"type": "updateNode", "value": {"id": parent["id"], "title": "changed", "content": None}},
+            {"type": "unlink", "value": {"links": [{"sourceId": parent["id"], "targetId": child["id"]}]}},
+            getNodes,
+        ])
+        result = json.loads(response.content)
+        newNode = result["results"][0]["value"]
+        self.assertEqual(newNode["data"]["title"], "new")
+        self.assertEqual([r["value"] for r in result["results"][1:]], [None, None, {"nodeIds": [parent["id"]], "truncatedIds": [], "childCursors": {}}])
+        self.assertEqual(result["cache"]["nodesById"][parent["id"]]["data"]["title"], "changed")
+        self.assertEqual(result["cache"]["childrenByParentId"], {parent["id"]: []})
+
+        # the writes of the batch are visible to later reads
+        self.assertEqual(repo.getChildren([child["id"]])[child["id"]][0]["targetId"], newNode["id"])
+        self.assertEqual(repo.get([parent["id"]])[parent["id"]]["data"]["title"], "changed")
+
+    def test_fetch_missing_levels(self):
+        repo = views.nodeRepository
+        nodes = [repo.create(NodeData.create({"title": str(i), "content": "", "type": "general"})) for i in range(3)]
+        for (parent, child) in zip(nodes, nodes[1:]):
+            repo.link(Link.create({"sourceId": parent["id"], "targetId": child["id"], "type": "general"}))
+
+        getNodes = lambda depth: {"type": "getNodes", "value": {"ids": [nodes[0]["id"]], "depth": depth}}
+        # the revision and the last change, the savepoint of the batch, a single subgraph query,
+        # and the children of the second level and the nodes of the third level
+        with self.assertNumQueries(7):
+            response = self.batch([getNodes(1), getNodes(2)])
+        result = json.loads(response.content)
+        self.assertEqual(result["results"][1]["value"]["nodeIds"], [node["id"] for node in nodes])
+        self.assertEqual(result["results"][1]["value"]["truncatedIds"], [])
+
+    def test_first_pages_of_children(self):
+        repo = views.nodeRepository
+        nodes = [repo.create(NodeData.create({"title": str(i), "content": "", "type": "general"})) for i in range(3)]
+        repo.linkMany([Link.create({"sourceId": nodes[0]["id"], "targetId": child["id"], "type": "general"}) for child in nodes[1:]])
+
+        getAllNodes = {"type": "getNodes", "value": {"ids": [nodes[0]["id"]], "depth": 1}}
+        getFirstNodes = {"type": "getNodes", "value": {"ids": [nodes[0]["id"]], "depth": 1, "maxChildren": 1}}
+        result = json.loads(self.batch([getFirstNodes, getAllNodes, getFirstNodes]).content)
+        self.assertEqual(result["results"][0]["value"]["childCursors"], result["results"][2]["value"]["childCursors"])
+        self.assertEqual(list(result["results"][0]["value"]["childCursors"].keys()), [nodes[0]["id"]])
+        self.assertEqual(result["results"][1]["value"]["childCursors"], {})
+        # the first page does not replace all children
+        self.assertEqual(len(result["cache"]["childrenByParentId"][nodes[0]["id"]]), 2)
+
+        # unless they were returned before a write
+        result = json.loads(self.batch([
+            getAllNodes,
+            {"type": "unlink", "value": {"links": [{"sourceId": nodes[0]["id"], "targetId": nodes[2]["id"]}]}},
+            {"type": "link", "value": {"links": [{"sourceId": nodes[0]["id"], "targetId": nodes[2]["id"], "type": "con_arg"}]}},
+            getFirstNodes,
+        ]).content)
+        self.assertEqual(result["cache"]["childrenByParentId"][nodes[0]["id"]], [
+            {"sourceId": nodes[0]["id"], "targetId": nodes[1]["id"], "type": "general"},
+        ])
+
+    def test_failing_batch_is_rolled_back(self):
+        repo = views.nodeRepository
+        node = repo.create(NodeData.create({"title": "node", "content": "", "type": "general"}))
+        response = self.batch([
+            {"type": "updateNode", "value": {"id": node["id"], "title": "changed", "content": None}},
+            {"type": "link", "value": {"links": [{"sourceId": node["id"], "targetId": "12345", "type": "general"}]}},
+        ])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(repo.get([node["id"]])[node["id"]]["data"]["title"], "node")
+
+    def test_invalid_command(self):
+        self.assertEqual(self.batch([{"type": "deleteEverything", "value": {}}]).status_code, 400)
+
+class EventsTestCase(TestCase):
+    def setUp(self):
+        clearViewCaches()
+
+    def test_push_changes(self):
+        repo = views.nodeRepository
+        (parent, child, other) = [repo.create(NodeData.create({"title": title, "content": "", "type": "general"})) for title in ["parent", "child", "other"]]
+        repo.link(Link.create({"sourceId": parent["id"], "targetId": child["id"], "type": "general"}))
+
+        def update(id):
+            with self.captureOnCommitCallbacks(execute=True):
+                repo.update(id, {"title": "changed", "content": "", "type": "general"})
+
+        bodies = async_to_sync(self.receiveEvents)({"ids": [parent["id"]], "depth": 1}, [
+            lambda: update(other["id"]),
+            lambda: update(child["id"]),
+        ])
+
+        self.assertEqual(bodies[0], b": subscribed\n\n")
+        self.assertTrue(bodies[1].startswith(b"event: changes\n"))
+        result = json.loads(bodies[1].split(b"data: ")[1])
+        self.assertEqual(list(result["changes"]["nodesById"].keys()), [child["id"]])
+        self.assertEqual(repo.changeHub.subscriberCount(), 0)
+
+    def test_poll_changes_of_other_processes(self):
+        repo = views.nodeRepository
+        node = repo.create(NodeData.create({"title": "node", "content": "", "type": "general"}))
+
+        # without running the on_commit callbacks, nothing is published, like for the writes of another process
+        def update():
+            repo.update(node["id"], {"title": "changed", "content": "", "type": "general"})
+
+        with mock.patch.object(events, "KEEPALIVE_INTERVAL", 0.01):
+            bodies = async_to_sync(self.receiveEvents)({"ids": [node["id"]], "depth": 0}, [update])
+
+        self.assertEqual(bodies[-2], b": keepalive\n\n")
+        result = json.loads(bodies[-1].split(b"data: ")[1])
+        self.assertEqual(result["changes"]["nodesById"][node["id"]]["data"]["title"], "changed")
+
+    # Subscribes with the given command, runs the writes and returns
+    # the bodies sent until the first event.
+    async def receiveEvents(self, command, writes):
+        bodies = []
+        sent = asyncio.Event()
+        disconnected = asyncio.Event()
+
+        async def receive():
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                bodies.append(message["body"])
+                sent.set()
+
+        async def waitForBodies(isDone):
+            while not isDone():
+                await asyncio.wait_for(sent.wait(), 5)
+                sent.clear()
+
+        scope = {"type": "http", "path": EVENTS_PATH, "query_string": urlencode({"command": json.dumps(command)}).encode()}
+        application = asyncio.ensure_future(eventsApplication(scope, receive, send))
+        await waitForBodies(lambda: len(bodies) > 0)
+        for write in writes:
+            await sync_to_async(write)()
+        await waitForBodies(lambda: bodies[-1].startswith(b"event: "))
+        disconnected.set()
+        await application
+        return bodies
+
+    def test_invalid_command(self):
+        sent = []
+        async def send(message):
+            sent.append(message)
+        scope = {"type": "http", "path": EVENTS_PATH, "query_string": b"command=%7B%7D"}
+        async_to_sync(eventsApplication)(scope, None, send)
+        self.assertEqual(sent[0]["status"], 400)
+
+class RequestEncodingTestCase(TestCase):
+    def setUp(self):
+        clearViewCaches()
+        repo = views.nodeRepository
+        (self.parent, self.child) = [repo.create(NodeData.create({"title": title, "content": "", "type": "general"})) for title in ["parent", "child"]]
+
+    def test_post_json(self):
+        links = {"links": [{"sourceId": self.parent["id"], "targetId": self.child["id"], "type": "general"}]}
+        response = self.client.post("/api/links/add", json.dumps(links), content_type="application/json")
+        self.assertEqual(response.status_code, 204)
+
+        response = self.client.post("/api/nodes/get", json.dumps({"ids": [self.parent["id"]], "depth": 1}), content_type="application/json")
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(len(json.loads(response.content)["childrenByParentId"][self.parent["id"]]), 1)
+
+    def test_invalid_body(self):
+        for (body, contentType) in [("{", "application/json"), ("{}", "text/plain")]:
+            response = self.client.post("/api/nodes/get", body, content_type=contentType)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get("/api/nodes/get", {"command": "{"}).status_code, 400)
+
+    @unittest.skipIf(views.msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        msgpack = views.msgpack
+        body = msgpack.packb({"ids": [self.parent["id"]], "depth": 1})
+        response = self.client.post("/api/nodes/get", body, content_type="application/msgpack", HTTP_ACCEPT="application/msgpack")
+        self.assertEqual(response["Content-Type"], "application/msgpack")
+        self.assertEqual(set(msgpack.unpackb(response.content)["nodesById"].keys()), {self.parent["id"]})
+
+        # the ETags of the encodings differ
+        command = json.dumps({"ids": [self.parent["id"]], "depth": 1})
+        etag = self.client.get("/api/nodes/get", {"command": command})["ETag"]
+        response = self.client.get("/api/nodes/get", {"command": command}, HTTP_ACCEPT="application/msgpack", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+class CompressionTestCase(TestCase):
+    def setUp(self):
+        clearViewCaches()
+
+    def test_choose_content_encoding(self):
+        brotli = ["br"] if compression.brotli is not None else []
+        for (acceptEncoding, expected) in [
+            ("", None),
+            ("gzip", "gzip"),
+            ("gzip;q=0.5, br", (brotli + ["gzip"])[0]),
+            ("gzip;q=0, identity", None),
+            ("*", (brotli + ["gzip"])[0]),
+            ("br;q=0, *;q=0.1", "gzip"),
+        ]:
+            request = self.client.get("/api/metrics", HTTP_ACCEPT_ENCODING=acceptEncoding).wsgi_request
+            self.assertEqual(chooseContentEncoding(request), expected, acceptEncoding)
+
+    def test_compressed_response_is_cached(self):
+        repo = views.nodeRepository
+        root = repo.create(NodeData.create({"title": "root", "content": "x" * 2000, "type": "general"}))
+        command = json.dumps({"ids": [root["id"]], "depth": 1})
+
+        response = self.client.get("/api/nodes/get", {"command": command}, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        body = json.loads(gzip.decompress(response.content))
+        self.assertEqual(body["nodesById"][root["id"]]["data"]["content"], "x" * 2000)
+
+        # only the revision is read
+        with self.assertNumQueries(1):
+            cachedResponse = self.client.get("/api/nodes/get", {"command": command}, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(cachedResponse.content, response.content)
+        self.assertIn('responseCacheHits;desc="1"', cachedResponse["Server-Timing"])
+
+        response = self.client.get("/api/nodes/get", {"command": command})
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(json.loads(response.content), body)
+        # the bodies differ, so their ETags do
+        self.assertNotEqual(response["ETag"], cachedResponse["ETag"])
+        response = self.client.get("/api/nodes/get", {"command": command}, HTTP_IF_NONE_MATCH=cachedResponse["ETag"])
+        self.assertEqual(response.status_code, 200)
+
+        repo.update(root["id"], {"title": "root", "content": "y" * 2000, "type": "general"})
+        response = self.client.get("/api/nodes/get", {"command": command}, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(json.loads(gzip.decompress(response.content))["nodesById"][root["id"]]["data"]["content"], "y" * 2000)
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        metricsRegistry.clear()
+        clearViewCaches()
+
+    def test_get_nodes_metrics(self):
+        repo = NodeRepository()
+        (parent, child) = [repo.create(NodeData.create({"title": title, "content": "", "type": "general"})) for title in ["parent", "child"]]
+        repo.link(Link.create({"sourceId": parent["id"], "targetId": child["id"], "type": "general"}))
+
+        response = self.client.get("/api/nodes/get", {"command": json.dumps({"ids": [parent["id"]], "depth": 1})})
+        self.assertIn("parse;dur=", response["Server-Timing"])
+        self.assertIn("serialize;dur=", response["Server-Timing"])
+        # the revision, the last change (for the empty graph cache) and the subgraph
+        self.assertIn('queries;desc="3"', response["Server-Timing"])
+        self.assertIn('nodes;desc="2"', response["Server-Timing"])
+        self.client.get("/api/nodes/get", {"command": "{}"})
+
+        snapshot = json.loads(self.client.get("/api/metrics").content)
+        self.assertEqual(list(snapshot["commands"].keys()), ["getNodes"])
+        getNodesMetrics = snapshot["commands"]["getNodes"]
+        self.assertEqual(getNodesMetrics["requests"], 2)
+        self.assertEqual(getNodesMetrics["failedRequests"], 1)
+        self.assertEqual(getNodesMetrics["valueSums"]["levels"], 2)
+        self.assertEqual(sum(getNodesMetrics["latencyHistogram"]), 2)
+
+class BenchmarkTestCase(TestCase):
+    def test_run_benchmarks(self):
+        dumpPath = os.path.join(settings.BASE_DIR, "dump-2019-04-16.json")
+        # as configured for the benchmark command
+        views.asyncNodeRepository.concurrentReads = settings.ASYNC_CONCURRENT_READS
+        try:
+            results = runBenchmarks(scale=0.01, repetitions=1, dumpPath=dumpPath)
+        finally:
+            views.asyncNodeRepository.concurrentReads = False
+
+        self.assertEqual(set(r["graph"] for r in results["results"]), {"wide", "deep", "dag", "tombstoned", "dump"})
+        self.assertTrue(all(r["queries"] <= 1 for r in results["results"] if r["operation"] == "getNodes"))
+        # cold requests read the last change (for the empty graph cache)
+        # and the subgraph, cached ones only the revision
+        queries = {(r["graph"], r["operation"]): r["queries"] for r in results["results"]}
+        for graph in ["wide", "deep", "dag", "tombstoned", "dump"]:
+            self.assertEqual(queries[(graph, "getNodesView")], 3)
+            self.assertEqual(queries[(graph, "getNodesViewCached")], 1)
+        self.assertEqual(DBNode.objects.count(), 0)
+        json.dumps(results)
+
+# Schema changes (for the deferred indexes) are not possible
+# inside the transaction of a TestCase on SQLite.
+class SnapshotTestCase(TransactionTestCase):
+    def test_round_trip(self):
+        builder = GraphBuilder()
+        root = builder.node("root")
+        for i in range(5):
+            child = builder.node("child " + str(i))
+            builder.link(root, child, deleted=(i == 0))
+        builder.save()
+        rows = lambda: (list(DBNode.objects.order_by("id").values_list()), list(DBLink.objects.order_by("id").values_list()))
+        expected = rows()
+
+        snapshot = io.StringIO()
+        self.assertEqual(exportSnapshot(snapshot, chunkSize=2), (6, 5))
+        # the indexes are not dropped for an import that cannot succeed
+        with CaptureQueriesContext(connection) as queries:
+            with self.assertRaises(SnapshotException):
+                importSnapshot(io.StringIO(snapshot.getvalue()))
+        self.assertFalse(any("INDEX" in query["sql"] for query in queries))
+
+        repo = NodeRepository(GraphCache(100))
+        repo.validateCache()
+        repo.get([str(root)])
+        cursor = repo.getLastChangeNumber()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(importSnapshot(io.StringIO(snapshot.getvalue()), chunkSize=2, replace=True), (6, 5))
+        self.assertEqual(rows(), expected)
+        self.assertEqual(len(self.linkIndexes()), len(DBLink._meta.indexes))
+        # the rows are deleted without loading them
+        self.assertFalse(any(query["sql"].startswith('SELECT "xtreembackend_node"."id"') for query in queries))
+
+        # the import is logged as a reset
+        self.assertEqual(repo.getChangesSince(cursor, 100)[1:], (set(), set(), False, True))
+        repo.validateCache()
+        self.assertIsNone(repo.graphCache.getNode(str(root)))
+
+        # new rows do not collide with the imported IDs
+        node = repo.create(NodeData.create({"title": "new", "content": "", "type": "general"}))
+        self.assertGreater(int(node["id"]), max(id for (id, *_) in expected[0]))
+
+    def test_invalid_rows_change_nothing(self):
+        snapshot = '{"format": "xtreem-snapshot", "version": 1}\n["n", 1, "a", "", "general"]\n["n", 2, "b", "", "unknown"]\n'
+        with self.assertRaisesRegex(SnapshotException, "line 3"):
+            importSnapshot(io.StringIO(snapshot), chunkSize=1)
+        self.assertEqual(DBNode.objects.count(), 0)
+        self.assertEqual(len(self.linkIndexes()), len(DBLink._meta.indexes))
+
+    def linkIndexes(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, DBLink._meta.db_table)
+        return [name for name in constraints if name in set(index.name for index in DBLink._meta.indexes)]
+
 """
 Ideas for more unit tests:
 ==========================
@@ -5,11 +5,22 @@ from . import views
 app_name="xtreembackend"
 urlpatterns = [
     path("api/nodes/get", views.getNodes, name="getNodes"),
+    path("api/nodes/stream", views.streamNodes, name="streamNodes"),
+    path("api/nodes/changes", views.getChangesSince, name="getChangesSince"),
+    path("api/nodes/children", views.getChildrenPage, name="getChildrenPage"),
+    path("api/nodes/ancestors", views.getAncestors, name="getAncestors"),
+    path("api/nodes/reachable", views.isReachable, name="isReachable"),
     path("api/nodes/create", views.createNode, name="createNode"),
+    path("api/nodes/createMany", views.createNodes, name="createNodes"),
     path("api/nodes/update", views.updateNode, name="updateNode"),
+    path("api/nodes/clone", views.cloneSubtree, name="cloneSubtree"),
 
     path("api/links/delete", views.deleteLinks, name="deleteLinks"),
     path("api/links/move", views.moveLinks, name="moveLinks"),
     path("api/links/add", views.addLinks, name="addLinks"),
+
+    path("api/batch", views.executeBatch, name="executeBatch"),
+
+    path("api/metrics", views.getMetrics, name="getMetrics"),
 ]
 
@@ -1,75 +1,333 @@
+import hashlib
 import json
 import traceback
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.http import JsonResponse, HttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.cache import get_conditional_response
 
 from .models import Node as DBNode, Link as DBLink
-from .repositories import NodeRepository
-from .api import executeGetNodesCommand, GetNodesCommand, executeCreateNodeCommand, CreateNodeCommand, UnlinkCommand, LinkCommand, MoveCommand, UpdateNodeDataCommand, executeLinkCommand, executeMoveCommand, executeUnlinkCommand, executeUpdateNodeDataCommand
+from .repositories import AsyncNodeRepository, NodeRepository, NodeNotFoundException
+from .graphcache import GraphCache
+from .graphindex import GraphIndex
+from .pubsub import ChangeHub
+from .api import executeBatchCommand, BatchCommand, BatchResult, executeGetNodesCommand, iterGetNodesCommand, GetNodesCommand, GetNodesResult, executeGetChildrenPageCommand, GetChildrenPageCommand, ChildrenPage, executeGetAncestorsCommand, GetAncestorsCommand, AncestorsResult, executeIsReachableCommand, IsReachableCommand, IsReachableResult, executeGetChangesSinceCommandAsync, GetChangesSinceCommand, ChangesResult, executeCreateNodeCommand, CreateNodeCommand, executeCreateNodesCommand, CreateNodesCommand, CreateNodesResult, executeCloneSubtreeCommand, CloneSubtreeCommand, CloneSubtreeResult, UnlinkCommand, LinkCommand, MoveCommand, UpdateNodeDataCommand, executeLinkCommand, executeMoveCommand, executeUnlinkCommand, executeUpdateNodeDataCommand
 from .domain.objects import Node, Link
 from .domain.cache import Cache
+from .dataspecs import ListDataType
+from .metrics import metricsRegistry, record, timed
+from .compression import ResponseCache, chooseContentEncoding, compress
 
 from .validation import Guard, ValidationException
 
-nodeRepository = NodeRepository()
+LinkList = ListDataType(Link)
+
+nodeRepository = NodeRepository(
+    GraphCache(settings.GRAPH_CACHE_SIZE) if settings.GRAPH_CACHE_SIZE > 0 else None,
+    GraphIndex() if settings.GRAPH_INDEX_ENABLED else None,
+    ChangeHub(),
+)
+asyncNodeRepository = AsyncNodeRepository(nodeRepository, settings.ASYNC_CONCURRENT_READS)
+responseCache = ResponseCache(settings.RESPONSE_CACHE_SIZE) if settings.RESPONSE_CACHE_SIZE > 0 else None
+
+# The API views are async, so that a request does not occupy
+# a thread while it waits for the database when served via ASGI.
+# Each command is executed with a single call to `asyncNodeRepository`
+# (which runs it in a thread), unless it consists of independent reads.
+
+async def createNode(request):
+    try:
+        command = parseCommand(request, CreateNodeCommand)
+        node = await asyncNodeRepository.execute(executeCreateNodeCommand, command)
+        with timed("serialize"):
+            return encodeResponse(request, Node.serialize(node))
+
+    except ValidationException:
+        return HttpResponse(status=400)
+    except NodeNotFoundException:
+        return HttpResponse(status=404)
+
+async def createNodes(request):
+    try:
+        command = parseCommand(request, CreateNodesCommand)
+        result = await asyncNodeRepository.execute(executeCreateNodesCommand, command)
+        with timed("serialize"):
+            return encodeResponse(request, CreateNodesResult.serialize(result))
+
+    except ValidationException:
+        return HttpResponse(status=400)
+    except NodeNotFoundException:
+        return HttpResponse(status=404)
 
-def createNode(request):
+async def cloneSubtree(request):
     try:
-        command = CreateNodeCommand.create(getRawCommand(request))
-        node = executeCreateNodeCommand(command, nodeRepository)
-        return JsonResponse(Node.serialize(node))
+        command = parseCommand(request, CloneSubtreeCommand)
+        result = await asyncNodeRepository.execute(executeCloneSubtreeCommand, command)
+        with timed("serialize"):
+            return encodeResponse(request, CloneSubtreeResult.serialize(result))
 
     except ValidationException:
         return HttpResponse(status=400)
+    except NodeNotFoundException:
+        return HttpResponse(status=404)
 
-def deleteLinks(request):
+async def deleteLinks(request):
     try:
-        command = UnlinkCommand.create(getRawCommand(request))
-        executeUnlinkCommand(command, nodeRepository)
+        command = parseCommand(request, UnlinkCommand)
+        await asyncNodeRepository.execute(executeUnlinkCommand, command)
 
         return HttpResponse(status=204)
 
     except ValidationException:
         return HttpResponse(status=400)
+    except NodeNotFoundException:
+        return HttpResponse(status=404)
 
-def addLinks(request):
+async def addLinks(request):
     try:
-        command = LinkCommand.create(getRawCommand(request))
-        executeLinkCommand(command, nodeRepository)
+        command = parseCommand(request, LinkCommand)
+        await asyncNodeRepository.execute(executeLinkCommand, command)
 
         return HttpResponse(status=204)
 
     except ValidationException:
         return HttpResponse(status=400)
+    except NodeNotFoundException:
+        return HttpResponse(status=404)
 
-def moveLinks(request):
+async def moveLinks(request):
     try:
-        command = MoveCommand.create(getRawCommand(request))
-        executeMoveCommand(command, nodeRepository)
-        return HttpResponse(204)
+        command = parseCommand(request, MoveCommand)
+        await asyncNodeRepository.execute(executeMoveCommand, command)
+        return HttpResponse(status=204)
 
     except ValidationException:
         return HttpResponse(status=400)
+    except NodeNotFoundException:
+        return HttpResponse(status=404)
 
-def updateNode(request):
+async def updateNode(request):
     try:
-        command = UpdateNodeDataCommand.create(getRawCommand(request))
-        executeUpdateNodeDataCommand(command, nodeRepository)
+        command = parseCommand(request, UpdateNodeDataCommand)
+        await asyncNodeRepository.execute(executeUpdateNodeDataCommand, command)
         return HttpResponse(status=204)
     except ValidationException:
         return HttpResponse(status=400)
+    except NodeNotFoundException:
+        return HttpResponse(status=404)
 
-def getNodes(request):
+async def getNodes(request):
     try:
-        command = GetNodesCommand.create(getRawCommand(request))
-        resultCache = executeGetNodesCommand(command, nodeRepository)
-        return JsonResponse(Cache.serialize(resultCache))
+        command = parseCommand(request, GetNodesCommand)
+        mediaType = responseMediaType(request)
+        requestedEncoding = chooseContentEncoding(request)
+        revision = await asyncNodeRepository.getRevision()
+        etag = getNodesEtag(command, revision, mediaType, requestedEncoding)
+        notModified = getNotModifiedResponse(request, etag)
+        if notModified is not None:
+            return notModified
+
+        # the ETag identifies the encoded body, so it can be reused
+        cached = responseCache.get(etag) if responseCache is not None else None
+        if cached is None:
+            result = await asyncNodeRepository.execute(executeGetNodesCommand, command, revision)
+            with timed("serialize"):
+                body = encodeBody(mediaType, GetNodesResult.serialize(result))
+            with timed("compress"):
+                cached = compress(body, requestedEncoding)
+            if responseCache is not None:
+                responseCache.store(etag, cached)
+        else:
+            record("responseCacheHits", 1)
+
+        response = createResponse(cached, mediaType)
+        response["ETag"] = etag
+        return response
     except ValidationException:
         print("ValidationException:")
         traceback.print_exc()
         return HttpResponse(status=400)
 
+async def getChildrenPage(request):
+    try:
+        command = parseCommand(request, GetChildrenPageCommand)
+        page = await asyncNodeRepository.execute(executeGetChildrenPageCommand, command)
+        with timed("serialize"):
+            return encodeResponse(request, ChildrenPage.serialize(page))
+    except ValidationException:
+        return HttpResponse(status=400)
+
+async def getAncestors(request):
+    try:
+        command = parseCommand(request, GetAncestorsCommand)
+        result = await asyncNodeRepository.execute(executeGetAncestorsCommand, command)
+        with timed("serialize"):
+            return encodeResponse(request, AncestorsResult.serialize(result))
+    except ValidationException:
+        return HttpResponse(status=400)
+    except NodeNotFoundException:
+        return HttpResponse(status=404)
+
+async def isReachable(request):
+    try:
+        command = parseCommand(request, IsReachableCommand)
+        result = await asyncNodeRepository.execute(executeIsReachableCommand, command)
+        with timed("serialize"):
+            return encodeResponse(request, IsReachableResult.serialize(result))
+    except ValidationException:
+        return HttpResponse(status=400)
+
+async def getChangesSince(request):
+    try:
+        command = parseCommand(request, GetChangesSinceCommand)
+        await asyncNodeRepository.validateCache()
+        result = await executeGetChangesSinceCommandAsync(command, asyncNodeRepository)
+        with timed("serialize"):
+            return encodeResponse(request, ChangesResult.serialize(result))
+    except ValidationException:
+        return HttpResponse(status=400)
+
+async def executeBatch(request):
+    try:
+        command = parseCommand(request, BatchCommand)
+        result = await asyncNodeRepository.execute(executeBatchCommand, command)
+        with timed("serialize"):
+            return encodeResponse(request, BatchResult.serialize(result))
+    except ValidationException:
+        return HttpResponse(status=400)
+    except NodeNotFoundException:
+        return HttpResponse(status=404)
+
+# Responds with the same JSON as getNodes, but encodes the nodes
+# while the traversal produces them instead of building the whole
+# response in memory first.
+# When served via ASGI, Django 3.2 iterates streaming responses on
+# the event loop, where the database must not be used, so the traversal
+# is finished in the view and only the encoding is done incrementally.
+def streamNodes(request):
+    try:
+        command = parseCommand(request, GetNodesCommand)
+        revision = nodeRepository.getRevision()
+        etag = getNodesEtag(command, revision, "application/json", None)
+        notModified = getNotModifiedResponse(request, etag)
+        if notModified is not None:
+            return notModified
+
+        nodeRepository.validateCache(revision)
+        truncatedIds = set()
+        childCursors = {}
+        levels = iterGetNodesCommand(command, nodeRepository, truncatedIds, childCursors)
+        if isinstance(request, ASGIRequest):
+            levels = list(levels)
+        response = StreamingHttpResponse(encodeResultIncrementally(levels, truncatedIds, childCursors), content_type="application/json")
+        response["ETag"] = etag
+        return response
+    except ValidationException:
+        return HttpResponse(status=400)
+
+# The result of a GetNodesCommand only changes when the graph revision
+# changes, so the command, the revision, the media type and the requested
+# content encoding (see chooseContentEncoding, None for identity) of the response
+# identify its body, as required for a strong ETag. The revision is read before
+# the traversal: if a write happens in between, the response is newer than
+# its ETag, and the next request fetches it again.
+def getNodesEtag(command, revision, mediaType, contentEncoding):
+    key = json.dumps(GetNodesCommand.serialize(command), sort_keys=True) + "@" + str(revision) + "@" + mediaType + "@" + str(contentEncoding)
+    return '"' + hashlib.sha1(key.encode("utf-8")).hexdigest() + '"'
+
+# Only GET requests are answered with 304 Not Modified;
+# for POST requests, If-None-Match has a different meaning.
+def getNotModifiedResponse(request, etag):
+    if request.method not in ("GET", "HEAD"):
+        return None
+    return get_conditional_response(request, etag=etag)
+
+# Encodes pairs (nodesById, childrenByParentId) into the JSON representation
+# of a GetNodesResult containing all of them, yielding one chunk per pair.
+# JSON does not allow to interleave the two maps, so the children are
+# kept (in encoded form) until all nodes have been written.
+# `truncatedIds` and `childCursors` are only read after all levels have been consumed.
+def encodeResultIncrementally(levels, truncatedIds, childCursors):
+    encodedChildren = []
+    separator = ""
+    yield '{"nodesById": {'
+    for (nodesById, childrenByParentId) in levels:
+        chunk = []
+        for (id, node) in nodesById.items():
+            chunk.append(separator + json.dumps(id) + ": " + json.dumps(Node.serialize(node)))
+            separator = ", "
+        yield "".join(chunk)
+
+        for (id, children) in childrenByParentId.items():
+            encodedChildren.append(json.dumps(id) + ": " + json.dumps(LinkList.serialize(children)))
+    yield '}, "childrenByParentId": {' + ", ".join(encodedChildren) + "}"
+    yield ', "truncatedIds": ' + json.dumps(sorted(truncatedIds, key=int))
+    yield ', "childCursors": ' + json.dumps(childCursors) + "}"
+
+# Responds with the metrics of all requests handled by this process
+# (see metrics.py).
+def getMetrics(request):
+    return JsonResponse(metricsRegistry.snapshot())
+getMetrics.excludedFromMetrics = True
+
+def parseCommand(request, commandType):
+    with timed("parse"):
+        return commandType.create(getRawCommand(request))
+
+# Commands are either sent in the body of a POST request, encoded as JSON
+# or (if the msgpack package is installed) as MessagePack,
+# or as JSON in the `command` parameter of a GET request.
 def getRawCommand(request):
-    return json.loads(Guard.access(request.GET, "command"))
+    try:
+        if request.method == "POST":
+            contentType = request.content_type
+            if contentType == "application/json":
+                return json.loads(request.body)
+            if contentType in MSGPACK_CONTENT_TYPES and msgpack is not None:
+                return msgpack.unpackb(request.body, raw=False)
+            raise ValidationException("unsupported content type " + contentType)
+        return json.loads(Guard.access(request.GET, "command"))
+    except ValueError as e:
+        # invalid JSON or MessagePack
+        raise ValidationException(str(e))
+
+MSGPACK_CONTENT_TYPES = ["application/msgpack", "application/x-msgpack"]
+
+# Encodes the response as MessagePack if the client accepts it
+# (and the msgpack package is installed), otherwise as JSON,
+# and compresses it if the client accepts a supported content encoding.
+def encodeResponse(request, data):
+    mediaType = responseMediaType(request)
+    body = encodeBody(mediaType, data)
+    with timed("compress"):
+        return createResponse(compress(body, chooseContentEncoding(request)), mediaType)
+
+def encodeBody(mediaType, data):
+    if mediaType == MSGPACK_CONTENT_TYPES[0]:
+        return msgpack.packb(data, use_bin_type=True)
+    return json.dumps(data).encode("utf-8")
+
+# `encodedBody` is a pair (body, contentEncoding) as returned by `compress`.
+def createResponse(encodedBody, mediaType):
+    (body, contentEncoding) = encodedBody
+    response = HttpResponse(body, content_type=mediaType)
+    if contentEncoding is not None:
+        response["Content-Encoding"] = contentEncoding
+    response["Vary"] = "Accept, Accept-Encoding"
+    return response
+
+def responseMediaType(request):
+    if msgpack is not None:
+        accept = request.headers.get("Accept", "")
+        if any(mediaType.split(";")[0].strip() in MSGPACK_CONTENT_TYPES for mediaType in accept.split(",")):
+            return MSGPACK_CONTENT_TYPES[0]
+    return "application/json"
 